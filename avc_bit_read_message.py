@@ -7,11 +7,15 @@ __all__ = [
 ]
 
 # pylint: disable=missing-type-doc
+import itertools
 import struct
 
 from pymodbus.pdu import ExceptionResponse, ModbusRequest, ModbusResponse
 from pymodbus.pdu import ModbusExceptions as merror
-from pymodbus.utilities import pack_bitstring, unpack_bitstring
+from pymodbus.utilities import pack_bitstring
+
+# The 8 bit values of every byte, LSB first, for expanding packed data
+_BYTE_BITS = [tuple(bool(byte >> i & 1) for i in range(8)) for byte in range(256)]
 
 
 class AvcReadBitsRequestBase(ModbusRequest):
@@ -68,7 +72,8 @@ class AvcReadBitsRequestBase(ModbusRequest):
 class AvcReadBitsResponseBase(ModbusResponse):
     """Base class for Messages responding to bit-reading values.
 
-    The requested bits can be found in the .bits list.
+    The requested bits are kept packed, 8 per byte, in .packed; .bits is
+    a list of booleans expanded on first access for existing callers.
     """
 
     _rtu_byte_count_pos = 2
@@ -81,15 +86,41 @@ class AvcReadBitsResponseBase(ModbusResponse):
         """
         ModbusResponse.__init__(self, slave, **kwargs)
 
-        #: A list of booleans representing bit values
+        #: The bit values, packed 8 per byte with the first bit in the LSB
+        self.packed = bytearray()
+        #: The number of bits in .packed
+        self.count = 0
+        self._bits = None
         self.bits = values or []
 
+    @property
+    def bits(self):
+        """Return the bit values as a list of booleans, expanded on first access."""
+        if self._bits is None:
+            expanded = itertools.chain.from_iterable(map(_BYTE_BITS.__getitem__, self.packed))
+            self._bits = list(itertools.islice(expanded, self.count))
+        return self._bits
+
+    @bits.setter
+    def bits(self, values):
+        """Replace the bit values.
+
+        :param values: The new bit values
+        """
+        self.packed = bytearray(pack_bitstring(values)) if values else bytearray()
+        self.count = len(values)
+        self._bits = None
+
     def encode(self):
         """Encode response pdu.
 
         :returns: The encoded packet message
         """
-        result = pack_bitstring(self.bits)
+        if self._bits is not None:
+            # the list view may have been modified in place by the caller
+            result = pack_bitstring(self._bits) if self._bits else b""
+        else:
+            result = bytes(self.packed)
         packet = struct.pack(">B", len(result)) + result
         return packet
 
@@ -99,7 +130,9 @@ class AvcReadBitsResponseBase(ModbusResponse):
         :param data: The packet data to decode
         """
         self.byte_count = int(data[0])  # pylint: disable=attribute-defined-outside-init
-        self.bits = unpack_bitstring(data[1:])
+        self.packed = bytearray(data[1:])
+        self.count = len(self.packed) * 8
+        self._bits = None
 
     def setBit(self, address, value=1):
         """Set the specified bit.
@@ -107,7 +140,12 @@ class AvcReadBitsResponseBase(ModbusResponse):
         :param address: The bit to set
         :param value: The value to set the bit to
         """
-        self.bits[address] = bool(value)
+        if value:
+            self.packed[address >> 3] |= 1 << (address & 7)
+        else:
+            self.packed[address >> 3] &= ~(1 << (address & 7)) & 0xFF
+        if self._bits is not None:
+            self._bits[address] = bool(value)
 
     def resetBit(self, address):
         """Set the specified bit to 0.
@@ -122,14 +160,37 @@ class AvcReadBitsResponseBase(ModbusResponse):
         :param address: The bit to query
         :returns: The value of the requested bit
         """
-        return self.bits[address]
+        if self._bits is not None:
+            return self._bits[address]
+        return bool(self.packed[address >> 3] >> (address & 7) & 1)
+
+    def changedBits(self, previous):
+        """Find the bits that differ from a previous frame.
+
+        The frames are compared with one XOR over their packed bytes.
+
+        :param previous: A previous response, or its packed bytes
+        :returns: The sorted addresses of the changed bits
+        """
+        if isinstance(previous, AvcReadBitsResponseBase):
+            previous = previous.packed
+        diff = int.from_bytes(self.packed, "little") ^ int.from_bytes(previous, "little")
+        changed = []
+        while diff:
+            lowest = diff & -diff
+            address = lowest.bit_length() - 1
+            if address >= self.count:
+                break
+            changed.append(address)
+            diff ^= lowest
+        return changed
 
     def __str__(self):
         """Return a string representation of the instance.
 
         :returns: A string representation of the instance
         """
-        return f"{self.__class__.__name__}({len(self.bits)})"
+        return f"{self.__class__.__name__}({self.count})"
 
 
 class AvcReadDiscreteInputsRequest(AvcReadBitsRequestBase):
@@ -161,7 +222,7 @@ class AvcReadDiscreteInputsRequest(AvcReadBitsRequestBase):
         request is valid against the current datastore.
 
         :param context: The datastore to request from
-        :returns: An initialized :py:class:`~pymodbus.register_read_message.ReadDiscreteInputsResponse`, or an :py:class:`~pymodbus.pdu.ExceptionResponse` if an error occurred
+        :returns: An initialized :py:class:`AvcReadDiscreteInputsResponse`, or an :py:class:`~pymodbus.pdu.ExceptionResponse` if an error occurred
         """
         if not (1 <= self.count <= 0x7D0):
             return self.doException(merror.IllegalValue)
@@ -7,11 +7,16 @@ __all__ = [
 ]
 
 # pylint: disable=missing-type-doc
+import array
 import struct
+import sys
 
 from pymodbus.pdu import ExceptionResponse, ModbusRequest, ModbusResponse
 from pymodbus.pdu import ModbusExceptions as merror
 
+# Registers are big-endian on the wire, array("H") uses the host byte order
+_SWAP = sys.byteorder == "little"
+
 
 class AvcReadRegistersRequestBase(ModbusRequest):
     """Base class for reading a modbus register."""
@@ -61,7 +66,8 @@ class AvcReadRegistersRequestBase(ModbusRequest):
 class AvcReadRegistersResponseBase(ModbusResponse):
     """Base class for responding to a modbus register read.
 
-    The requested registers can be found in the .registers list.
+    The requested registers are kept in the compact .register_array
+    (array("H")); .registers is a list view of it for existing callers.
     """
 
     _rtu_byte_count_pos = 2
@@ -74,28 +80,53 @@ class AvcReadRegistersResponseBase(ModbusResponse):
         """
         super().__init__(slave, **kwargs)
 
-        #: A list of register values
+        #: A compact array of register values
+        self.register_array = array.array("H")
+        self._registers = None
         self.registers = values or []
 
+    @property
+    def registers(self):
+        """Return the register values as a list, built on first access."""
+        if self._registers is None:
+            self._registers = self.register_array.tolist()
+        return self._registers
+
+    @registers.setter
+    def registers(self, values):
+        """Replace the register values.
+
+        :param values: The new register values
+        """
+        self.register_array = array.array("H", values)
+        self._registers = None
+
     def encode(self):
         """Encode the response packet.
 
         :returns: The encoded packet
         """
-        result = struct.pack(">B", len(self.registers) * 2)
-        for register in self.registers:
-            result += struct.pack(">H", register)
-        return result
+        if self._registers is not None:
+            # the list view may have been modified in place by the caller
+            values = array.array("H", self._registers)
+        else:
+            values = array.array("H", self.register_array)
+        if _SWAP:
+            values.byteswap()
+        return struct.pack(">B", len(values) * 2) + values.tobytes()
 
     def decode(self, data):
         """Decode a register response packet.
 
         :param data: The request to decode
         """
-        byte_count = int(data[0])
-        self.registers = []
-        for i in range(1, byte_count + 1, 2):
-            self.registers.append(struct.unpack(">H", data[i : i + 2])[0])
+        byte_count = int(data[0]) & ~1
+        values = array.array("H")
+        values.frombytes(memoryview(data)[1 : byte_count + 1])
+        if _SWAP:
+            values.byteswap()
+        self.register_array = values
+        self._registers = None
 
     def getRegister(self, index):
         """Get the requested register.
@@ -103,14 +134,16 @@ class AvcReadRegistersResponseBase(ModbusResponse):
         :param index: The indexed register to retrieve
         :returns: The request register
         """
-        return self.registers[index]
+        if self._registers is not None:
+            return self._registers[index]
+        return self.register_array[index]
 
     def __str__(self):
         """Return a string representation of the instance.
 
         :returns: A string representation of the instance
         """
-        return f"{self.__class__.__name__} ({len(self.registers)})"
+        return f"{self.__class__.__name__} ({len(self.register_array)})"
 
 
 class AvcReadHoldingRegistersRequest(AvcReadRegistersRequestBase):
@@ -139,7 +172,7 @@ class AvcReadHoldingRegistersRequest(AvcReadRegistersRequestBase):
         """Run a read holding request against a datastore.
 
         :param context: The datastore to request from
-        :returns: An initialized :py:class:`~pymodbus.register_read_message.ReadHoldingRegistersResponse`, or an :py:class:`~pymodbus.pdu.ExceptionResponse` if an error occurred
+        :returns: An initialized :py:class:`AvcReadHoldingRegistersResponse`, or an :py:class:`~pymodbus.pdu.ExceptionResponse` if an error occurred
         """
         if not (1 <= self.count <= 0x7D):
             return self.doException(merror.IllegalValue)
@@ -149,7 +182,7 @@ class AvcReadHoldingRegistersRequest(AvcReadRegistersRequestBase):
         if isinstance(values, ExceptionResponse):
             return values
 
-        return ReadHoldingRegistersResponse(values)
+        return AvcReadHoldingRegistersResponse(values)
 
 
 class AvcReadHoldingRegistersResponse(AvcReadRegistersResponseBase):
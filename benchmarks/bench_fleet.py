@@ -0,0 +1,207 @@
+"""Drive the forwarders and the gateway against a simulated PLC fleet.
+
+Starts N simulators (benchmarks/plc_sim.py) in a child process, then for
+each fleet size and target runs a number of poll cycles and reports the
+cycle time, reads per second and the CPU the target spent per cycle.
+The simulators run in their own process, so the CPU figures only cover
+the code under test.
+
+Run from the repository root::
+
+    python benchmarks/bench_fleet.py --devices 1,8,32 --latency 0.005 --jitter 0.002
+    python benchmarks/bench_fleet.py --targets gateway --failure 0.05 --drop 0.01
+
+Targets:
+
+- forwarder: forwarder.poll_devices() of the chosen groups, then
+  forward_data() into an uplink that discards the bytes
+- forwarder1: forwarder1.pool_data() of the chosen groups, device after
+  device like its scheduler does, with the coalesced read plans
+- gateway: one monitor read per device through forward_message(),
+  all devices concurrently, with the response cache disabled
+
+The machine group reads 285 registers at once in forwarder.py, more than
+the 125 a Modbus read may ask for, so the simulators answer those reads
+with an exception; it is left out of the default groups.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import forwarder  # noqa: E402
+import forwarder1  # noqa: E402
+import gateway  # noqa: E402
+from avc_bit_read_message import AvcReadDiscreteInputsRequest  # noqa: E402
+from modbus_pool import TcpMasterPool  # noqa: E402
+from plc_sim import start_fleet  # noqa: E402
+
+
+class NullUplink:
+    """Stands in for CloudUplink; counts the bytes instead of sending them."""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def publish(self, message, on_sent=None, on_spilled=None):
+        self.bytes += len(message)
+        if on_sent is not None:
+            on_sent()
+        return True
+
+
+def measure(cycles, cycle):
+    """Run cycle() repeatedly and return the wall and CPU time of each run."""
+    walls, cpus = [], []
+    for _ in range(cycles):
+        wall, cpu = time.perf_counter(), time.process_time()
+        cycle()
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+    return walls, cpus
+
+
+async def measure_async(cycles, cycle):
+    """Await cycle() repeatedly and return the wall and CPU time of each run."""
+    walls, cpus = [], []
+    for _ in range(cycles):
+        wall, cpu = time.perf_counter(), time.process_time()
+        await cycle()
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+    return walls, cpus
+
+
+def bench_forwarder(devices, args, warmed):
+    config = {"pool": {"timeout": args.timeout, "concurrency": args.concurrency}}
+    uplink = NullUplink()
+
+    async def run():
+        pool = forwarder.create_pool(config)
+        breakers = forwarder.create_breakers({})
+        data = {}
+
+        async def cycle():
+            for group in args.groups:
+                await forwarder.poll_devices(pool, devices, group, data, breakers)
+            forwarder.forward_data(uplink, forwarder.copy_snapshot(data))
+
+        # 先建立连接，连接耗时不计入结果
+        await cycle()
+        warmed()
+        try:
+            return await measure_async(args.cycles, cycle)
+        finally:
+            pool.close()
+
+    return asyncio.run(run())
+
+
+def bench_forwarder1(devices, args, warmed):
+    forwarder1.pool = TcpMasterPool(forwarder1.pool.factory, timeout=args.timeout)
+    breakers = forwarder1.create_breakers({})
+    groups = [forwarder1.GROUP_BLOCKS[group] for group in args.groups]
+
+    def cycle():
+        for blocks in groups:
+            for device in devices:
+                forwarder1.pool_data(device, blocks, breakers)
+
+    cycle()
+    warmed()
+    try:
+        return measure(args.cycles, cycle)
+    finally:
+        for device in devices:
+            forwarder1.pool.discard(device)
+
+
+def monitor_command(slave=1):
+    # 与云端下发的命令相同：完整的 MBAP 帧的十六进制字符串
+    request = AvcReadDiscreteInputsRequest(address=10, count=12*16, slave=slave)
+    pdu = bytes([request.function_code]) + request.encode()
+    return (struct.pack(">HHHB", 1, 0, len(pdu) + 1, slave) + pdu).hex()
+
+
+def bench_gateway(devices, args, warmed):
+    cmd = monitor_command()
+
+    async def run():
+        target = gateway.Gateway(device_port=devices[0]["port"], device_timeout=args.timeout, cache_ttl=0)
+
+        async def cycle():
+            await asyncio.gather(*(gateway.forward_message(target, device["ip"], cmd) for device in devices))
+
+        await cycle()
+        warmed()
+        try:
+            return await measure_async(args.cycles, cycle)
+        finally:
+            target.close()
+
+    return asyncio.run(run())
+
+
+TARGETS = {
+    "forwarder": bench_forwarder,
+    "forwarder1": bench_forwarder1,
+    "gateway": bench_gateway,
+}
+
+
+def report(target, count, walls, cpus, reads):
+    cycle = statistics.mean(walls)
+    cpu = statistics.mean(cpus)
+    print(f"{target:<11} {count:>7} {cycle * 1000:10.1f} {max(walls) * 1000:10.1f} "
+          f"{reads / sum(walls):10.0f} {cpu * 1000:10.2f} {100 * cpu / cycle:6.1f}%")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", default="1,8,32", help="Comma separated fleet sizes")
+    parser.add_argument("--targets", default=",".join(TARGETS), help="Comma separated targets")
+    parser.add_argument("--groups", default="monitor,storage", help="Block groups the forwarders poll")
+    parser.add_argument("--cycles", type=int, default=10, help="Measured cycles per configuration")
+    parser.add_argument("--latency", type=float, default=0.005, help="Mean PLC response delay, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.002, help="Max deviation from the delay, in seconds")
+    parser.add_argument("--failure", type=float, default=0.0, help="Fraction of reads answered with an exception")
+    parser.add_argument("--drop", type=float, default=0.0, help="Fraction of reads left unanswered")
+    parser.add_argument("--timeout", type=float, default=0.5, help="Client timeout, in seconds")
+    parser.add_argument("--concurrency", type=int, default=4, help="In-flight reads per device (forwarder)")
+    parser.add_argument("--port", type=int, default=5502, help="TCP port of the simulators")
+    args = parser.parse_args()
+    args.devices = [int(count) for count in args.devices.split(",")]
+    args.targets = args.targets.split(",")
+    args.groups = args.groups.split(",")
+    return args
+
+
+def main():
+    args = parse_args()
+    # 日志输出会左右 CPU 的测量结果
+    logging.disable(logging.CRITICAL)
+    print(f"latency {args.latency * 1000:.1f}ms ±{args.jitter * 1000:.1f}ms, "
+          f"failure {args.failure:.0%}, drop {args.drop:.0%}, groups {'+'.join(args.groups)}")
+    print(f"{'target':<11} {'devices':>7} {'cycle ms':>10} {'max ms':>10} {'reads/s':>10} {'cpu ms':>10} {'cpu':>7}")
+    for count in args.devices:
+        process, devices, answered = start_fleet(count, args.port, latency=args.latency, jitter=args.jitter,
+                                                 failure_rate=args.failure, drop_rate=args.drop)
+        try:
+            for target in args.targets:
+                # 读取次数按模拟器实际应答的请求计，与目标的实现无关
+                before = []
+                walls, cpus = TARGETS[target](devices, args, lambda: before.append(answered.value))
+                report(target, count, walls, cpus, answered.value - before[0])
+        finally:
+            process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
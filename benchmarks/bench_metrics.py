@@ -0,0 +1,46 @@
+"""Measure the cost of recording one metric sample.
+
+Run from the repository root::
+
+    python benchmarks/bench_metrics.py
+"""
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import Registry, render  # noqa: E402
+
+
+def bench(name, func, number=200000):
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:<40} {seconds * 1e9:9.1f} ns")
+    return seconds
+
+
+def main():
+    registry = Registry()
+    histogram = registry.histogram("read_seconds", "Read latency", ("device", "block"))
+    counter = registry.counter("errors_total", "Errors", ("device", "reason"))
+    child = histogram.labels("192.168.1.100:502", "monitor")
+    for i in range(100):
+        histogram.labels(f"192.168.1.{i}:502", "monitor")
+
+    bench("Histogram.observe", lambda: child.observe(0.0123))
+    bench("labels().observe", lambda: histogram.labels("192.168.1.100:502", "monitor").observe(0.0123))
+    bench("labels().inc", lambda: counter.labels("192.168.1.100:502", "timeout").inc())
+    perf_counter = time.perf_counter
+    started = perf_counter()
+    bench("perf_counter + labels().observe",
+          lambda: histogram.labels("192.168.1.100:502", "monitor").observe(perf_counter() - started))
+
+    start = time.perf_counter()
+    text = render([{"service": "forwarder", "families": registry.snapshot()}])
+    elapsed = time.perf_counter() - start
+    print(f"render {len(text.splitlines())} lines {elapsed * 1e3:9.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
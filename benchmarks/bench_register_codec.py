@@ -0,0 +1,68 @@
+"""Compare the bulk register codec with the former per-register loop.
+
+Run from the repository root::
+
+    python benchmarks/bench_register_codec.py
+"""
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from avc_register_read_message import AvcReadHoldingRegistersResponse  # noqa: E402
+
+
+def legacy_encode(registers):
+    """The former AvcReadRegistersResponseBase.encode."""
+    result = struct.pack(">B", len(registers) * 2)
+    for register in registers:
+        result += struct.pack(">H", register)
+    return result
+
+
+def legacy_decode(data):
+    """The former AvcReadRegistersResponseBase.decode."""
+    byte_count = int(data[0])
+    registers = []
+    for i in range(1, byte_count + 1, 2):
+        registers.append(struct.unpack(">H", data[i : i + 2])[0])
+    return registers
+
+
+def bench(name, func, number=2000):
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:<32} {seconds * 1e6:9.2f} us")
+    return seconds
+
+
+def main():
+    for count in (43, 125):
+        values = [(i * 7919) & 0xFFFF for i in range(count)]
+        packet = legacy_encode(values)
+        response = AvcReadHoldingRegistersResponse()
+        response.decode(packet)
+        assert response.registers == legacy_decode(packet) == values
+        assert AvcReadHoldingRegistersResponse(values).encode() == packet
+
+        def bulk_decode():
+            AvcReadHoldingRegistersResponse().decode(packet)
+
+        def bulk_decode_list():
+            decoded = AvcReadHoldingRegistersResponse()
+            decoded.decode(packet)
+            return decoded.registers
+
+        print(f"{count} registers")
+        old = bench("  legacy decode", lambda: legacy_decode(packet))
+        new = bench("  bulk decode (array)", bulk_decode)
+        bench("  bulk decode + .registers list", bulk_decode_list)
+        print(f"  decode speedup {old / new:17.1f}x")
+        old = bench("  legacy encode", lambda: legacy_encode(values))
+        new = bench("  bulk encode", AvcReadHoldingRegistersResponse(values).encode)
+        print(f"  encode speedup {old / new:17.1f}x")
+
+
+if __name__ == "__main__":
+    main()
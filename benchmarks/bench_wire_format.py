@@ -0,0 +1,67 @@
+"""Compare the JSON and binary uplink encodings of a full snapshot.
+
+Run from the repository root::
+
+    python benchmarks/bench_wire_format.py
+"""
+import json
+import os
+import random
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wire_format  # noqa: E402
+
+
+def make_snapshot(devices=1, machines=56, storages=7):
+    """Build a snapshot with the same layout as forwarder.encode_data."""
+    rng = random.Random(0)
+    snapshot = {}
+    for slave in range(1, devices + 1):
+        data = {}
+        for i in range(machines):
+            data["machine" + str(i)] = {
+                "0x10": [rng.random() < 0.1 for _ in range(8 * 16)],
+                "0x30": [rng.randrange(0x10000) for _ in range(285)],
+            }
+        for i in range(storages):
+            data["storage" + str(i)] = {
+                "0x10": [rng.random() < 0.1 for _ in range(11 * 16)],
+                "0x30": [rng.randrange(0x10000) for _ in range(43)],
+            }
+        data["monitor"] = {"0x10": [rng.random() < 0.1 for _ in range(12 * 16)]}
+        snapshot["slave" + str(slave)] = data
+    return snapshot
+
+
+def bench(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:<24} {seconds * 1000:8.3f} ms")
+    return seconds
+
+
+def main():
+    snapshot = make_snapshot()
+    timestamp = time.time()
+    json_payload = (json.dumps(snapshot) + "\n").encode("utf-8")
+    binary_payload = wire_format.encode_snapshot(snapshot, timestamp)
+    frames, _ = wire_format.decode_stream(binary_payload)
+    assert frames[0][1] == snapshot["slave1"], "binary round trip mismatch"
+
+    print(f"{'payload':<24} {'size':>11}")
+    print(f"{'json':<24} {len(json_payload):8d} B")
+    print(f"{'binary':<24} {len(binary_payload):8d} B  ({len(json_payload) / len(binary_payload):.1f}x smaller)")
+    print()
+    print(f"{'operation':<24} {'time':>11}")
+    json_encode = bench("json encode", lambda: (json.dumps(snapshot) + "\n").encode("utf-8"), 20)
+    binary_encode = bench("binary encode", lambda: wire_format.encode_snapshot(snapshot, timestamp), 20)
+    bench("json decode", lambda: json.loads(json_payload), 20)
+    bench("binary decode", lambda: wire_format.decode_stream(binary_payload), 20)
+    print(f"binary encode speedup    {json_encode / binary_encode:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Simulated AVC PLCs for the benchmarks.
+
+Every simulator is a pymodbus TCP server over a sequential datastore.
+Reads are answered by the repo's own Avc*Request.execute(), so the
+benchmarks exercise the same PDUs, codec and framing as production.
+Each simulator adds a configurable latency with jitter and fails a
+fraction of the requests, either with a Modbus exception (the PLC is
+busy) or by not answering at all (the client times out).
+
+Simulators listen on consecutive loopback addresses (127.0.0.2,
+127.0.0.3, ...) and the same port, because the gateway addresses
+devices by ip only.
+"""
+
+__all__ = [
+    "SimulatedSlaveContext",
+    "run_fleet",
+    "start_fleet",
+]
+
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusServerContext, ModbusSlaveContext
+from pymodbus.exceptions import NoSuchSlaveException
+from pymodbus.pdu import ModbusExceptions as merror
+from pymodbus.server import ModbusTcpServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from avc_bit_read_message import AvcReadDiscreteInputsRequest  # noqa: E402
+from avc_register_read_message import AvcReadHoldingRegistersRequest  # noqa: E402
+
+#: Datastore size, enough for every block the forwarders read
+POINTS = 1024
+
+
+class SimulatedSlaveContext(ModbusSlaveContext):
+    """A datastore that is slow and unreliable on purpose."""
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, drop_rate=0.0, seed=None, answered=None):
+        """Initialize a new instance.
+
+        :param latency: Mean response delay, in seconds
+        :param jitter: Max deviation from the mean delay, in seconds
+        :param failure_rate: Fraction of requests answered with a SlaveBusy exception
+        :param drop_rate: Fraction of requests left unanswered
+        :param seed: Seed of the random generator, for repeatable runs
+        :param answered: Shared multiprocessing.Value counting the answered requests
+        """
+        rng = random.Random(seed)
+        super().__init__(
+            di=ModbusSequentialDataBlock(0, [rng.random() < 0.5 for _ in range(POINTS)]),
+            hr=ModbusSequentialDataBlock(0, [rng.randrange(0x10000) for _ in range(POINTS)]),
+        )
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.random = rng
+        self.answered = answered
+
+    async def simulate(self):
+        """Wait like a real PLC would and decide how the request ends.
+
+        :returns: True if the request should fail with an exception response
+        :raises NoSuchSlaveException: if the request must not be answered
+        """
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        roll = self.random.random()
+        if roll < self.drop_rate:
+            # with ignore_missing_slaves the server sends nothing back
+            raise NoSuchSlaveException("request dropped")
+        if self.answered is not None:
+            with self.answered.get_lock():
+                self.answered.value += 1
+        return roll < self.drop_rate + self.failure_rate
+
+
+class _SimulatedRequest:
+    async def execute(self, context):
+        if await context.simulate():
+            return self.doException(merror.SlaveBusy)
+        return super().execute(context)
+
+
+class SimulatedDiscreteInputsRequest(_SimulatedRequest, AvcReadDiscreteInputsRequest):
+    pass
+
+
+class SimulatedHoldingRegistersRequest(_SimulatedRequest, AvcReadHoldingRegistersRequest):
+    pass
+
+
+def address(index):
+    """Return the loopback ip of the index-th simulator."""
+    return f"127.0.{(index + 2) // 256}.{(index + 2) % 256}"
+
+
+async def run_fleet(count, port, ready=None, answered=None, **profile):
+    """Serve count simulators until cancelled.
+
+    :param count: The number of simulators
+    :param port: The TCP port of every simulator
+    :param ready: Event set once every simulator listens
+    :param answered: Shared multiprocessing.Value counting the answered requests
+    :param profile: SimulatedSlaveContext parameters
+    """
+    servers = []
+    for index in range(count):
+        context = ModbusServerContext(slaves=SimulatedSlaveContext(seed=index, answered=answered, **profile), single=True)
+        server = ModbusTcpServer(context, address=(address(index), port), ignore_missing_slaves=True)
+        server.decoder.register(SimulatedDiscreteInputsRequest)
+        server.decoder.register(SimulatedHoldingRegistersRequest)
+        await server.listen()
+        servers.append(server)
+    if ready is not None:
+        ready.set()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for server in servers:
+            await server.shutdown()
+
+
+def _fleet_main(count, port, ready, answered, profile):
+    asyncio.run(run_fleet(count, port, ready, answered, **profile))
+
+
+def start_fleet(count, port=5502, **profile):
+    """Start count simulators in a child process, so they do not add to the measured CPU.
+
+    :returns: (process, device entries like config.json "devices", answered request counter)
+    """
+    ready = multiprocessing.Event()
+    answered = multiprocessing.Value("Q", 0)
+    process = multiprocessing.Process(target=_fleet_main, args=(count, port, ready, answered, profile), daemon=True)
+    process.start()
+    if not ready.wait(30):
+        process.terminate()
+        raise RuntimeError("simulators did not start")
+    devices = [{"ip": address(index), "port": port, "slave": 1} for index in range(count)]
+    return process, devices, answered
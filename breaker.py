@@ -0,0 +1,158 @@
+"""Per-device circuit breakers for the poll loops.
+
+A breaker is closed while its device answers. After `failure_threshold`
+consecutive failed reads or connects it opens, and polls skip the device
+at once instead of waiting out a timeout per read. Every `probe_interval`
+seconds one probe is allowed through (half-open): if it succeeds the
+breaker closes again, otherwise it stays open for another interval.
+"""
+
+__all__ = [
+    "CLOSED",
+    "HALF_OPEN",
+    "OPEN",
+    "CircuitBreaker",
+    "CircuitBreakers",
+]
+
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """Closed/open/half-open state of one device."""
+
+    def __init__(self, key, failure_threshold=3, probe_interval=10, on_change=None):
+        """Initialize a new instance.
+
+        :param key: The device key ("ip:port")
+        :param failure_threshold: Consecutive failures that open the breaker
+        :param probe_interval: Seconds between probes while open
+        :param on_change: Callable(breaker, old state, new state)
+        """
+        self.key = key
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.changed_at = time.time()
+        self.opens = 0
+        self.skipped = 0
+
+    def _set_state(self, state):
+        # called with the lock held, returns the callback to run after releasing it
+        old = self.state
+        if old == state:
+            return None
+        self.state = state
+        self.changed_at = time.time()
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+            self.opens += 1
+        if self.on_change is None:
+            return None
+        return lambda: self.on_change(self, old, state)
+
+    def _notify(self, callback):
+        if callback is not None:
+            callback()
+
+    def allow(self):
+        """Return True if the device may be polled now; counts a skip otherwise."""
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            self.skipped += 1
+            return False
+
+    def try_probe(self):
+        """Switch an open breaker to half-open once its probe is due.
+
+        :returns: True if the caller should run the probe now
+        """
+        with self.lock:
+            if self.state != OPEN or time.monotonic() < self.opened_at + self.probe_interval:
+                return False
+            callback = self._set_state(HALF_OPEN)
+        self._notify(callback)
+        return True
+
+    def is_open(self):
+        """Return True while reads should fail fast."""
+        return self.state == OPEN
+
+    def success(self):
+        """Record a successful read or probe."""
+        with self.lock:
+            self.failures = 0
+            callback = self._set_state(CLOSED)
+        self._notify(callback)
+
+    def failure(self):
+        """Record a failed read, connect or probe."""
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                callback = self._set_state(OPEN)
+            elif self.state == OPEN:
+                # 失败发生在熔断之前已发出的请求上，重新计时
+                self.opened_at = time.monotonic()
+                callback = None
+            else:
+                callback = None
+        self._notify(callback)
+
+    def stats(self):
+        """Return the breaker state and counters as a dict."""
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opens": self.opens,
+            "skipped": self.skipped,
+            "since": self.changed_at,
+        }
+
+
+class CircuitBreakers:
+    """The breakers of all devices, keyed by "ip:port"."""
+
+    def __init__(self, failure_threshold=3, probe_interval=10, on_change=None):
+        """Initialize a new instance.
+
+        :param failure_threshold: Consecutive failures that open a breaker
+        :param probe_interval: Seconds between probes while open
+        :param on_change: Callable(breaker, old state, new state)
+        """
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.on_change = on_change
+        self.breakers = {}
+
+    def get(self, key):
+        """Return the breaker of a device, creating it closed.
+
+        :param key: The device key ("ip:port")
+        """
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(key, self.failure_threshold, self.probe_interval, self.on_change)
+            self.breakers[key] = breaker
+        return breaker
+
+    def remove(self, key):
+        """Forget the breaker of a device that is no longer polled.
+
+        :param key: The device key ("ip:port")
+        """
+        self.breakers.pop(key, None)
+
+    def stats(self):
+        """Return the state of every breaker, keyed by "ip:port"."""
+        return {key: breaker.stats() for key, breaker in list(self.breakers.items())}
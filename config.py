@@ -1,21 +1,38 @@
+import os
 import sys
 import logging
 import socket
 import time
 import json
+import threading
 
-from flask import Flask, render_template, request
+from flask import Flask, Response, render_template, request
+
+from historian import HistoryReader
+from live_feed import DEFAULT_PATH, DEFAULT_QUEUE_SIZE, FeedClient, SnapshotHub
+import log_pipeline
+import metrics
 app = Flask(__name__)
 
 # 默认的配置文件路径
 CONFIG_FILE = 'config.json'
 
+# 转发服务写出的运行状态（设备熔断器等）
+STATUS_FILE = 'status.json'
+
 # 初始默认配置
 config_data = {
     "deviceIP": "192.168.1.100",
     "cloudIP": "192.168.1.101"
 }
 
+# 实时数据推送，第一个订阅者到来时才连接转发服务；runtime.py 中直接赋值
+live_hub = None
+live_lock = threading.Lock()
+
+# 没有数据时发送注释行的间隔（秒），用于发现已断开的客户端
+KEEPALIVE_INTERVAL = 15
+
 def load_config():
     try:
         with open(CONFIG_FILE, 'r') as file:
@@ -25,8 +42,17 @@ def load_config():
         return config_data
 
 def save_config(config):
-    with open(CONFIG_FILE, 'w') as file:
+    # 先写临时文件再替换，转发和网关监视 config.json 时不会读到写了一半的文件
+    with open(CONFIG_FILE + '.tmp', 'w') as file:
         json.dump(config, file)
+    os.replace(CONFIG_FILE + '.tmp', CONFIG_FILE)
+
+def load_status():
+    try:
+        with open(STATUS_FILE, 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
 
 @app.route('/')
 def index():
@@ -42,7 +68,81 @@ def config():
 
 @app.route('/status', methods=['GET'])
 def status():
-    return json.dumps(config_data)
+    data = dict(config_data)
+    data.update(load_status())
+    return json.dumps(data)
+
+
+@app.route('/history', methods=['GET'])
+def history():
+    # /history?device=slave1&block=monitor/0x10&index=3&from=&to=&step=
+    args = request.args
+    try:
+        device = args['device']
+        block = args['block']
+        index = int(args.get('index', 0))
+        end = float(args.get('to', time.time()))
+        start = float(args.get('from', end - 3600))
+        step = float(args.get('step', 0))
+    except (KeyError, ValueError):
+        return json.dumps({"error": "invalid params"}), 400
+    if index < 0 or step < 0:
+        return json.dumps({"error": "invalid params"}), 400
+    reader = HistoryReader(config_data.get("history", {}).get("path", "history"))
+    points = reader.query(device, block, index, start, end, step)
+    return json.dumps({"device": device, "block": block, "index": index, "step": step, "points": points})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_text():
+    # 合并转发、网关等各服务写出的指标，Prometheus 文本格式
+    text = metrics.render_directory(config_data.get("metrics", {}).get("path", "metrics"))
+    return text, 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+def get_live_hub():
+    global live_hub
+    with live_lock:
+        if live_hub is None:
+            options = config_data.get("live", {})
+            live_hub = SnapshotHub(options.get("queueSize", DEFAULT_QUEUE_SIZE))
+            FeedClient(options.get("path", DEFAULT_PATH), live_hub).start()
+        return live_hub
+
+
+def split_arg(value):
+    return [item for item in value.split(",") if item] if value else []
+
+
+@app.route('/stream', methods=['GET'])
+def stream():
+    # /stream?device=slave1&block=monitor/0x10&start=0&end=16，Server-Sent Events
+    args = request.args
+    try:
+        start = int(args.get('start', 0))
+        end = int(args['end']) if args.get('end') else None
+    except ValueError:
+        return json.dumps({"error": "invalid params"}), 400
+    if start < 0 or (end is not None and end < start):
+        return json.dumps({"error": "invalid params"}), 400
+    hub = get_live_hub()
+    subscription = hub.subscribe(split_arg(args.get('device')), split_arg(args.get('block')), start, end)
+
+    def events():
+        try:
+            while True:
+                event = subscription.next(KEEPALIVE_INTERVAL)
+                if event is not None:
+                    yield event
+                elif subscription.closed:
+                    return
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            hub.unsubscribe(subscription)
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.route('/restart', methods=['GET'])
@@ -51,5 +151,6 @@ def restart():
 
 if __name__ == "__main__":
     config_data = load_config()
+    log_pipeline.setup(config_data, "app")
     app.run(debug=True)
 
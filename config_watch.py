@@ -0,0 +1,164 @@
+"""Watch config.json and hand every change to the running service.
+
+On Linux the watcher uses inotify on the config directory, so a change
+is seen as soon as the writer closes the file or renames a new one over
+it. Elsewhere, or if inotify is unavailable, it polls the file's mtime.
+A file that does not parse is ignored until the next write; the service
+keeps running on the previous config.
+
+The services reconcile incrementally: see forwarder.reconcile() and
+gateway.Gateway.reconcile().
+"""
+
+__all__ = [
+    "ConfigWatcher",
+    "diff_devices",
+]
+
+import asyncio
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+# struct inotify_event: wd, mask, cookie, len, 后跟 len 字节的文件名
+EVENT = struct.Struct("iIII")
+
+#: Seconds between two checks when polling the mtime
+POLL_INTERVAL = 2
+
+#: Seconds to wait for more events before reading the file
+DEBOUNCE = 0.2
+
+
+def device_id(device):
+    """Return a key identifying a device entry with all its settings."""
+    return json.dumps(device, sort_keys=True)
+
+
+def diff_devices(old, new):
+    """Compare two device lists.
+
+    An entry whose settings changed (e.g. its timeout) counts as removed
+    and added again, so only that device reconnects.
+
+    :returns: (added, removed) lists of device entries
+    """
+    old_ids = {device_id(device) for device in old}
+    new_ids = {device_id(device) for device in new}
+    added = [device for device in new if device_id(device) not in old_ids]
+    removed = [device for device in old if device_id(device) not in new_ids]
+    return added, removed
+
+
+def _inotify(directory):
+    # 返回 inotify 文件描述符，不可用时返回 None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError, TypeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class ConfigWatcher:
+    """Call a function with the new config whenever config.json changes."""
+
+    def __init__(self, path, on_change, current=None, interval=POLL_INTERVAL):
+        """Initialize a new instance.
+
+        :param path: The config file
+        :param on_change: Callable(new config), called in the event loop
+        :param current: The config the service started with
+        :param interval: Seconds between checks when polling
+        """
+        self.path = os.path.abspath(path)
+        self.on_change = on_change
+        self.current = current
+        self.interval = interval
+        self.changes = 0
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def check(self):
+        """Reload the file and call on_change if its content changed."""
+        try:
+            with open(self.path, "r") as file:
+                config = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            logger.warning(f"Ignoring {self.path}: {exc}")
+            return
+        if config == self.current:
+            return
+        self.current = config
+        self.changes += 1
+        logger.info(f"{self.path} changed, reconciling")
+        try:
+            self.on_change(config)
+        except Exception as exc:
+            logger.error(f"Applying {self.path} failed: {exc}")
+
+    async def run(self):
+        """Watch until cancelled."""
+        fd = _inotify(os.path.dirname(self.path))
+        if fd is None:
+            logger.info(f"inotify unavailable, polling {self.path} every {self.interval}s")
+            await self._poll()
+            return
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        name = os.path.basename(self.path).encode()
+
+        def on_events():
+            try:
+                data = os.read(fd, 4096)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset + EVENT.size <= len(data):
+                _, _, _, length = EVENT.unpack_from(data, offset)
+                event_name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+                offset += EVENT.size + length
+                if event_name == name:
+                    changed.set()
+
+        loop.add_reader(fd, on_events)
+        try:
+            while True:
+                await changed.wait()
+                # 编辑器常常连续写几次，等写完再读
+                await asyncio.sleep(DEBOUNCE)
+                changed.clear()
+                self.check()
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+
+    async def _poll(self):
+        stamp = self._stamp()
+        while True:
+            await asyncio.sleep(self.interval)
+            new_stamp = self._stamp()
+            if new_stamp != stamp:
+                stamp = new_stamp
+                self.check()
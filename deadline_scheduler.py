@@ -0,0 +1,170 @@
+"""Drift-free periodic jobs on absolute deadlines.
+
+A job's n-th run is due at start + n * period, no matter how long the
+previous runs took, so the period does not stretch by the work time.
+A run that overruns its period does not queue the deadlines it missed:
+they are skipped and counted, and the job resumes on the next deadline
+still ahead. Every job reports its jitter (how late a run started) and
+overruns.
+
+Jobs can be added, removed or given a new period while the scheduler
+runs, e.g. when config.json changes; the other jobs keep their deadlines.
+"""
+
+__all__ = [
+    "DeadlineScheduler",
+]
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    def __init__(self, name, period, func):
+        self.name = name
+        self.period = period
+        self.func = func
+        self.deadline = 0.0
+        self.runs = 0
+        self.skipped = 0
+        self.overruns = 0
+        self.errors = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.duration_max = 0.0
+
+    def begin(self, now):
+        jitter = max(0.0, now - self.deadline)
+        self.runs += 1
+        self.jitter_total += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+
+    def end(self, started, now):
+        self.duration_max = max(self.duration_max, now - started)
+        self.deadline += self.period
+        if now >= self.deadline:
+            # 错过的周期直接跳过，不排队补跑
+            missed = int((now - self.deadline) // self.period) + 1
+            self.deadline += missed * self.period
+            self.skipped += missed
+            self.overruns += 1
+
+    def stats(self):
+        return {
+            "period": self.period,
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "overruns": self.overruns,
+            "errors": self.errors,
+            "jitterAvg": self.jitter_total / self.runs if self.runs else 0.0,
+            "jitterMax": self.jitter_max,
+            "durationMax": self.duration_max,
+        }
+
+
+class DeadlineScheduler:
+    """Run named jobs each at its own fixed period."""
+
+    def __init__(self, clock=time.monotonic):
+        """Initialize a new instance.
+
+        :param clock: Monotonic clock returning seconds
+        """
+        self.clock = clock
+        self.jobs = {}
+        self.tasks = {}
+        self.running = False
+
+    def add(self, name, period, func):
+        """Add a periodic job; a job added while running starts at once.
+
+        :param name: The job name, used in the stats
+        :param period: Seconds between the start of two runs
+        :param func: The function to run; a coroutine function with run_async()
+        """
+        if period <= 0:
+            raise ValueError(f"Period of {name} must be positive")
+        self.remove(name)
+        job = _Job(name, period, func)
+        job.deadline = self.clock()
+        self.jobs[name] = job
+        if self.running and self.tasks is not None:
+            self.tasks[name] = asyncio.ensure_future(self._run_job(job))
+
+    def remove(self, name):
+        """Stop and forget a job, if it exists."""
+        self.jobs.pop(name, None)
+        task = self.tasks.pop(name, None) if self.tasks is not None else None
+        if task is not None:
+            task.cancel()
+
+    def set_period(self, name, period):
+        """Change the period of a job, effective from its next deadline."""
+        if period <= 0:
+            raise ValueError(f"Period of {name} must be positive")
+        self.jobs[name].period = period
+
+    def _start(self):
+        now = self.clock()
+        for job in self.jobs.values():
+            job.deadline = now
+
+    async def _run_job(self, job):
+        while True:
+            delay = job.deadline - self.clock()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            started = self.clock()
+            job.begin(started)
+            try:
+                await job.func()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                job.errors += 1
+                logger.error(f"Job {job.name} failed: {exc}")
+            job.end(started, self.clock())
+
+    async def run_async(self):
+        """Run every job as its own task until cancelled."""
+        self._start()
+        self.tasks = {name: asyncio.ensure_future(self._run_job(job)) for name, job in self.jobs.items()}
+        self.running = True
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.running = False
+            for task in self.tasks.values():
+                task.cancel()
+            self.tasks = {}
+
+    def run(self):
+        """Run the jobs in this thread, earliest deadline first, forever.
+
+        Jobs share the thread, so a long run delays the others; that
+        shows up as their jitter.
+        """
+        self._start()
+        # 同步模式下没有任务，add/remove 只改动 jobs
+        self.tasks = None
+        self.running = True
+        while True:
+            job = min(self.jobs.values(), key=lambda job: job.deadline)
+            delay = job.deadline - self.clock()
+            if delay > 0:
+                time.sleep(delay)
+            started = self.clock()
+            job.begin(started)
+            try:
+                job.func()
+            except Exception as exc:
+                job.errors += 1
+                logger.error(f"Job {job.name} failed: {exc}")
+            job.end(started, self.clock())
+
+    def stats(self):
+        """Return the timing counters per job."""
+        return {name: job.stats() for name, job in self.jobs.items()}
@@ -0,0 +1,229 @@
+"""Change-only (delta) encoding of poll snapshots for the cloud uplink.
+
+Every device gets its own message stream with increasing sequence numbers:
+
+* {"type": "key", "device", "seq", "ts", "data"} carries the full device data.
+* {"type": "delta", "device", "seq", "base", "ts", "set", "put"} carries only
+  what changed since the snapshot with sequence number "base": "set" maps
+  group/key to [[index, value], ...] pairs, "put" maps group/key to a whole
+  new value when a block changed length or failed.
+
+A delta is always computed against the last snapshot the uplink actually
+sent (acknowledged), and a keyframe is forced every `keyframe_interval`
+messages so a receiver can resync. A message stored in the uplink's disk
+ring during an outage is never acknowledged; resync() then forces the
+next message to be a keyframe. An encoder replacing another one, e.g. in
+a restarted shard worker, resume()s its sequence numbers, so the receiver
+sees a keyframe continuing the stream rather than a stream starting over.
+DeltaDecoder is the reference receiver.
+"""
+
+__all__ = [
+    "DeltaDecoder",
+    "DeltaEncoder",
+]
+
+import threading
+import time
+
+
+def _same_layout(old, new):
+    if not isinstance(old, dict) or not isinstance(new, dict) or old.keys() != new.keys():
+        return False
+    for group, blocks in new.items():
+        if not isinstance(blocks, dict) or not isinstance(old[group], dict):
+            return False
+        if blocks.keys() != old[group].keys():
+            return False
+    return True
+
+
+def diff(old, new):
+    """Return the ("set", "put") sections turning old into new.
+
+    Both must have the same group/key layout.
+    """
+    changes = {}
+    puts = {}
+    for group, blocks in new.items():
+        for key, values in blocks.items():
+            previous = old[group][key]
+            if isinstance(values, list) and isinstance(previous, list) and len(values) == len(previous):
+                pairs = [[i, v] for i, (p, v) in enumerate(zip(previous, values)) if p != v]
+                if pairs:
+                    changes.setdefault(group, {})[key] = pairs
+            elif values != previous:
+                puts.setdefault(group, {})[key] = values
+    return changes, puts
+
+
+class _DeviceStream:
+    def __init__(self):
+        self.seq = 0
+        self.base = None
+        self.base_seq = 0
+        self.pending = {}
+        self.since_keyframe = 0
+
+
+class DeltaEncoder:
+    """Turn full snapshots into per-device keyframe/delta messages."""
+
+    def __init__(self, keyframe_interval=12, window=64):
+        """Initialize a new instance.
+
+        :param keyframe_interval: Send a full keyframe at least every N messages
+        :param window: Max number of unacknowledged snapshots kept per device
+        """
+        self.keyframe_interval = keyframe_interval
+        self.window = window
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.keyframes = 0
+        self.deltas = 0
+
+    def encode(self, snapshot):
+        """Encode a {"slaveN": {...}} snapshot.
+
+        :param snapshot: The poll snapshot
+        :returns: One message dict per device
+        """
+        timestamp = time.time()
+        return [self.encode_device(device, data, timestamp) for device, data in snapshot.items()]
+
+    def encode_device(self, device, data, timestamp):
+        """Encode the data of one device.
+
+        :param device: The device name, e.g. "slave1"
+        :param data: The device data
+        :param timestamp: The poll time, in seconds since the epoch
+        :returns: A keyframe or delta message dict
+        """
+        with self.lock:
+            stream = self.streams.setdefault(device, _DeviceStream())
+            stream.seq += 1
+            message = {"device": device, "seq": stream.seq, "ts": timestamp}
+            if (stream.base is None
+                    or stream.since_keyframe >= self.keyframe_interval
+                    or not _same_layout(stream.base, data)):
+                message["type"] = "key"
+                message["data"] = data
+                stream.since_keyframe = 0
+                self.keyframes += 1
+            else:
+                changes, puts = diff(stream.base, data)
+                message["type"] = "delta"
+                message["base"] = stream.base_seq
+                message["set"] = changes
+                message["put"] = puts
+                stream.since_keyframe += 1
+                self.deltas += 1
+            stream.pending[stream.seq] = data
+            while len(stream.pending) > self.window:
+                del stream.pending[min(stream.pending)]
+            return message
+
+    def ack(self, device, seq):
+        """Mark a message as sent, making its snapshot the new delta base.
+
+        :param device: The device name of the message
+        :param seq: The sequence number of the message
+        """
+        with self.lock:
+            stream = self.streams.get(device)
+            if stream is None or seq <= stream.base_seq:
+                return
+            data = stream.pending.get(seq)
+            if data is None:
+                return
+            stream.base = data
+            stream.base_seq = seq
+            for old in [s for s in stream.pending if s <= seq]:
+                del stream.pending[old]
+
+    def resume(self, device, seq):
+        """Continue a device stream of a previous encoder.
+
+        The next message of the device is a keyframe numbered seq + 1.
+
+        :param device: The device name
+        :param seq: The last sequence number the previous encoder sent
+        """
+        with self.lock:
+            stream = self.streams.setdefault(device, _DeviceStream())
+            stream.seq = max(stream.seq, seq)
+            stream.base = None
+            stream.base_seq = stream.seq
+            stream.pending.clear()
+
+    def resync(self, device, seq):
+        """Force a keyframe after a message that will not reach the cloud in order.
+
+        Called when a message went to the uplink's disk ring: its on_sent
+        never comes, and the receiver may get it long after newer ones, so
+        the next message of the device must not depend on it.
+
+        :param device: The device name of the message
+        :param seq: The sequence number of the message
+        """
+        with self.lock:
+            stream = self.streams.get(device)
+            if stream is None:
+                return
+            stream.base = None
+            stream.base_seq = max(stream.base_seq, seq)
+            for old in [s for s in stream.pending if s <= seq]:
+                del stream.pending[old]
+
+    def stats(self):
+        """Return the encoder counters as a dict."""
+        return {"keyframes": self.keyframes, "deltas": self.deltas}
+
+
+class DeltaDecoder:
+    """Reference receiver rebuilding the full device data from the message stream."""
+
+    def __init__(self, history=16):
+        """Initialize a new instance.
+
+        :param history: Number of past states kept per device to resolve delta bases
+        """
+        self.history = history
+        self.states = {}
+        self.last_seq = {}
+        self.gaps = 0
+        self.unresolved = 0
+
+    def apply(self, message):
+        """Apply one message.
+
+        :param message: A keyframe or delta message dict
+        :returns: The full device data, or None until the next keyframe if the base is unknown
+        """
+        device = message["device"]
+        seq = message["seq"]
+        states = self.states.setdefault(device, {})
+        last = self.last_seq.get(device)
+        if last is not None and seq != last + 1:
+            self.gaps += 1
+        self.last_seq[device] = seq
+        if message["type"] == "key":
+            data = message["data"]
+        else:
+            base = states.get(message["base"])
+            if base is None:
+                self.unresolved += 1
+                return None
+            data = {group: dict(blocks) for group, blocks in base.items()}
+            for group, blocks in message["set"].items():
+                for key, pairs in blocks.items():
+                    values = list(data[group][key])
+                    for index, value in pairs:
+                        values[index] = value
+                    data[group][key] = values
+            for group, blocks in message["put"].items():
+                data[group].update(blocks)
+        states[seq] = data
+        while len(states) > self.history:
+            del states[min(states)]
+        return data
@@ -1,4 +1,6 @@
 import sys
+import functools
+import asyncio
 import logging
 import socket
 import time
@@ -9,38 +11,77 @@ from pymodbus import (
     ExceptionResponse,
     Framer,
     ModbusException,
-    pymodbus_apply_logging_config,
 )
 # from pymodbus.client.sync import ModbusTcpClient
 # from pymodbus.exceptions import ModbusIOException, ConnectionException
+from pymodbus.exceptions import ConnectionException, ModbusIOException
 from avc_bit_read_message import AvcReadDiscreteInputsResponse, AvcReadDiscreteInputsRequest
 from avc_register_read_message import AvcReadHoldingRegistersResponse, AvcReadHoldingRegistersRequest
+from modbus_pool import ModbusConnectionPool, device_key
+from read_plan import BITS, REGISTERS
+from breaker import CircuitBreakers
+from metrics import REGISTRY
+import wire_format
+from deadline_scheduler import DeadlineScheduler
+from delta import DeltaEncoder
+from historian import DEFAULT_FLUSH_SECONDS, Historian, HistoryWriter, open_series_limit
+from ring_buffer import RingBuffer
+from uplink import CloudUplink, DROP_OLDEST, ring_slot_size
+import config_watch
+import live_feed
+import log_pipeline
+import traffic_trace
 
-pymodbus_apply_logging_config("DEBUG")
+# 日志经 log_pipeline 的队列异步输出，各类别的等级在 config.json 的 "logging" 中配置
+logger = logging.getLogger("forwarder")
 
-# 设置日志记录器的名称
-logger = logging.getLogger(__name__)
+is_mocking = False
 
-# 设置日志记录器的等级
-logger.setLevel(logging.DEBUG)  # 或者其他等级，如 logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL
+# 每个设备同时进行中的请求数上限
+DEFAULT_DEVICE_CONCURRENCY = 4
 
-# 创建一个日志处理器（例如，输出到控制台）
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)  # 设置处理器的等级
+# 单个请求的超时时间（秒）
+DEFAULT_DEVICE_TIMEOUT = 3
 
-# 创建一个格式化程序
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)  # 应用格式化程序到处理器
+# 熔断器状态文件，供配置页面的 /status 读取
+STATUS_FILE = 'status.json'
 
-# 将处理器添加到记录器
-logger.addHandler(console_handler)
+CONFIG_FILE = 'config.json'
 
-is_mocking = False
+# 修改后需要重启才能生效的配置项，其余（devices、schedule）运行中直接应用
+RESTART_KEYS = ("pool", "uplink", "history", "breaker", "metrics", "trace", "logging", "live")
+
+# 各数据块的轮询周期与上送周期（秒），machine/storage 默认不轮询，在 config.json 的 "schedule" 中配置周期即可启用
+DEFAULT_SCHEDULE = {
+    "monitor": 0.5,
+    "forward": 5,
+}
+
+GROUPS = ("machine", "storage", "monitor")
+
+# 进行中的后台探测任务
+probes = set()
+
+# 运行指标，每个上送周期写入 metrics 目录，由配置页面的 /metrics 输出
+READ_SECONDS = REGISTRY.histogram("s2c2s_read_seconds", "Latency of one Modbus read request", ("device", "block"))
+READ_ERRORS = REGISTRY.counter("s2c2s_read_errors_total", "Failed Modbus reads by reason", ("device", "block", "reason"))
+READ_BYTES = REGISTRY.counter("s2c2s_read_bytes_total", "Payload bytes read from devices", ("device",))
+POLL_SECONDS = REGISTRY.histogram("s2c2s_poll_seconds", "Time to poll one block group of a device", ("device", "group"))
+POLL_SKIPPED = REGISTRY.counter("s2c2s_poll_skipped_total", "Polls skipped by an open breaker", ("device",))
+FORWARD_SECONDS = REGISTRY.histogram("s2c2s_forward_seconds", "Time to encode and queue one snapshot")
+UPLINK_BYTES = REGISTRY.counter("s2c2s_uplink_bytes_total", "Bytes queued for the cloud uplink")
+SCHEDULE_OVERRUNS = REGISTRY.counter("s2c2s_schedule_overruns_total", "Poll or forward runs longer than their period", ("job",))
+SCHEDULE_SKIPPED = REGISTRY.counter("s2c2s_schedule_skipped_total", "Deadlines skipped after an overrun", ("job",))
+SCHEDULE_JITTER = REGISTRY.gauge("s2c2s_schedule_jitter_max_seconds", "Largest start delay of a job", ("job",))
+POOL_CONNECTS = REGISTRY.counter("s2c2s_pool_connects_total", "Connections opened to a device", ("device",))
+POOL_RECONNECTS = REGISTRY.counter("s2c2s_pool_reconnects_total", "Reconnects after a connection broke", ("device",))
+POOL_REUSES = REGISTRY.counter("s2c2s_pool_reuses_total", "Requests sent over an already open connection", ("device",))
+POOL_FAILURES = REGISTRY.counter("s2c2s_pool_failures_total", "Connections discarded as broken", ("device",))
 
     
 def load_config():
     try:
-        with open('config.json', 'r') as file:
+        with open(CONFIG_FILE, 'r') as file:
             data = json.load(file)
             return data
     except FileNotFoundError:
@@ -52,139 +93,537 @@ def save_data(data):
         json.dump(data, file)
 
 
-def connect_to_server(ip, port):
-    while True:
-        try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect((ip, port))
-            return client_socket
-        except Exception as e:
-            logger.error(f"Connection error: {e}")
-            logger.info("Retrying in 5 seconds...")
-            time.sleep(5)
+def save_status(breakers):
+    with open(STATUS_FILE, 'w') as file:
+        json.dump({"breakers": breakers.stats()}, file)
 
 
-def forward_data(data):
-    try:
-        client1_socket = connect_to_server('192.168.1.101', 500)
-        client1_socket.sendall(json.dumps(data).encode("utf-8"))
-        
-    except Exception as e:
-        logger.error("Error forwarding data to cloud server:", e)
+def create_breakers(config, on_change=None):
+    options = config.get("breaker", {})
 
+    def log_change(breaker, old, new):
+        logger.warning(f"Device {breaker.key} breaker {old} -> {new}")
+        save_status(breakers)
 
-def encode_machine_data(client, slave, index):
-    address = (index<<16) + 10
-    # 0x0010 ~ 0x0017, 8 x 1 words
-    d0x0010 = ""
-    if is_mocking:
-        d0x0010 = [False for i in range(8*16)]
-    else:
-        r0x0010 = client.read_discrete_inputs(address=10, count=8*16, unit=slave)
-        if r0x0010.isError():
-            logger.error(f"Poll machine[{index}](0x0010) error：{r0x0010}")
-        else:
-            d0x0010 = r0x0010.bits
+    breakers = CircuitBreakers(
+        failure_threshold=options.get("failureThreshold", 3),
+        probe_interval=options.get("probeInterval", 10),
+        on_change=on_change or log_change,
+    )
+    return breakers
 
-    # 0x0030 ~ 0x14c, 285 x 2 words
-    d0x0030 = ""
-    if is_mocking:
-        d0x0030 = [0 for i in range(285)]
+
+def group_template(group):
+    # 与 encode_*_data 读取的数量相同，位按 False、寄存器按 65535 取最长的 JSON
+    if group == "machine":
+        return {"machine" + str(i): {"0x10": [False] * (8*16), "0x30": [65535] * 285} for i in range(56)}
+    if group == "storage":
+        return {"storage" + str(i): {"0x10": [False] * (11*16), "0x30": [65535] * 43} for i in range(7)}
+    return {"monitor": {"0x10": [False] * (12*16)}}
+
+
+# 每个数据块是位还是寄存器，二进制帧按此编码，不按值的类型猜测
+BLOCK_KINDS = {(group, key): BITS if isinstance(values[0], bool) else REGISTERS
+               for name in GROUPS for group, blocks in group_template(name).items()
+               for key, values in blocks.items()}
+
+
+def max_message_size(config):
+    """Return the largest uplink message the enabled block groups can produce, in bytes."""
+    schedule = dict(DEFAULT_SCHEDULE, **config.get("schedule", {}))
+    template = {}
+    for group in GROUPS:
+        if schedule.get(group):
+            template.update(group_template(group))
+    # 增量模式每个设备一条消息，否则一条消息包含所有设备
+    size = len(json.dumps({"slave255": template})) + 128
+    if config.get("uplink", {}).get("encoding") == "delta":
+        return size
+    return size * max(1, len(config.get("devices", [])))
+
+
+def uplink_address(config):
+    return config.get("cloudIP", "192.168.1.101"), config.get("uplink", {}).get("port", 500)
+
+
+def create_uplink(config):
+    options = config.get("uplink", {})
+    ring = None
+    if "ring" in options:
+        # 断网期间的数据写入磁盘环形缓冲，恢复后限速补发
+        ring_options = options["ring"]
+        ring = RingBuffer(
+            ring_options.get("path", "uplink.ring"),
+            slots=ring_options.get("slots", 256),
+            slot_size=ring_options.get("slotSize") or ring_slot_size(max_message_size(config)),
+        )
+    host, port = uplink_address(config)
+    uplink = CloudUplink(
+        host=host,
+        port=port,
+        maxsize=options.get("queueSize", 16),
+        policy=options.get("policy", DROP_OLDEST),
+        ring=ring,
+        replay_rate=options.get("ring", {}).get("replayRate", 2),
+    )
+    uplink.start()
+    return uplink
+
+
+def create_encoder(config):
+    options = config.get("uplink", {})
+    if options.get("encoding") != "delta":
+        return None
+    return DeltaEncoder(keyframe_interval=options.get("keyframeInterval", 12))
+
+
+def create_historian(config):
+    if "history" not in config:
+        return None
+    # 本地历史库，断网时现场也能查询历史数据
+    options = config["history"]
+    historian = Historian(
+        options.get("path", "history"),
+        segment_seconds=options.get("segmentSeconds", 3600),
+        retention_days=options.get("retentionDays", 7),
+        kinds=BLOCK_KINDS,
+        max_open=options.get("maxOpen") or open_series_limit(len(config.get("devices", [])) * len(BLOCK_KINDS)),
+        flush_seconds=options.get("flushSeconds", DEFAULT_FLUSH_SECONDS),
+    )
+    # 写盘在单独的线程中进行，不阻塞轮询
+    writer = HistoryWriter(historian)
+    writer.start()
+    return writer
+
+
+def forward_data(uplink, data, encoder=None, binary=False):
+    # 非阻塞：云端断开时只影响上行队列，不影响轮询
+    started = time.perf_counter()
+    tracer = traffic_trace.TRACER
+    if encoder is None:
+        if binary:
+            # 二进制帧：位按 8 个一字节打包，寄存器为大端 uint16
+            message = wire_format.encode_snapshot(data, time.time(), BLOCK_KINDS)
+        else:
+            message = (json.dumps(data) + "\n").encode("utf-8")
+        if not uplink.publish(message):
+            logger.warning("Uplink queue full, snapshot dropped")
+        UPLINK_BYTES.labels().inc(len(message))
+        if tracer is not None:
+            tracer.cloud_out(message)
     else:
-        r0x0030 = client.read_holding_registers(address=30, count=285, unit=slave)
-        if r0x0030.isError():
-            logger.error(f"Poll machine[{index}](0x0030) error：{r0x0030}")
+        # 增量模式：每个设备只发送变化的位/寄存器
+        for delta in encoder.encode(data):
+            message = (json.dumps(delta) + "\n").encode("utf-8")
+            on_sent = functools.partial(encoder.ack, delta["device"], delta["seq"])
+            # 转存到磁盘环形缓冲的消息不会回执，下一条改发关键帧
+            on_spilled = functools.partial(encoder.resync, delta["device"], delta["seq"])
+            if not uplink.publish(message, on_sent, on_spilled):
+                logger.warning(f"Uplink queue full, {delta['device']} #{delta['seq']} dropped")
+            UPLINK_BYTES.labels().inc(len(message))
+            if tracer is not None:
+                tracer.cloud_out(message)
+    FORWARD_SECONDS.labels().observe(time.perf_counter() - started)
+
+
+async def read_block(client, limiter, request, label, breaker=None):
+    """Execute one read request, bounded by the device's concurrency limit.
+
+    Returns the response, or None if the read failed or the device's
+    breaker opened while the request was waiting.
+    """
+    if breaker is not None and breaker.is_open():
+        return None
+    device = breaker.key if breaker is not None else ""
+    tracer = traffic_trace.TRACER
+    txn = None
+    try:
+        async with limiter:
+            if breaker is not None and breaker.is_open():
+                return None
+            started = time.perf_counter()
+            if tracer is not None:
+                txn = tracer.request(device, traffic_trace.encode_pdu(request.slave_id, request))
+            log_pipeline.dump_frame("out", device, lambda: traffic_trace.encode_pdu(request.slave_id, request))
+            response = await client.execute(request)
+    except Exception as exc:
+        if txn is not None:
+            tracer.no_response(device, txn, type(exc).__name__)
+        logger.error(f"Poll {label} error：{exc}")
+        if isinstance(exc, ConnectionException):
+            reason = "connection"
+        elif isinstance(exc, ModbusIOException):
+            reason = "timeout"
         else:
-            d0x0030 = r0x0030.registers
-    return { "0x10": d0x0010, "0x30": d0x0030 }
+            reason = "error"
+        READ_ERRORS.labels(device, label, reason).inc()
+        if breaker is not None:
+            breaker.failure()
+        return None
+    READ_SECONDS.labels(device, label).observe(time.perf_counter() - started)
+    if txn is not None:
+        tracer.response(device, txn, traffic_trace.encode_pdu(request.slave_id, response))
+    log_pipeline.dump_frame("in", device, lambda: traffic_trace.encode_pdu(request.slave_id, response))
+    if breaker is not None:
+        breaker.success()
+    if response.isError():
+        logger.error(f"Poll {label} error：{response}")
+        READ_ERRORS.labels(device, label, "exception").inc()
+        return None
+    READ_BYTES.labels(device).inc(response_size(response))
+    return response
+
+
+def response_size(response):
+    # 响应的数据字节数：寄存器 2 字节一个，位按 8 个一字节打包
+    if isinstance(response, AvcReadHoldingRegistersResponse):
+        return 2 * len(response.register_array)
+    if isinstance(response, AvcReadDiscreteInputsResponse):
+        return len(response.packed)
+    return 0
 
 
-def encode_storage_data(client, slave, index):
+async def encode_machine_data(client, limiter, slave, index, breaker=None):
     address = (index<<16) + 10
-    # 0x0010 ~ 0x0020, 11 x 1 words
-    d0x0010 = ""
     if is_mocking:
-        d0x0010 = [False for i in range(11*16)]
-    else:
-        r0x0010 = client.read_discrete_inputs(address=10, count=11*16, unit=slave)
-        if r0x0010.isError():
-            logger.error(f"Poll storage[{index}](0x0010) error：{r0x0010}")
-        else:
-            d0x0010 = r0x0010.bits
+        return { "0x10": [False for i in range(8*16)], "0x30": [0 for i in range(285)] }
+    r0x0010, r0x0030 = await asyncio.gather(
+        # 0x0010 ~ 0x0017, 8 x 1 words
+        read_block(client, limiter,
+                   AvcReadDiscreteInputsRequest(address=10, count=8*16, slave=slave),
+                   f"machine[{index}](0x0010)", breaker),
+        # 0x0030 ~ 0x14c, 285 x 2 words
+        read_block(client, limiter,
+                   AvcReadHoldingRegistersRequest(address=30, count=285, slave=slave),
+                   f"machine[{index}](0x0030)", breaker),
+    )
+    d0x0010 = r0x0010.bits if r0x0010 else ""
+    d0x0030 = r0x0030.registers if r0x0030 else ""
+    return { "0x10": d0x0010, "0x30": d0x0030 }
 
-    # 0x0030 ~ 0x005a, 43 x 2 words
-    d0x0030 = ""
+
+async def encode_storage_data(client, limiter, slave, index, breaker=None):
+    address = (index<<16) + 10
     if is_mocking:
-        d0x0010 = [0 for i in range(43)]
-    else:
-        r0x0030 = client.read_holding_registers(address=30, count=43, unit=slave)
-        if r0x0030.isError():
-            logger.error(f"Poll storage[{index}](0x0030) error：{r0x0030}")
-        else:
-            d0x0030 = r0x0030.registers
+        return { "0x10": [False for i in range(11*16)], "0x30": [0 for i in range(43)] }
+    r0x0010, r0x0030 = await asyncio.gather(
+        # 0x0010 ~ 0x0020, 11 x 1 words
+        read_block(client, limiter,
+                   AvcReadDiscreteInputsRequest(address=10, count=11*16, slave=slave),
+                   f"storage[{index}](0x0010)", breaker),
+        # 0x0030 ~ 0x005a, 43 x 2 words
+        read_block(client, limiter,
+                   AvcReadHoldingRegistersRequest(address=30, count=43, slave=slave),
+                   f"storage[{index}](0x0030)", breaker),
+    )
+    d0x0010 = r0x0010.bits if r0x0010 else ""
+    d0x0030 = r0x0030.registers if r0x0030 else ""
     return { "0x10": d0x0010, "0x30": d0x0030 }
 
 
-def encode_monitor_data(client, slave):
+async def encode_monitor_data(client, limiter, slave, breaker=None):
     address = (200<<16) + 10
-    # 0x0010 ~ 0x0018, 12 x 1 words
-    d0x0010 = ""
     if is_mocking:
-        d0x0010 = [0 for i in range(12*16)]
-    else:
-        try:
-            request = AvcReadDiscreteInputsRequest(address=10, count=12*16, unit=slave)
-            r0x0010 = client.execute(request)
-            # r0x0010 = client.read_discrete_inputs(address=address, count=12*16, unit=slave)
-            if r0x0010.isError():
-                logger.error(f"Poll monitor error：{r0x0010}")
-            else:
-                d0x0010 = r0x0010.bits
-        except Exception as ee:
-            logger.error(f"Poll monitor error:{ee}")
+        return { "0x10": [0 for i in range(12*16)] }
+    # 0x0010 ~ 0x0018, 12 x 1 words
+    r0x0010 = await read_block(client, limiter,
+                               AvcReadDiscreteInputsRequest(address=10, count=12*16, slave=slave),
+                               "monitor", breaker)
+    d0x0010 = r0x0010.bits if r0x0010 else ""
     return { "0x10": d0x0010 }
 
 
-def encode_data(client, slave):
-    data = {}
-    # for i in range(0, 56):
-    #     name = "machine" + str(i)
-    #     data[name] = encode_machine_data(client, slave, i)
-    # for i in range(101, 108):
-    #     name = "storage" + str(i - 101)
-    #     data[name] = encode_storage_data(client, slave, i)
-    data["monitor"] = encode_monitor_data(client, slave)
-    return data
+async def encode_data(client, limiter, slave, group, breaker=None):
+    jobs = {}
+    if group == "machine":
+        for i in range(0, 56):
+            name = "machine" + str(i)
+            jobs[name] = encode_machine_data(client, limiter, slave, i, breaker)
+    elif group == "storage":
+        for i in range(101, 108):
+            name = "storage" + str(i - 101)
+            jobs[name] = encode_storage_data(client, limiter, slave, i, breaker)
+    elif group == "monitor":
+        jobs["monitor"] = encode_monitor_data(client, limiter, slave, breaker)
+    results = await asyncio.gather(*jobs.values())
+    return dict(zip(jobs.keys(), results))
+
+
+async def probe_device(pool, device, breaker):
+    """Try a half-open device once; the read result closes or reopens its breaker."""
+    try:
+        connection = await pool.acquire(device)
+    except ConnectionError as exc:
+        logger.info(f"Probe {breaker.key} failed: {exc}")
+        breaker.failure()
+        return
+    response = await read_block(connection.client, connection.limiter,
+                                AvcReadDiscreteInputsRequest(address=10, count=12*16, slave=device["slave"]),
+                                f"probe {breaker.key}", breaker)
+    if response is None:
+        pool.discard(device)
+
+
+def spawn_probe(pool, device, breaker):
+    # 探测在后台进行，不占用本轮轮询的时间
+    task = asyncio.ensure_future(probe_device(pool, device, breaker))
+    probes.add(task)
+    task.add_done_callback(probes.discard)
 
 
-def pool_data(device):
+async def pool_data(pool, device, group, breakers=None):
     data = ""
+    if is_mocking:
+        return await encode_data(None, None, device["slave"], group)
+    key = device_key(device)
+    breaker = breakers.get(key) if breakers is not None else None
+    if breaker is not None and not breaker.allow():
+        # 熔断中的设备直接跳过
+        POLL_SKIPPED.labels(key).inc()
+        if breaker.try_probe():
+            spawn_probe(pool, device, breaker)
+        return data
+    started = time.perf_counter()
     try:
-        client = ModbusClient.ModbusTcpClient(host=device["ip"], strict=False)
-        client.register(AvcReadDiscreteInputsResponse)
-        client.register(AvcReadHoldingRegistersResponse)
-        data = encode_data(client, device["slave"])
+        connection = await pool.acquire(device)
+        data = await encode_data(connection.client, connection.limiter, device["slave"], group, breaker)
+    except ConnectionError as exc:
+        logger.error(f"Error when polling data {exc}")
+        READ_ERRORS.labels(key, group, "connect").inc()
+        if breaker is not None:
+            breaker.failure()
     except Exception as exc:
         logger.error(f"Error when polling data {exc}")
+        READ_ERRORS.labels(key, group, "error").inc()
+        pool.discard(device)
+        if breaker is not None:
+            breaker.failure()
+    POLL_SECONDS.labels(key, group).observe(time.perf_counter() - started)
+    return data
+
+
+async def poll_devices(pool, devices, group, data, breakers=None):
+    """Poll one block group of every device concurrently into the {"slaveN": {...}} snapshot.
+
+    A cycle takes as long as the slowest device instead of the sum of all of
+    them; devices whose breaker is open are skipped.
+    """
+    if traffic_trace.TRACER is not None:
+        traffic_trace.TRACER.poll(group)
+    # 配置热更新会修改设备列表，本轮使用开始时的副本
+    devices = list(devices)
+    results = await asyncio.gather(*(pool_data(pool, device, group, breakers) for device in devices))
+    for device, result in zip(devices, results):
+        name = "slave" + str(device["slave"])
+        if not result:
+            # 设备不可达
+            data[name] = result
+        elif isinstance(data.get(name), dict):
+            data[name].update(result)
+        else:
+            data[name] = result
+    return data
+
+
+def metrics_path(config):
+    # 指标文件目录，配置页面从这里读取
+    return config.get("metrics", {}).get("path", "metrics")
+
+
+def dump_metrics(path, service, scheduler, pool=None):
+    for job, stats in scheduler.stats().items():
+        SCHEDULE_OVERRUNS.labels(job).set(stats["overruns"])
+        SCHEDULE_SKIPPED.labels(job).set(stats["skipped"])
+        SCHEDULE_JITTER.labels(job).set(stats["jitterMax"])
+    if pool is not None:
+        # 连接池的复用与重连次数，与断路器状态一起在 /metrics 中查看
+        for device, stats in pool.stats().items():
+            POOL_CONNECTS.labels(device).set(stats["connects"])
+            POOL_RECONNECTS.labels(device).set(stats["reconnects"])
+            POOL_REUSES.labels(device).set(stats["reuses"])
+            POOL_FAILURES.labels(device).set(stats["failures"])
+    REGISTRY.dump(path, service)
+
+
+def copy_snapshot(data):
+    # 轮询任务会继续更新 data，增量编码器保存的是引用，发送前先复制一份
+    return {name: dict(groups) if isinstance(groups, dict) else groups
+            for name, groups in data.items()}
+
+
+def add_poll_jobs(scheduler, config, pool, devices, data, breakers):
+    """Add one job per enabled block group, polling it into data at its own period.
+
+    :returns: The effective schedule, including the "forward" period
+    """
+    schedule = dict(DEFAULT_SCHEDULE, **config.get("schedule", {}))
+    for group in GROUPS:
+        if schedule.get(group):
+            scheduler.add(group, schedule[group], functools.partial(poll_devices, pool, devices, group, data, breakers))
+    return schedule
+
+
+def reconcile(config, new_config, scheduler, pool, devices, data, breakers, uplink=None):
+    """Apply a changed config.json to the running forwarder.
+
+    Added devices are polled from the next cycle, removed ones lose their
+    connection, breaker and data; unchanged devices keep their connection
+    and the jobs keep their deadlines. A device whose settings changed
+    reconnects with the new ones, even when another device shares its
+    ip:port; the shared connection then uses the settings of whichever
+    device acquires it first. Block group periods are updated in place.
+    A new "cloudIP" or "uplink" port moves the uplink to that address.
+    Other sections only take effect after a restart.
+
+    :param config: The config in use, updated to new_config
+    :param new_config: The config read from config.json
+    :param uplink: The CloudUplink to move when the cloud address changed
+    """
+    added, removed = config_watch.diff_devices(devices, new_config.get("devices", []))
+    for device in removed:
+        devices.remove(device)
+    keys = {device_key(device) for device in devices}
+    changed = {device_key(device) for device in added}
+    names = {"slave" + str(device["slave"]) for device in devices + added}
+    for device in removed:
+        key = device_key(device)
+        if key not in keys:
+            # 没有其它设备共用这个连接，立即关闭
+            pool.remove(device)
+            breakers.remove(key)
+        elif key in changed:
+            # 连接参数（如超时）已修改，共用的连接按新参数重建
+            pool.remove(device)
+        name = "slave" + str(device["slave"])
+        if name not in names:
+            data.pop(name, None)
+        logger.info(f"Device {key} slave {device['slave']} removed")
+    for device in added:
+        devices.append(device)
+        logger.info(f"Device {device_key(device)} slave {device['slave']} added")
+
+    old = dict(DEFAULT_SCHEDULE, **config.get("schedule", {}))
+    new = dict(DEFAULT_SCHEDULE, **new_config.get("schedule", {}))
+    for group in GROUPS:
+        if new.get(group) == old.get(group):
+            continue
+        if not new.get(group):
+            scheduler.remove(group)
+        elif group in scheduler.jobs:
+            scheduler.set_period(group, new[group])
+        else:
+            scheduler.add(group, new[group], functools.partial(poll_devices, pool, devices, group, data, breakers))
+        logger.info(f"Poll period of {group} changed to {new.get(group)}")
+    if new["forward"] != old["forward"]:
+        scheduler.set_period("forward", new["forward"])
+
+    address = uplink_address(new_config)
+    if uplink is not None and address != uplink_address(config):
+        # 与网关相同：断开当前云端连接，按新地址重连，队列中的数据保留
+        logger.info(f"Cloud address changed to {address[0]}:{address[1]}")
+        uplink.retarget(*address)
+
+    old_uplink = dict(config.get("uplink", {}), port=None)
+    new_uplink = dict(new_config.get("uplink", {}), port=None)
+    for key in RESTART_KEYS:
+        if key == "uplink":
+            changed = old_uplink != new_uplink
+        else:
+            changed = config.get(key) != new_config.get(key)
+        if changed:
+            logger.warning(f"config.json \"{key}\" changed, restart the forwarder to apply it")
+    config.clear()
+    config.update(new_config)
+
+
+async def start_live_feed(config):
+    # 配置页面的 /stream 经 unix 套接字读取内存中的最新快照，不读 data.json
+    feed = live_feed.FeedServer(config.get("live", {}).get("path", live_feed.DEFAULT_PATH))
+    try:
+        await feed.start()
+    except OSError as exc:
+        logger.warning(f"Live feed disabled: {exc}")
+        return None
+    return feed
+
+
+def create_pool(config):
+    options = config.get("pool", {})
+    return ModbusConnectionPool(
+        timeout=options.get("timeout", DEFAULT_DEVICE_TIMEOUT),
+        backoff_initial=options.get("backoffInitial", 1),
+        backoff_max=options.get("backoffMax", 60),
+        concurrency=options.get("concurrency", DEFAULT_DEVICE_CONCURRENCY),
+        pipeline=options.get("pipeline", 0),
+    )
+
+
+async def run_forwarder(config):
+    devices = config["devices"]
+    pool = create_pool(config)
+    uplink = create_uplink(config)
+    encoder = create_encoder(config)
+    historian = create_historian(config)
+    binary = config.get("uplink", {}).get("format") == "binary"
+    scheduler = DeadlineScheduler()
+    breakers = create_breakers(config)
+    save_status(breakers)
+    metrics_dir = metrics_path(config)
+    traffic_trace.start(config, "forwarder")
+    data = {}
+
+    async def forward():
+        if not data:
+            return
+        snapshot = copy_snapshot(data)
+        if historian is not None:
+            historian.record(snapshot, time.time())
+        logger.debug(f"Connection pool {pool.stats()}")
+        logger.debug(f"Uplink {uplink.stats()}")
+        logger.debug(f"Schedule {scheduler.stats()}")
+        logger.debug(f"Breakers {breakers.stats()}")
+        forward_data(uplink, snapshot, encoder, binary)
+        save_data(snapshot)
+        save_status(breakers)
+        dump_metrics(metrics_dir, "forwarder", scheduler, pool)
+
+    # 每个数据块按各自的周期轮询，上送按固定周期发送最新快照
+    async def publish_live():
+        feed.publish(data, time.time())
+
+    schedule = add_poll_jobs(scheduler, config, pool, devices, data, breakers)
+    scheduler.add("forward", schedule["forward"], forward)
+    feed = await start_live_feed(config)
+    if feed is not None:
+        scheduler.add("live", config.get("live", {}).get("interval", live_feed.DEFAULT_INTERVAL), publish_live)
+    # 监视 config.json，设备和轮询周期的修改不需要重启
+    watcher = config_watch.ConfigWatcher(
+        CONFIG_FILE,
+        lambda new_config: reconcile(config, new_config, scheduler, pool, devices, data, breakers, uplink),
+        current=json.loads(json.dumps(config)),
+    )
+    watching = asyncio.ensure_future(watcher.run())
+    try:
+        await scheduler.run_async()
     finally:
-        client.close()
-        return data
+        watching.cancel()
+        if feed is not None:
+            feed.close()
+        uplink.stop()
+        pool.close()
+        if historian is not None:
+            historian.close()
+        traffic_trace.stop()
 
 
-def start_forwarder(devices):
-    while True:
-        data = {}
-        for device in devices:
-            name = "slave" + str(device["slave"])
-            data[name] = pool_data(device)
-        forward_data(data)
-        save_data(data)
-        time.sleep(5000 / 1000)
+def start_forwarder(config):
+    asyncio.run(run_forwarder(config))
 
 
 if __name__ == "__main__":
     config_data = load_config()
+    log_pipeline.setup(config_data, "forwarder")
     if config_data is None or "devices" not in config_data:
         logger.error("Config invalid, exiting..")
         pass 
-    start_forwarder(config_data['devices'])
+    start_forwarder(config_data)
@@ -1,13 +1,27 @@
 import sys
+import functools
 import logging
 import socket
 import time
 import json
+import threading
 
 import modbus_tk
 import modbus_tk.defines as cst
 import modbus_tk.modbus_tcp as modbus_tcp
 
+from modbus_pool import TcpMasterPool, device_key
+from breaker import CircuitBreakers
+from metrics import REGISTRY
+from read_plan import BITS, REGISTERS, Block, compile_plan
+import log_pipeline
+import wire_format
+from deadline_scheduler import DeadlineScheduler
+from delta import DeltaEncoder
+from historian import DEFAULT_FLUSH_SECONDS, Historian, HistoryWriter, open_series_limit
+from ring_buffer import RingBuffer
+from uplink import CloudUplink, DROP_OLDEST, ring_slot_size
+
 def start_forwarder(device_ip, cloud_ip):
     global master
     try:
@@ -27,22 +41,38 @@ def start_forwarder(device_ip, cloud_ip):
         logger.error("%s- Code=%d" % (e, e.get_exception_code()))
 
 
-# 设置日志记录器的名称
-logger = logging.getLogger(__name__)
-
-# 设置日志记录器的等级
-logger.setLevel(logging.DEBUG)  # 或者其他等级，如 logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL
-
-# 创建一个日志处理器（例如，输出到控制台）
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)  # 设置处理器的等级
-
-# 创建一个格式化程序
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)  # 应用格式化程序到处理器
-
-# 将处理器添加到记录器
-logger.addHandler(console_handler)
+# 日志经 log_pipeline 的队列异步输出，各类别的等级在 config.json 的 "logging" 中配置
+logger = logging.getLogger("forwarder1")
+
+# 各数据块的轮询周期与上送周期（秒），可在 config.json 的 "schedule" 中覆盖
+DEFAULT_SCHEDULE = {
+    "monitor": 0.5,
+    "machine": 5,
+    "storage": 60,
+    "forward": 5,
+}
+
+# 熔断器状态文件，供配置页面的 /status 读取
+STATUS_FILE = 'status.json'
+
+# 运行指标，每个上送周期写入 metrics 目录，由配置页面的 /metrics 输出
+READ_SECONDS = REGISTRY.histogram("s2c2s_read_seconds", "Latency of one Modbus read request", ("device", "block"))
+READ_ERRORS = REGISTRY.counter("s2c2s_read_errors_total", "Failed Modbus reads by reason", ("device", "block", "reason"))
+READ_BYTES = REGISTRY.counter("s2c2s_read_bytes_total", "Payload bytes read from devices", ("device",))
+POLL_SECONDS = REGISTRY.histogram("s2c2s_poll_seconds", "Time to poll one block group of a device", ("device", "group"))
+POLL_SKIPPED = REGISTRY.counter("s2c2s_poll_skipped_total", "Polls skipped by an open breaker", ("device",))
+FORWARD_SECONDS = REGISTRY.histogram("s2c2s_forward_seconds", "Time to encode and queue one snapshot")
+UPLINK_BYTES = REGISTRY.counter("s2c2s_uplink_bytes_total", "Bytes queued for the cloud uplink")
+SCHEDULE_OVERRUNS = REGISTRY.counter("s2c2s_schedule_overruns_total", "Poll or forward runs longer than their period", ("job",))
+SCHEDULE_SKIPPED = REGISTRY.counter("s2c2s_schedule_skipped_total", "Deadlines skipped after an overrun", ("job",))
+SCHEDULE_JITTER = REGISTRY.gauge("s2c2s_schedule_jitter_max_seconds", "Largest start delay of a job", ("job",))
+POOL_CONNECTS = REGISTRY.counter("s2c2s_pool_connects_total", "Connections opened to a device", ("device",))
+POOL_RECONNECTS = REGISTRY.counter("s2c2s_pool_reconnects_total", "Reconnects after a connection broke", ("device",))
+POOL_REUSES = REGISTRY.counter("s2c2s_pool_reuses_total", "Requests sent over an already open connection", ("device",))
+POOL_FAILURES = REGISTRY.counter("s2c2s_pool_failures_total", "Connections discarded as broken", ("device",))
+
+# 长连接池，按设备 ip/port 复用 TcpMaster
+pool = TcpMasterPool(lambda host, port: modbus_tcp.TcpMaster(host=host, port=port))
 
 def load_config():
     try:
@@ -53,113 +83,347 @@ def load_config():
         return config_data
 
 
-def connect_to_server(ip, port):
-    while True:
-        try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect((ip, port))
-            return client_socket
-        except Exception as e:
-            logger.error(f"Connection error: {e}")
-            logger.info("Retrying in 5 seconds...")
-            time.sleep(5)
-
-
-def forward_data(data):
-    try:
-        client1_socket = connect_to_server('192.168.1.101', 500)
-        client1_socket.sendall(json.dumps(data).encode("utf-8"))
-    except Exception as e:
-        logger.error("Error forwarding data to cloud server:", e)
-
-
-def encode_machine_data(client, slave, index):
-    address = (index<<16) + 10
-    # 0x0010 ~ 0x0017, 8 x 1 words
-    d0x0010 = ""
-    try: 
-        d0x0010 = client.execute(slave, cst.READ_DISCRETE_INPUTS, 10, 8)
-    except Exception as ex:
-        logger.error(f"Poll machine[{index}](0x0010) error：{ex}")
-
-    # 0x0030 ~ 0x14c, 285 x 2 words
-    d0x0030 = ""
-    try:
-        d0x0030 = client.execute(slave, cst.READ_HOLDING_REGISTERS, 30, 285)
-    except Exception as ex:
-        logger.error(f"Poll machine[{index}](0x0030) error：{ex}")
-
-    return { "0x10": d0x0010, "0x30": d0x0030 }
-
-
-def encode_storage_data(client, slave, index):
-    address = (index<<16) + 10
-    # 0x0010 ~ 0x0020, 11 x 1 words
-    d0x0010 = ""
-    try:
-        d0x0010 = client.execute(slave, cst.READ_DISCRETE_INPUTS, 10, 11)
-    except Exception as ex:
-        logger.error(f"Poll storage[{index}](0x0010) error：{ex}")
-
-    # 0x0030 ~ 0x005a, 43 x 2 words
-    d0x0030 = ""
-    try:
-        d0x0030 = client.execute(slave, cst.READ_HOLDING_REGISTERS, 30, 43)
-    except Exception as ex:
-        logger.error(f"Poll storage[{index}](0x0030) error：{ex}")
-
-    return { "0x10": d0x0010, "0x30": d0x0030 }
-
-
-def encode_monitor_data(client, slave):
-    address = (200<<16) + 10
-    # 0x0010 ~ 0x0018, 12 x 1 words
-    d0x0010 = ""
-    try:
-        d0x0010 = client.execute(slave, cst.READ_DISCRETE_INPUTS, 10, 12)
-    except Exception as ex:
-        logger.error(f"Poll monitor error：{d0x0010}")
-    
-    return { "0x10": d0x0010 }
-
-
-def encode_data(client, slave):
-    data = {}
+def max_message_size(config):
+    """Return the largest uplink message the enabled block groups can produce, in bytes."""
+    schedule = dict(DEFAULT_SCHEDULE, **config.get("schedule", {}))
+    template = {}
+    for group, blocks in GROUP_BLOCKS.items():
+        if schedule.get(group):
+            for block in blocks:
+                # 位按 False、寄存器按 65535 取最长的 JSON
+                values = [False] * block.count if block.kind == BITS else [65535] * block.count
+                template.setdefault(block.group, {})[block.key] = values
+    # 增量模式每个设备一条消息，否则一条消息包含所有设备
+    size = len(json.dumps({"slave255": template})) + 128
+    if config.get("uplink", {}).get("encoding") == "delta":
+        return size
+    return size * max(1, len(config.get("devices", [])))
+
+
+def create_uplink(config):
+    options = config.get("uplink", {})
+    ring = None
+    if "ring" in options:
+        # 断网期间的数据写入磁盘环形缓冲，恢复后限速补发
+        ring_options = options["ring"]
+        ring = RingBuffer(
+            ring_options.get("path", "uplink.ring"),
+            slots=ring_options.get("slots", 256),
+            slot_size=ring_options.get("slotSize") or ring_slot_size(max_message_size(config)),
+        )
+    uplink = CloudUplink(
+        host=config.get("cloudIP", "192.168.1.101"),
+        port=options.get("port", 500),
+        maxsize=options.get("queueSize", 16),
+        policy=options.get("policy", DROP_OLDEST),
+        ring=ring,
+        replay_rate=options.get("ring", {}).get("replayRate", 2),
+    )
+    uplink.start()
+    return uplink
+
+
+def create_encoder(config):
+    options = config.get("uplink", {})
+    if options.get("encoding") != "delta":
+        return None
+    return DeltaEncoder(keyframe_interval=options.get("keyframeInterval", 12))
+
+
+def save_status(breakers):
+    with open(STATUS_FILE, 'w') as file:
+        json.dump({"breakers": breakers.stats()}, file)
+
+
+def create_breakers(config):
+    options = config.get("breaker", {})
+
+    def on_change(breaker, old, new):
+        logger.warning(f"Device {breaker.key} breaker {old} -> {new}")
+        save_status(breakers)
+
+    breakers = CircuitBreakers(
+        failure_threshold=options.get("failureThreshold", 3),
+        probe_interval=options.get("probeInterval", 10),
+        on_change=on_change,
+    )
+    return breakers
+
+
+def create_historian(config):
+    if "history" not in config:
+        return None
+    # 本地历史库，断网时现场也能查询历史数据
+    options = config["history"]
+    historian = Historian(
+        options.get("path", "history"),
+        segment_seconds=options.get("segmentSeconds", 3600),
+        retention_days=options.get("retentionDays", 7),
+        kinds=BLOCK_KINDS,
+        max_open=options.get("maxOpen") or open_series_limit(len(config.get("devices", [])) * len(BLOCK_KINDS)),
+        flush_seconds=options.get("flushSeconds", DEFAULT_FLUSH_SECONDS),
+    )
+    # 写盘在单独的线程中进行，不阻塞轮询
+    writer = HistoryWriter(historian)
+    writer.start()
+    return writer
+
+
+def forward_data(uplink, data, encoder=None, binary=False):
+    # 非阻塞：云端断开时只影响上行队列，不影响轮询
+    started = time.perf_counter()
+    if encoder is None:
+        if binary:
+            # 二进制帧：位按 8 个一字节打包，寄存器为大端 uint16
+            message = wire_format.encode_snapshot(data, time.time(), BLOCK_KINDS)
+        else:
+            message = (json.dumps(data) + "\n").encode("utf-8")
+        if not uplink.publish(message):
+            logger.warning("Uplink queue full, snapshot dropped")
+        UPLINK_BYTES.labels().inc(len(message))
+    else:
+        # 增量模式：每个设备只发送变化的位/寄存器
+        for delta in encoder.encode(data):
+            message = (json.dumps(delta) + "\n").encode("utf-8")
+            on_sent = functools.partial(encoder.ack, delta["device"], delta["seq"])
+            # 转存到磁盘环形缓冲的消息不会回执，下一条改发关键帧
+            on_spilled = functools.partial(encoder.resync, delta["device"], delta["seq"])
+            if not uplink.publish(message, on_sent, on_spilled):
+                logger.warning(f"Uplink queue full, {delta['device']} #{delta['seq']} dropped")
+            UPLINK_BYTES.labels().inc(len(message))
+    FORWARD_SECONDS.labels().observe(time.perf_counter() - started)
+
+
+def dump_metrics(path, service, scheduler, pool=None):
+    for job, stats in scheduler.stats().items():
+        SCHEDULE_OVERRUNS.labels(job).set(stats["overruns"])
+        SCHEDULE_SKIPPED.labels(job).set(stats["skipped"])
+        SCHEDULE_JITTER.labels(job).set(stats["jitterMax"])
+    if pool is not None:
+        # 连接池的复用与重连次数，与断路器状态一起在 /metrics 中查看
+        for device, stats in pool.stats().items():
+            POOL_CONNECTS.labels(device).set(stats["connects"])
+            POOL_RECONNECTS.labels(device).set(stats["reconnects"])
+            POOL_REUSES.labels(device).set(stats["reuses"])
+            POOL_FAILURES.labels(device).set(stats["failures"])
+    REGISTRY.dump(path, service)
+
+
+def machine_blocks(index):
+    name = "machine" + str(index)
+    return [
+        # 0x0010 ~ 0x0017, 8 x 1 words
+        Block(name, "0x10", BITS, 10, 8),
+        # 0x0030 ~ 0x14c, 285 x 2 words
+        Block(name, "0x30", REGISTERS, 30, 285),
+    ]
+
+
+def storage_blocks(index):
+    name = "storage" + str(index - 101)
+    return [
+        # 0x0010 ~ 0x0020, 11 x 1 words
+        Block(name, "0x10", BITS, 10, 11),
+        # 0x0030 ~ 0x005a, 43 x 2 words
+        Block(name, "0x30", REGISTERS, 30, 43),
+    ]
+
+
+def monitor_blocks():
+    return [
+        # 0x0010 ~ 0x0018, 12 x 1 words
+        Block("monitor", "0x10", BITS, 10, 12),
+    ]
+
+
+def declare_blocks():
+    # 各组读取相同的地址，读取计划才能把 127 个块合并成 4 次请求
+    blocks = []
     for i in range(0, 56):
-        name = "machine" + str(i)
-        data[name] = encode_machine_data(client, slave, i)
+        blocks += machine_blocks(i)
     for i in range(101, 108):
-        name = "storage" + str(i - 101)
-        data[name] = encode_storage_data(client, slave, i)
-    data["monitor"] = encode_monitor_data(client, slave)
-    return data
+        blocks += storage_blocks(i)
+    blocks += monitor_blocks()
+    return tuple(blocks)
+
+
+def declare_groups():
+    # 按轮询周期分组，每组单独生成读取计划
+    return {
+        "machine": tuple(block for i in range(0, 56) for block in machine_blocks(i)),
+        "storage": tuple(block for i in range(101, 108) for block in storage_blocks(i)),
+        "monitor": tuple(monitor_blocks()),
+    }
+
+
+BLOCKS = declare_blocks()
+GROUP_BLOCKS = declare_groups()
+# modbus_tk 返回的位是 0/1 整数，二进制帧按声明的类型编码
+BLOCK_KINDS = {(block.group, block.key): block.kind for block in BLOCKS}
+
+
+class BrokenConnectionError(Exception):
+    """A read timed out or the socket failed; the TcpMaster must not be reused.
+
+    modbus_tk does not drain a late response, so every later read on the
+    same connection would get the answer of an earlier request.
+    """
+
+    def __init__(self, message, data):
+        super().__init__(message)
+        #: The blocks read before the failure, the others as ""
+        self.data = data
+
+
+def encode_data(client, slave, gap=0, blocks=BLOCKS, breaker=None):
+    plan = compile_plan(blocks, gap)
+    device = breaker.key if breaker is not None else ""
+    results = []
+    broken = None
+    for request in plan.requests:
+        if broken is not None or (breaker is not None and breaker.is_open()):
+            # 连接已失效或本轮中途熔断，剩余请求直接失败
+            results.append(None)
+            continue
+        function_code = cst.READ_DISCRETE_INPUTS if request.kind == BITS else cst.READ_HOLDING_REGISTERS
+        label = f"{request.kind}@{request.address}"
+        started = time.perf_counter()
+        try:
+            results.append(client.execute(slave, function_code, request.address, request.count))
+        except modbus_tk.modbus.ModbusError as ex:
+            # 设备有应答，只是返回了异常码
+            logger.error(f"Poll {request} error：{ex}")
+            READ_ERRORS.labels(device, label, "exception").inc()
+            results.append(None)
+            if breaker is not None:
+                breaker.success()
+            continue
+        except Exception as ex:
+            logger.error(f"Poll {request} error：{ex}")
+            READ_ERRORS.labels(device, label, "timeout" if isinstance(ex, socket.timeout) else "error").inc()
+            results.append(None)
+            if breaker is not None:
+                breaker.failure()
+            broken = ex
+            continue
+        READ_SECONDS.labels(device, label).observe(time.perf_counter() - started)
+        READ_BYTES.labels(device).inc(request.count * 2 if request.kind == REGISTERS else (request.count + 7) // 8)
+        if breaker is not None:
+            breaker.success()
+    if broken is not None:
+        raise BrokenConnectionError(str(broken), plan.split(results))
+    return plan.split(results)
+
+
+def probe_device(device, breaker):
+    """Try a half-open device once; the read result closes or reopens its breaker."""
+    try:
+        connection = pool.acquire(device)
+        connection.client.execute(device["slave"], cst.READ_DISCRETE_INPUTS, 10, 12)
+    except modbus_tk.modbus.ModbusError:
+        breaker.success()
+    except Exception as exc:
+        logger.info(f"Probe {breaker.key} failed: {exc}")
+        if not isinstance(exc, ConnectionError):
+            pool.discard(device)
+        breaker.failure()
+    else:
+        breaker.success()
 
 
-def pool_data(device):
+def pool_data(device, blocks=BLOCKS, breakers=None):
     data = ""
+    breaker = breakers.get(device_key(device)) if breakers is not None else None
+    if breaker is not None and not breaker.allow():
+        # 熔断中的设备直接跳过，探测在后台线程进行
+        POLL_SKIPPED.labels(breaker.key).inc()
+        if breaker.try_probe():
+            threading.Thread(target=probe_device, args=(device, breaker), daemon=True).start()
+        return data
     try:
-        client = modbus_tcp.TcpMaster(host=device["ip"])
-        data = encode_data(client, device["slave"])
+        connection = pool.acquire(device)
+        data = encode_data(connection.client, device["slave"], device.get("readGap", 0), blocks, breaker)
+    except BrokenConnectionError as exc:
+        # 失败已计入熔断器，这里只丢弃连接，已读到的数据块照常上送
+        pool.discard(device)
+        data = exc.data
+    except ConnectionError as exc:
+        logger.error(f"Error when polling data {exc}")
+        if breaker is not None:
+            breaker.failure()
     except Exception as exc:
         logger.error(f"Error when polling data {exc}")
-    finally:
-        client.close()
-        return data
+        pool.discard(device)
+        if breaker is not None:
+            breaker.failure()
+    return data
 
 
-def start_forwarder(devices):
-    while True:
-        data = {}
+def start_forwarder(config):
+    devices = config["devices"]
+    uplink = create_uplink(config)
+    encoder = create_encoder(config)
+    historian = create_historian(config)
+    binary = config.get("uplink", {}).get("format") == "binary"
+    schedule = dict(DEFAULT_SCHEDULE, **config.get("schedule", {}))
+    scheduler = DeadlineScheduler()
+    breakers = create_breakers(config)
+    save_status(breakers)
+    data = {}
+
+    metrics_dir = config.get("metrics", {}).get("path", "metrics")
+
+    def poll(group, blocks):
         for device in devices:
             name = "slave" + str(device["slave"])
-            data[name] = pool_data(device)
-        forward_data(data)
-        time.sleep(5000 / 1000)
+            started = time.perf_counter()
+            result = pool_data(device, blocks, breakers)
+            POLL_SECONDS.labels(device_key(device), group).observe(time.perf_counter() - started)
+            if not result:
+                # 设备不可达
+                data[name] = result
+            elif isinstance(data.get(name), dict):
+                data[name].update(result)
+            else:
+                data[name] = result
+
+    def forward():
+        if not data:
+            return
+        # 增量编码器保存的是引用，轮询会继续更新 data，这里先复制一份
+        snapshot = {name: dict(groups) if isinstance(groups, dict) else groups
+                    for name, groups in data.items()}
+        if historian is not None:
+            historian.record(snapshot, time.time())
+        logger.debug(f"Connection pool {pool.stats()}")
+        logger.debug(f"Uplink {uplink.stats()}")
+        logger.debug(f"Schedule {scheduler.stats()}")
+        logger.debug(f"Breakers {breakers.stats()}")
+        forward_data(uplink, snapshot, encoder, binary)
+        save_status(breakers)
+        dump_metrics(metrics_dir, "forwarder1", scheduler, pool)
+
+    # 每个数据块按各自的周期轮询，上送按固定周期发送最新快照
+    for group, blocks in GROUP_BLOCKS.items():
+        if schedule.get(group):
+            scheduler.add(group, schedule[group], functools.partial(poll, group, blocks))
+    scheduler.add("forward", schedule["forward"], forward)
+    try:
+        scheduler.run()
+    finally:
+        if historian is not None:
+            # 写完队列中的快照，缓冲的数据写入磁盘
+            historian.close()
 
 
 if __name__ == "__main__":
+    if "--plan" in sys.argv:
+        # 打印读取计划，对比合并前后的请求次数
+        print(compile_plan(BLOCKS, 0))
+        sys.exit(0)
     config_data = load_config()
+    log_pipeline.setup(config_data, "forwarder1")
     if config_data is None or "devices" not in config_data:
         logger.error("Config invalid, exiting..")
         pass 
-    start_forwarder(config_data['devices'])
+    start_forwarder(config_data)
@@ -0,0 +1,169 @@
+"""Streaming JSON message framing for the cloud links.
+
+Messages are newline-delimited JSON objects. A TCP read may hold part of
+a message or several of them, so the decoder buffers incoming bytes and
+only returns complete objects. Objects sent back to back without a
+newline, as older cloud clients do, are still accepted.
+"""
+
+__all__ = [
+    "FramingError",
+    "JsonStreamDecoder",
+    "encode_message",
+]
+
+import json
+import re
+
+# 扫描未结束的尾部时只关心字符串边界、转义和括号
+_STRUCTURE = re.compile(rb'["\\{}\[\]]')
+
+
+class FramingError(ValueError):
+    """A message on the stream is not valid JSON."""
+
+
+def encode_message(data):
+    """Encode one message for the stream.
+
+    :param data: A JSON serialisable object
+    :returns: The newline-terminated bytes
+    """
+    return (json.dumps(data) + "\n").encode("utf-8")
+
+
+class JsonStreamDecoder:
+    """Incremental decoder of a newline-delimited JSON byte stream."""
+
+    def __init__(self, max_buffer=1 << 20):
+        """Initialize a new instance.
+
+        :param max_buffer: Max number of bytes of a single pending message
+        """
+        self.max_buffer = max_buffer
+        self.buffer = bytearray()
+        self.decoder = json.JSONDecoder()
+        self._reset_scan()
+
+    def feed(self, data):
+        """Add received bytes and return the complete messages.
+
+        Invalid messages are returned as FramingError instances in the
+        message list, so the caller can answer them and carry on. Only
+        newline-terminated lines are judged; an unterminated tail yields
+        the whole objects at its start and the rest stays buffered until
+        more bytes arrive. The tail is scanned incrementally and only
+        decoded once a top-level object or array may have closed, so a
+        large message arriving in many reads costs linear time.
+
+        :param data: The received bytes
+        :returns: A list of decoded objects and FramingError
+        """
+        self.buffer += data
+        messages = []
+        # complete lines first
+        end = self.buffer.rfind(b"\n")
+        if end >= 0:
+            lines = bytes(self.buffer[:end])
+            del self.buffer[:end + 1]
+            for line in lines.split(b"\n"):
+                self._decode_line(line, messages)
+            self._reset_scan()
+        # then whatever objects are already whole in the unterminated tail
+        if self.buffer and self._scan():
+            rest = self._decode_tail(bytes(self.buffer), messages)
+            self.buffer = bytearray(rest)
+            self._reset_scan()
+            self._scan()
+        if len(self.buffer) > self.max_buffer:
+            self.buffer.clear()
+            self._reset_scan()
+            messages.append(FramingError("message too large"))
+        return messages
+
+    def _reset_scan(self):
+        self.scanned = 0
+        self.depth = 0
+        self.in_string = False
+
+    def _scan(self):
+        """Scan the tail bytes not seen yet; return True if a top-level object or array closed."""
+        closed = False
+        position = self.scanned
+        while True:
+            match = _STRUCTURE.search(self.buffer, position)
+            if match is None:
+                position = len(self.buffer)
+                break
+            char = match.group()
+            position = match.end()
+            if self.in_string:
+                if char == b"\\":
+                    if position >= len(self.buffer):
+                        # 转义符是最后一个字节，下次从它开始重新扫描
+                        position = match.start()
+                        break
+                    position += 1
+                elif char == b'"':
+                    self.in_string = False
+            elif char == b'"':
+                self.in_string = True
+            elif char in b"{[":
+                self.depth += 1
+            elif char in b"}]":
+                self.depth = max(0, self.depth - 1)
+                if self.depth == 0:
+                    closed = True
+        self.scanned = position
+        return closed
+
+    def _decode_line(self, data, messages):
+        """Decode the objects of a complete line."""
+        try:
+            text = data.decode("utf-8")
+        except UnicodeDecodeError as exc:
+            messages.append(FramingError(str(exc)))
+            return
+        position = 0
+        while True:
+            while position < len(text) and text[position].isspace():
+                position += 1
+            if position >= len(text):
+                return
+            try:
+                obj, position = self.decoder.raw_decode(text, position)
+            except json.JSONDecodeError as exc:
+                messages.append(FramingError(str(exc)))
+                # skip the garbage up to the next object
+                position = text.find("{", position + 1)
+                if position < 0:
+                    return
+                continue
+            messages.append(obj)
+
+    def _decode_tail(self, data, messages):
+        """Decode the whole objects at the start of an unterminated tail, return the rest.
+
+        Only objects and arrays count as whole: their closing bracket ends
+        them, while a number or literal might still continue. Anything
+        that does not decode yet is kept without an error.
+        """
+        try:
+            text = data.decode("utf-8")
+        except UnicodeDecodeError:
+            # 可能截断在多字节字符中间
+            return data
+        position = 0
+        while True:
+            while position < len(text) and text[position].isspace():
+                position += 1
+            if position >= len(text):
+                return b""
+            try:
+                obj, end = self.decoder.raw_decode(text, position)
+            except json.JSONDecodeError:
+                return text[position:].encode("utf-8")
+            if not isinstance(obj, (dict, list)):
+                return text[position:].encode("utf-8")
+            messages.append(obj)
+            position = end
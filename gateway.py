@@ -3,60 +3,400 @@ import logging
 import socket
 import time
 import json
+import asyncio
+import functools
+import struct
 
+from framing import FramingError, JsonStreamDecoder, encode_message
+from metrics import REGISTRY
+from request_scheduler import BusyError, FairScheduler
+from response_cache import READ_FUNCTION_CODES, ResponseCache
+import config_watch
+import log_pipeline
+import traffic_trace
 
-def connect_to_server(ip, port):
-    while True:
+logger = logging.getLogger("gateway")
+
+# 默认的配置文件路径
+CONFIG_FILE = 'config.json'
+
+# 初始默认配置
+config_data = {
+    "cloudIP": "192.168.1.101"
+}
+
+# 设备 Modbus TCP 端口与单次请求超时（秒）
+DEVICE_PORT = 502
+DEVICE_TIMEOUT = 1
+
+# 指标写入 metrics 目录的周期（秒）
+METRICS_INTERVAL = 5
+
+# 修改后需要重启才能生效的配置项
+RESTART_KEYS = ("metrics", "trace", "logging")
+
+REQUEST_SECONDS = REGISTRY.histogram("s2c2s_gateway_request_seconds", "Time to answer one cloud command", ("device",))
+REQUEST_ERRORS = REGISTRY.counter("s2c2s_gateway_errors_total", "Failed cloud commands by reason", ("device", "reason"))
+DEVICE_BYTES = REGISTRY.counter("s2c2s_gateway_device_bytes_total", "Bytes exchanged with devices", ("device", "direction"))
+CLOUD_BYTES = REGISTRY.counter("s2c2s_gateway_cloud_bytes_total", "Bytes exchanged with the cloud", ("direction",))
+CACHE_EVENTS = REGISTRY.counter("s2c2s_gateway_cache_total", "Response cache lookups by outcome", ("outcome",))
+
+
+def load_config():
+    try:
+        with open(CONFIG_FILE, 'r') as file:
+            data = json.load(file)
+            return data
+    except FileNotFoundError:
+        return config_data
+
+
+class StaleLinkError(ConnectionError):
+    """The device closed a reused connection before answering any byte."""
+
+
+class DeviceLink:
+    """Persistent connection to one device.
+
+    Commands to the same device are sent one at a time over the same
+    socket; commands to different devices run concurrently.
+    """
+
+    def __init__(self, ip, port=DEVICE_PORT, timeout=DEVICE_TIMEOUT):
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.lock = asyncio.Lock()
+        self.reader = None
+        self.writer = None
+        self.connects = 0
+        self.requests = 0
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip, self.port), timeout=self.timeout)
+        self.connects += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def exchange(self, frame):
+        tracer = traffic_trace.TRACER
+        if tracer is not None:
+            peer = f"{self.ip}:{self.port}"
+            txn = tracer.request(peer, frame[6:])
         try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect((ip, port))
-            return client_socket
-        except Exception as e:
-            print(f"Connection error: {e}")
-            print("Retrying in 5 seconds...")
-            time.sleep(5)
+            log_pipeline.dump_frame("out", self.ip, frame)
+            try:
+                self.writer.write(frame)
+                await self.writer.drain()
+                DEVICE_BYTES.labels(self.ip, "out").inc(len(frame))
+                # 按 MBAP 头中的长度读取完整响应，而不是假设一次 recv 就是一帧
+                header = await self.reader.readexactly(6)
+            except asyncio.IncompleteReadError as exc:
+                if exc.partial:
+                    raise
+                raise StaleLinkError(f"{self.ip} closed the connection") from exc
+            except (ConnectionResetError, BrokenPipeError) as exc:
+                raise StaleLinkError(f"{self.ip}: {exc}") from exc
+            if header[:2] != frame[:2]:
+                raise ConnectionError(f"{self.ip} answered transaction {header[:2].hex()}, expected {frame[:2].hex()}")
+            length = struct.unpack(">H", header[4:6])[0]
+            response = header + await self.reader.readexactly(length)
+        except (Exception, asyncio.CancelledError) as exc:
+            # 超时时 wait_for 会取消这里
+            if tracer is not None:
+                tracer.no_response(peer, txn, type(exc).__name__)
+            raise
+        DEVICE_BYTES.labels(self.ip, "in").inc(len(response))
+        log_pipeline.dump_frame("in", self.ip, response)
+        if tracer is not None:
+            tracer.response(peer, txn, response[6:])
+        return response
+
+    async def request(self, frame):
+        async with self.lock:
+            self.requests += 1
+            reused = self.writer is not None
+            try:
+                if not reused:
+                    await self.connect()
+                return await asyncio.wait_for(self.exchange(frame), timeout=self.timeout)
+            except StaleLinkError:
+                self.close()
+                # 复用的连接可能已被设备关闭：设备还没有应答任何字节，读请求可以安全地重发；
+                # 超时或写请求不重发，否则设备可能执行两次
+                if not reused or len(frame) < 8 or frame[7] not in READ_FUNCTION_CODES:
+                    raise
+            except BaseException:
+                self.close()
+                raise
+            await self.connect()
+            try:
+                return await asyncio.wait_for(self.exchange(frame), timeout=self.timeout)
+            except BaseException:
+                self.close()
+                raise
+
+
+def gateway_settings(options):
+    """Return the Gateway arguments of a config.json "gateway" section."""
+    return {
+        "device_port": options.get("devicePort", DEVICE_PORT),
+        "device_timeout": options.get("deviceTimeout", DEVICE_TIMEOUT),
+        "cache_ttl": options.get("cacheTtl", 0.5),
+        "cache_size": options.get("cacheSize", 256),
+        "max_outstanding": options.get("maxOutstanding", 1),
+        "max_queue": options.get("maxQueue", 16),
+        "max_inflight": options.get("maxInflight", 0),
+    }
+
+
+class Gateway:
+    """Forward commands from the cloud link to the devices concurrently."""
+
+    def __init__(self, device_port=DEVICE_PORT, device_timeout=DEVICE_TIMEOUT,
+                 cache_ttl=0.5, cache_size=256, max_outstanding=1, max_queue=16, max_inflight=0):
+        self.device_port = device_port
+        self.device_timeout = device_timeout
+        self.links = {}
+        self.tasks = set()
+        # 当前的云端连接，未连接时为 None
+        self.cloud_writer = None
+        # 相同读请求短时间内复用响应，进行中的相同请求合并为一次
+        self.cache = ResponseCache(cache_ttl, cache_size)
+        # 每个设备一个有界队列，设备之间轮询调度，队列满时立即返回 busy
+        self.scheduler = FairScheduler(max_outstanding, max_queue, max_inflight)
+
+    def link(self, ip):
+        link = self.links.get(ip)
+        if link is None:
+            link = DeviceLink(ip, self.device_port, self.device_timeout)
+            self.links[ip] = link
+        return link
+
+    def close(self):
+        for link in self.links.values():
+            link.close()
+        self.links.clear()
+
+    def reconcile(self, settings, removed=()):
+        """Apply new settings and drop the links of removed devices.
+
+        Links to the other devices stay open, unless the device port changed.
+
+        :param settings: Keyword arguments as returned by gateway_settings()
+        :param removed: The ips of the devices removed from config.json
+        """
+        if settings["device_port"] != self.device_port:
+            self.device_port = settings["device_port"]
+            # 下次请求时按新端口重新连接
+            self.close()
+        self.device_timeout = settings["device_timeout"]
+        for link in self.links.values():
+            link.timeout = self.device_timeout
+        self.cache.ttl = settings["cache_ttl"]
+        self.cache.maxsize = settings["cache_size"]
+        self.scheduler.max_outstanding = settings["max_outstanding"]
+        self.scheduler.max_queue = settings["max_queue"]
+        self.scheduler.max_inflight = settings["max_inflight"]
+        for ip in removed:
+            link = self.links.pop(ip, None)
+            if link is not None:
+                link.close()
+
+    def stats(self):
+        devices = {ip: {"connects": link.connects, "requests": link.requests}
+                   for ip, link in self.links.items()}
+        return {"devices": devices, "cache": self.cache.stats(), "queues": self.scheduler.stats()}
+
+    def update_metrics(self):
+        cache = self.cache.stats()
+        for outcome in ("hits", "misses", "coalesced", "bypassed"):
+            CACHE_EVENTS.labels(outcome).set(cache[outcome])
+
+    def dump_metrics(self, path):
+        self.update_metrics()
+        REGISTRY.dump(path, "gateway")
+
+    async def request(self, ip, frame):
+        link = self.link(ip)
+        return await self.scheduler.submit(ip, lambda: link.request(frame))
+
+
+async def send_response(client1_writer, response_data, request_id=None):
+    # 带上请求 id，响应可以乱序返回
+    if request_id is not None:
+        response_data["id"] = request_id
+    message = encode_message(response_data)
+    client1_writer.write(message)
+    CLOUD_BYTES.labels("out").inc(len(message))
+    if traffic_trace.TRACER is not None:
+        traffic_trace.TRACER.cloud_out(message)
+    try:
+        # 云端读得慢时在这里等待，响应不会无限堆积在发送缓冲中
+        await client1_writer.drain()
+    except ConnectionError as exc:
+        logger.warning(f"Cloud link lost while answering: {exc}")
+
 
-def forward_message(client1_socket, ip, cmd):
+async def forward_message(gateway, ip, cmd):
+    started = time.perf_counter()
     try:
-        client2_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client2_socket.settimeout(1)
-        client2_socket.connect((ip, 502))
-        client2_socket.send(bytes.fromhex(cmd))
-        response_message = client2_socket.recv(1024)
-        if response_message:
-            print("Receive from server2: {}".format(response_message.hex()))
-            response_data = {"ip":ip,"data":response_message.hex()}
-            client1_socket.send(json.dumps(response_data).encode("utf-8"))
+        request = functools.partial(gateway.request, ip)
+        response_message = await gateway.cache.fetch(ip, bytes.fromhex(cmd), request)
+        return {"ip":ip,"data":response_message.hex()}
+    except BusyError:
+        REQUEST_ERRORS.labels(ip, "busy").inc()
+        return {"ip":ip,"error":"busy"}
     except Exception as e:
-        response_data = {"ip":ip,"error":"device unreachable"}
-        client1_socket.send(json.dumps(response_data).encode("utf-8"))
+        REQUEST_ERRORS.labels(ip, "timeout" if isinstance(e, asyncio.TimeoutError) else "unreachable").inc()
+        return {"ip":ip,"error":"device unreachable"}
+    finally:
+        REQUEST_SECONDS.labels(ip).observe(time.perf_counter() - started)
 
-def start_gateway():
+
+async def forward_command(gateway, request_data):
     try:
-        while True:
-            client1_socket = connect_to_server('192.168.1.101', 12345)
+        ip = request_data["ip"]
+        cmd = request_data["cmd"]
+    except Exception:
+        return {"error":"invalid format"}
+    if not ip or not cmd:
+        return {"error":"invalid params"}
+    return await forward_message(gateway, ip, cmd)
+
+
+async def forward_batch(gateway, client1_writer, request_data):
+    # 批量命令：并发下发到各设备，结果按原顺序一次返回
+    commands = request_data["batch"]
+    results = await asyncio.gather(*(forward_command(gateway, command) for command in commands))
+    for command, result in zip(commands, results):
+        if isinstance(command, dict) and command.get("id") is not None:
+            result["id"] = command["id"]
+    await send_response(client1_writer, {"batch":list(results)}, request_data.get("id"))
+
+
+async def forward_single(gateway, client1_writer, request_data):
+    response_data = await forward_command(gateway, request_data)
+    await send_response(client1_writer, response_data, request_data.get("id"))
+
+
+def spawn(gateway, coro):
+    task = asyncio.ensure_future(coro)
+    gateway.tasks.add(task)
+    task.add_done_callback(gateway.tasks.discard)
+
+
+def handle_message(gateway, client1_writer, request_data):
+    logger.debug("Receive from cloud: %s", request_data)
+    if isinstance(request_data, FramingError) or not isinstance(request_data, dict):
+        logger.warning("Decoding JSON has failed: %s", request_data)
+        spawn(gateway, send_response(client1_writer, {"error":"invalid format"}))
+    elif request_data.get("type") == "stats":
+        spawn(gateway, send_response(client1_writer, {"stats":gateway.stats()}, request_data.get("id")))
+    elif "batch" in request_data:
+        if not isinstance(request_data["batch"], list):
+            spawn(gateway, send_response(client1_writer, {"error":"invalid params"}, request_data.get("id")))
+        else:
+            spawn(gateway, forward_batch(gateway, client1_writer, request_data))
+    else:
+        spawn(gateway, forward_single(gateway, client1_writer, request_data))
+
+
+def cloud_address(config):
+    return config.get("cloudIP", "192.168.1.101"), config.get("gateway", {}).get("port", 12345)
+
+
+async def connect_to_server(config):
+    while True:
+        # 每次重试都重新读取地址，配置修改后连到新的云端
+        ip, port = cloud_address(config)
+        try:
+            return await asyncio.open_connection(ip, port)
+        except Exception as e:
+            logger.warning(f"Connection error: {e}, retrying in 5 seconds")
+            await asyncio.sleep(5)
+
+
+def reconcile_gateway(gateway, config, new_config):
+    """Apply a changed config.json to a running gateway.
+
+    :param gateway: The Gateway
+    :param config: The config it runs with, updated in place
+    :param new_config: The new config
+    """
+    old_ips = {device["ip"] for device in config.get("devices", [])}
+    new_ips = {device["ip"] for device in new_config.get("devices", [])}
+    gateway.reconcile(gateway_settings(new_config.get("gateway", {})), old_ips - new_ips)
+    moved = cloud_address(new_config) != cloud_address(config)
+    for key in RESTART_KEYS:
+        if config.get(key) != new_config.get(key):
+            logger.warning(f"config.json \"{key}\" changed, restart the gateway to apply it")
+    config.clear()
+    config.update(new_config)
+    if moved and gateway.cloud_writer is not None:
+        # 断开当前云端连接，主循环按新地址重连
+        logger.info(f"Cloud address changed to {cloud_address(config)}")
+        gateway.cloud_writer.close()
+
+
+async def serve_cloud(gateway, config):
+    """Connect to the cloud and answer its commands until cancelled."""
+    while True:
+        client1_reader, client1_writer = await connect_to_server(config)
+        gateway.cloud_writer = client1_writer
+        decoder = JsonStreamDecoder()
+        try:
             while True:
-                request_message = client1_socket.recv(1024).decode("utf-8")
-                if not request_message:
+                data = await client1_reader.read(4096)
+                if not data:
                     break
-                print("Receive from server1: {}".format(request_message))
-                try:
-                    request_data = json.loads(request_message)
-                    ip = request_data["ip"]
-                    cmd = request_data["cmd"]
-                    if ip and cmd:
-                        forward_message(client1_socket, ip, cmd)
-                    else:
-                        response_data = {"error":"invalid params"}
-                        client1_socket.send(json.dumps(response_data).encode("utf-8"))
-                except Exception as e:
-                     print("Decoding JSON has failed: {}".format(e))
-                     response_data = {"error":"invalid format"}
-                     client1_socket.send(json.dumps(response_data).encode("utf-8"))
-    except Exception as e:
-        print(f"Error occurred: {e}")
+                CLOUD_BYTES.labels("in").inc(len(data))
+                if traffic_trace.TRACER is not None:
+                    traffic_trace.TRACER.cloud_in(data)
+                for request_data in decoder.feed(data):
+                    handle_message(gateway, client1_writer, request_data)
+        except Exception as e:
+            logger.error(f"Error occurred: {e}")
+        finally:
+            gateway.cloud_writer = None
+            client1_writer.close()
+
+
+async def run_gateway(config):
+    gateway = Gateway(**gateway_settings(config.get("gateway", {})))
+    metrics_dir = config.get("metrics", {}).get("path", "metrics")
+    traffic_trace.start(config, "gateway")
+
+    async def dump_metrics():
+        while True:
+            gateway.dump_metrics(metrics_dir)
+            await asyncio.sleep(METRICS_INTERVAL)
+
+    watcher = config_watch.ConfigWatcher(CONFIG_FILE, functools.partial(reconcile_gateway, gateway, config),
+                                         current=json.loads(json.dumps(config)))
+    spawn(gateway, dump_metrics())
+    spawn(gateway, watcher.run())
+    try:
+        await serve_cloud(gateway, config)
+    finally:
+        for task in list(gateway.tasks):
+            task.cancel()
+        gateway.close()
+        traffic_trace.stop()
+
+
+def start_gateway():
+    config = load_config()
+    log_pipeline.setup(config, "gateway")
+    try:
+        asyncio.run(run_gateway(config))
     finally:
-        client1_socket.close()
+        log_pipeline.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,476 @@
+"""Embedded append-only historian of polled values.
+
+Every block of a snapshot, e.g. slave1 / monitor / 0x10, is a series of
+fixed-width samples. Time is cut into segments (one directory per
+segmentSeconds); inside a segment each series has:
+
+    <series>.t    timestamps, array("d"), appended per sample
+    <series>.v    ">4sBcH" header (magic b"S2HV", version, typecode, width),
+                  then the samples row by row
+
+Rows are cheap to append, but a query only wants one register, so when a
+segment is over its series are sealed into a columnar file:
+
+    <series>.c    ">4sBcHI" header (magic b"S2HC", version, typecode, width,
+                  rows), the timestamps, then the values column by column
+
+and a query reads the timestamps plus the one column it needs. Bits are
+stored one per byte ("B"), registers as uint16 ("H"), by the block kinds
+the forwarder declares. Segments older than the retention are deleted.
+
+Files are written through their buffers and flushed every flushSeconds,
+and only the most recently written series keep their files open (by
+default as many as the fleet has series, within the descriptor limit).
+The forwarders record through a HistoryWriter, so the disk writes run in
+a thread of their own instead of the poll loop.
+"""
+
+__all__ = [
+    "Historian",
+    "HistoryReader",
+    "HistoryWriter",
+    "open_series_limit",
+]
+
+import array
+import collections
+import logging
+import os
+import queue
+import resource
+import shutil
+import struct
+import sys
+import threading
+import time
+
+from read_plan import BITS
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_MAGIC = b"S2HV"
+SEALED_MAGIC = b"S2HC"
+VERSION = 1
+
+ACTIVE_HEADER = struct.Struct(">4sBcH")
+SEALED_HEADER = struct.Struct(">4sBcHI")
+
+#: Headers are big-endian, samples use the host byte order
+_SWAP = sys.byteorder != "little"
+
+
+def series_name(device, block):
+    """Return the file name of a series, e.g. slave1.monitor.0x10.
+
+    :param device: The device name, e.g. slave1
+    :param block: The block path, e.g. monitor/0x10
+    """
+    return f"{device}.{block.replace('/', '.')}"
+
+
+def _typecode(values):
+    return "B" if values and isinstance(values[0], bool) else "H"
+
+
+#: Seconds between two flushes of the open series files
+DEFAULT_FLUSH_SECONDS = 10
+
+#: Snapshots queued for the HistoryWriter before new ones are dropped
+DEFAULT_QUEUE_SIZE = 4
+
+
+def open_series_limit(series):
+    """Return how many series may keep their files open.
+
+    :param series: The number of series the fleet records
+    :returns: series, but at most a quarter of the descriptor limit
+              (2 descriptors per series, the rest left for sockets)
+    """
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return max(1, series)
+    return max(1, min(series, soft // 4))
+
+
+def _to_disk(values):
+    if _SWAP:
+        values.byteswap()
+    return values
+
+
+def _from_disk(values):
+    if _SWAP:
+        values.byteswap()
+    return values
+
+
+def _read_array(typecode, data):
+    values = array.array(typecode)
+    values.frombytes(data)
+    return _from_disk(values)
+
+
+class _Series:
+    """One series in the active segment; its files are opened on demand."""
+
+    def __init__(self, directory, name, typecode, width):
+        self.directory = directory
+        self.name = name
+        self.typecode = typecode
+        self.width = width
+        base = os.path.join(directory, name)
+        if os.path.exists(base + ".v"):
+            # 重启后继续写当前分段，沿用文件中的类型和宽度
+            with open(base + ".v", "rb") as file:
+                _, _, typecode, self.width = ACTIVE_HEADER.unpack(file.read(ACTIVE_HEADER.size))
+            self.typecode = typecode.decode()
+        else:
+            with open(base + ".v", "ab") as file:
+                file.write(ACTIVE_HEADER.pack(ACTIVE_MAGIC, VERSION, typecode.encode(), width))
+        self.values = None
+        self.times = None
+
+    def open(self):
+        base = os.path.join(self.directory, self.name)
+        self.values = open(base + ".v", "ab")
+        self.times = open(base + ".t", "ab")
+
+    def append(self, timestamp, values):
+        if self.values is None:
+            self.open()
+        row = array.array(self.typecode, values)
+        if len(row) != self.width:
+            # 块长度变化时按首次记录的宽度截断/补零，保持行定长
+            del row[self.width:]
+            row.extend([0] * (self.width - len(row)))
+        self.values.write(_to_disk(row).tobytes())
+        self.times.write(_to_disk(array.array("d", [timestamp])).tobytes())
+
+    def flush(self):
+        if self.values is not None:
+            self.values.flush()
+            self.times.flush()
+
+    def close(self):
+        if self.values is not None:
+            self.values.close()
+            self.times.close()
+        self.values = None
+        self.times = None
+
+
+def _load_active(base):
+    """Return (typecode, width, timestamps, row-major values) of an active series."""
+    with open(base + ".v", "rb") as file:
+        data = file.read()
+    with open(base + ".t", "rb") as file:
+        times = file.read()
+    magic, version, typecode, width = ACTIVE_HEADER.unpack_from(data, 0)
+    if magic != ACTIVE_MAGIC or version != VERSION:
+        raise ValueError(f"{base}.v is not a history series")
+    typecode = typecode.decode()
+    itemsize = array.array(typecode).itemsize
+    # 写入方可能刚写了一半的行：只取两个文件都完整的行数
+    rows = min(len(times) // 8, (len(data) - ACTIVE_HEADER.size) // (itemsize * width))
+    timestamps = _read_array("d", times[:rows * 8])
+    values = _read_array(typecode, data[ACTIVE_HEADER.size:ACTIVE_HEADER.size + rows * width * itemsize])
+    return typecode, width, timestamps, values
+
+
+def _seal(base):
+    """Rewrite an active series column by column into <base>.c."""
+    if os.path.exists(base + ".c"):
+        # 时钟回拨到已封存的分段，保留行存文件，查询时两者合并
+        logger.warning(f"History series {base} is already sealed")
+        return
+    typecode, width, timestamps, values = _load_active(base)
+    rows = len(timestamps)
+    temporary = f"{base}.c.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(SEALED_HEADER.pack(SEALED_MAGIC, VERSION, typecode.encode(), width, rows))
+        file.write(_to_disk(timestamps).tobytes())
+        for index in range(width):
+            # array 的步长切片即取出一列
+            file.write(_to_disk(values[index::width]).tobytes())
+    os.replace(temporary, base + ".c")
+    os.remove(base + ".v")
+    os.remove(base + ".t")
+
+
+class Historian:
+    """Record forwarder snapshots into time-partitioned segments."""
+
+    def __init__(self, path="history", segment_seconds=3600, retention_days=7, kinds=None,
+                 max_open=None, flush_seconds=DEFAULT_FLUSH_SECONDS):
+        """Initialize a new instance.
+
+        :param path: The history directory
+        :param segment_seconds: Length of a segment, in seconds
+        :param retention_days: Segments older than this are deleted
+        :param kinds: {(group, key): read_plan.BITS or REGISTERS} of every block;
+                      without it, lists of bools are stored as bits
+        :param max_open: Series whose files are kept open, see open_series_limit()
+        :param flush_seconds: Seconds between two flushes; a reader sees new
+                              samples at most this late
+        """
+        self.path = path
+        self.segment_seconds = segment_seconds
+        self.retention_days = retention_days
+        self.kinds = kinds
+        self.max_open = max_open or open_series_limit(float("inf"))
+        self.flush_seconds = flush_seconds
+        self.next_flush = time.monotonic() + flush_seconds
+        self.segment = None
+        self.series = {}
+        # 最近写过的序列保持文件打开，超过上限时关闭最久未写的
+        self.open_series = collections.OrderedDict()
+        os.makedirs(path, exist_ok=True)
+        # 上次运行未封存的分段；当前分段继续追加
+        current = self._segment_start(time.time())
+        for segment in _segments(path):
+            if segment < current:
+                self._seal_segment(segment)
+        self._expire()
+
+    def _segment_start(self, timestamp):
+        return int(timestamp // self.segment_seconds * self.segment_seconds)
+
+    def _seal_segment(self, segment, names=None):
+        directory = os.path.join(self.path, str(segment))
+        if names is None:
+            names = [file_name[:-2] for file_name in os.listdir(directory) if file_name.endswith(".v")]
+        for name in names:
+            base = os.path.join(directory, name)
+            try:
+                _seal(base)
+            except FileNotFoundError:
+                # 另一个写入进程已经封存
+                pass
+            except (OSError, ValueError, struct.error) as exc:
+                logger.error(f"Could not seal history series {base}: {exc}")
+
+    def _rotate(self, segment):
+        previous = self.segment
+        # 只封存自己写的序列，分片模式下多个进程共用同一目录
+        names = list(self.series)
+        self.close()
+        if previous is not None:
+            self._seal_segment(previous, names)
+        self.segment = segment
+        os.makedirs(os.path.join(self.path, str(segment)), exist_ok=True)
+        self._expire()
+
+    def _expire(self):
+        if not self.retention_days:
+            return
+        segments = _segments(self.path)
+        if not segments:
+            return
+        oldest = max(segments) - self.retention_days * 86400
+        for segment in segments:
+            if segment + self.segment_seconds <= oldest:
+                logger.info(f"History segment {segment} expired")
+                shutil.rmtree(os.path.join(self.path, str(segment)), ignore_errors=True)
+
+    def _typecode(self, group, key, values):
+        if self.kinds is None:
+            return _typecode(values)
+        # modbus_tk 返回的位是 0/1 整数，按声明的类型存储
+        return "B" if self.kinds.get((group, key)) == BITS else "H"
+
+    def _append(self, timestamp, device, group, key, values):
+        block = f"{group}/{key}"
+        name = series_name(device, block)
+        series = self.series.get(name)
+        if series is None:
+            directory = os.path.join(self.path, str(self.segment))
+            series = _Series(directory, name, self._typecode(group, key, values), len(values))
+            self.series[name] = series
+        self.open_series[name] = series
+        self.open_series.move_to_end(name)
+        while len(self.open_series) > self.max_open:
+            _, oldest = self.open_series.popitem(last=False)
+            oldest.close()
+        series.append(timestamp, values)
+
+    def record(self, data, timestamp):
+        """Append one snapshot.
+
+        Devices or blocks that failed to poll ("") are left out, so their
+        series simply have a gap.
+
+        :param data: The {"slaveN": {"group": {"0xNN": [...]}}} snapshot
+        :param timestamp: The poll time, in seconds since the epoch
+        """
+        segment = self._segment_start(timestamp)
+        if segment != self.segment:
+            self._rotate(segment)
+        for device, groups in data.items():
+            if not isinstance(groups, dict):
+                continue
+            for group, blocks in groups.items():
+                for key, values in blocks.items():
+                    if values:
+                        self._append(timestamp, device, group, key, values)
+        now = time.monotonic()
+        if now >= self.next_flush:
+            # 按周期刷新，而不是每写一行都刷新
+            self.flush()
+            self.next_flush = now + self.flush_seconds
+
+    def flush(self):
+        """Write the buffered samples of the open series to disk."""
+        for series in self.open_series.values():
+            series.flush()
+
+    def close(self):
+        """Close the files of the active segment."""
+        for series in self.series.values():
+            series.close()
+        self.series.clear()
+        self.open_series.clear()
+
+
+class HistoryWriter(threading.Thread):
+    """Record snapshots into a Historian from a thread of its own.
+
+    record() only queues the snapshot, so appending to hundreds of series
+    files never blocks the poll loop. The snapshots must not be modified
+    after they were passed in.
+    """
+
+    def __init__(self, historian, maxsize=DEFAULT_QUEUE_SIZE):
+        """Initialize a new instance.
+
+        :param historian: The Historian to write to, closed with the writer
+        :param maxsize: Snapshots queued before new ones are dropped
+        """
+        super().__init__(name="history", daemon=True)
+        self.historian = historian
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+
+    def record(self, data, timestamp):
+        """Queue a snapshot without blocking; see Historian.record()."""
+        try:
+            self.queue.put_nowait((data, timestamp))
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("History writer is behind, snapshot dropped")
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.historian.record(*item)
+            except (OSError, ValueError, struct.error) as exc:
+                logger.error(f"Could not record history: {exc}")
+        self.historian.close()
+
+    def close(self):
+        """Write the queued snapshots, then close the historian."""
+        self.queue.put(None)
+        self.join()
+
+
+def _segments(path):
+    try:
+        return sorted(int(name) for name in os.listdir(path) if name.isdigit())
+    except FileNotFoundError:
+        return []
+
+
+def _read_sealed_column(base, index):
+    """Return (timestamps, values) of one column of a sealed series."""
+    with open(base + ".c", "rb") as file:
+        magic, version, typecode, width, rows = SEALED_HEADER.unpack(file.read(SEALED_HEADER.size))
+        if magic != SEALED_MAGIC or version != VERSION:
+            raise ValueError(f"{base}.c is not a history series")
+        if index >= width:
+            return array.array("d"), array.array("H")
+        typecode = typecode.decode()
+        itemsize = array.array(typecode).itemsize
+        timestamps = _read_array("d", file.read(rows * 8))
+        file.seek(SEALED_HEADER.size + rows * 8 + index * rows * itemsize)
+        values = _read_array(typecode, file.read(rows * itemsize))
+    return timestamps, values
+
+
+def _read_active_column(base, index):
+    typecode, width, timestamps, values = _load_active(base)
+    if index >= width:
+        return array.array("d"), array.array("H")
+    return timestamps, values[index::width]
+
+
+class HistoryReader:
+    """Range and downsample queries over a history directory."""
+
+    def __init__(self, path="history"):
+        """Initialize a new instance.
+
+        :param path: The history directory
+        """
+        self.path = path
+
+    def _column(self, directory, name, index):
+        base = os.path.join(directory, name)
+        timestamps, values = array.array("d"), []
+        sealed = False
+        if os.path.exists(base + ".c"):
+            timestamps, values = _read_sealed_column(base, index)
+            sealed = True
+        try:
+            active_timestamps, active_values = _read_active_column(base, index)
+        except FileNotFoundError:
+            # 读取期间分段刚好被封存
+            if not sealed and os.path.exists(base + ".c"):
+                return _read_sealed_column(base, index)
+            return timestamps, values
+        except (ValueError, struct.error) as exc:
+            logger.warning(f"Skipping unreadable history series {base}: {exc}")
+            return timestamps, values
+        return timestamps + active_timestamps, list(values) + list(active_values)
+
+    def query(self, device, block, index, start, end, step=0):
+        """Return the samples of one register or bit between start and end.
+
+        :param device: The device name, e.g. slave1
+        :param block: The block path, e.g. monitor/0x10
+        :param index: The register or bit index in the block
+        :param start: Range start, in seconds since the epoch
+        :param end: Range end, in seconds since the epoch
+        :param step: Downsample bucket in seconds, 0 for raw samples
+        :returns: [[time, value]], or [[bucket start, avg, min, max]] with a step
+        """
+        name = series_name(device, block)
+        points = []
+        segments = _segments(self.path)
+        # 分段长度不写入磁盘，用下一个分段的起点作为上界
+        for segment, segment_end in zip(segments, segments[1:] + [None]):
+            if segment > end or (segment_end is not None and segment_end < start):
+                continue
+            timestamps, values = self._column(os.path.join(self.path, str(segment)), name, index)
+            for timestamp, value in zip(timestamps, values):
+                if start <= timestamp <= end:
+                    points.append((timestamp, value))
+        if not step:
+            return [[timestamp, value] for timestamp, value in points]
+        return _downsample(points, start, step)
+
+
+def _downsample(points, start, step):
+    buckets = []
+    current = None
+    for timestamp, value in points:
+        bucket = start + (timestamp - start) // step * step
+        if current is None or current[0] != bucket:
+            current = [bucket, 0, 0, value, value]
+            buckets.append(current)
+        current[1] += value
+        current[2] += 1
+        current[3] = min(current[3], value)
+        current[4] = max(current[4], value)
+    return [[bucket, total / count, low, high] for bucket, total, count, low, high in buckets]
@@ -0,0 +1,385 @@
+"""Live snapshots for the config page, pushed as Server-Sent Events.
+
+The forwarder keeps the latest snapshot in memory. FeedServer sends it
+over a unix socket (config.json "live": {"path": "live.sock"}) every
+"interval" seconds while a reader is connected; app.py's FeedClient
+reads it into a SnapshotHub, which serves the /stream subscribers. The
+client only stays connected while the hub has subscribers, so the
+forwarder encodes nothing when no page is open. In runtime.py the hub is
+fed directly, without the socket.
+
+A subscriber names what it wants with the /stream query parameters:
+
+    device  comma separated devices, e.g. slave1,slave2
+    block   comma separated groups or blocks, e.g. monitor,storage0/0x30
+    start   first index of every block, 0 by default
+    end     index after the last one, the whole block by default
+
+It first gets a "snapshot" event with the selected part of the current
+snapshot, then one "change" event per new snapshot that changed it:
+
+    {"ts": ..., "set": {"slave1": {"monitor/0x10": [[index, value], ...]}},
+     "put": {"slave1": {"monitor/0x10": [...]}}}
+
+Indices in "set" are absolute; the lists in "snapshot" and "put" start at
+`start`. "put" replaces a block that changed length or failed (""), and
+maps a device to "" when it is unreachable or to null once removed.
+
+Every subscriber has a bounded queue of events. A subscriber that does
+not keep up is disconnected instead of delaying the others; the browser's
+EventSource reconnects and starts again from a fresh snapshot.
+"""
+
+__all__ = [
+    "FeedClient",
+    "FeedServer",
+    "SnapshotHub",
+    "Subscription",
+    "diff",
+    "flatten",
+]
+
+import asyncio
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+from framing import encode_message
+
+logger = logging.getLogger(__name__)
+
+#: The socket the forwarder serves the snapshots on
+DEFAULT_PATH = "live.sock"
+
+#: Seconds between two snapshots sent by the forwarder
+DEFAULT_INTERVAL = 0.5
+
+#: Events a subscriber may have queued before it is dropped
+DEFAULT_QUEUE_SIZE = 64
+
+
+def flatten(snapshot):
+    """Return the {"slave1": {"monitor/0x10": [...]}} form of a snapshot.
+
+    :param snapshot: The forwarder's {"slaveN": {"group": {"0xNN": [...]}}} snapshot
+    """
+    flat = {}
+    for device, groups in snapshot.items():
+        if not isinstance(groups, dict):
+            # 设备不可达
+            flat[device] = groups
+            continue
+        flat[device] = {f"{group}/{key}": values
+                        for group, blocks in groups.items() if isinstance(blocks, dict)
+                        for key, values in blocks.items()}
+    return flat
+
+
+def diff(old, new):
+    """Return the ("set", "put") sections turning flat snapshot old into new."""
+    changes = {}
+    puts = {}
+    for device, blocks in new.items():
+        previous = old.get(device)
+        if not isinstance(blocks, dict) or not isinstance(previous, dict):
+            if blocks != previous:
+                puts[device] = blocks
+            continue
+        for block, values in blocks.items():
+            before = previous.get(block)
+            if isinstance(values, list) and isinstance(before, list) and len(values) == len(before):
+                pairs = [[i, v] for i, (p, v) in enumerate(zip(before, values)) if p != v]
+                if pairs:
+                    changes.setdefault(device, {})[block] = pairs
+            elif values != before:
+                puts.setdefault(device, {})[block] = values
+    for device in old:
+        if device not in new:
+            puts[device] = None
+    return changes, puts
+
+
+def _event(name, seq, payload):
+    return f"id: {seq}\nevent: {name}\ndata: {json.dumps(payload)}\n\n"
+
+
+class Subscription:
+    """The filter and the event queue of one /stream client."""
+
+    def __init__(self, devices=None, blocks=None, start=0, end=None, maxsize=DEFAULT_QUEUE_SIZE):
+        """Initialize a new instance.
+
+        :param devices: Device names to receive, all if empty
+        :param blocks: Groups ("monitor") or blocks ("monitor/0x10") to receive, all if empty
+        :param start: First index of every block
+        :param end: Index after the last one, None for the whole block
+        :param maxsize: Events that may be queued before the subscriber is dropped
+        """
+        self.devices = frozenset(devices or ())
+        self.blocks = frozenset(blocks or ())
+        self.start = start
+        self.end = end
+        self.queue = queue.Queue(maxsize)
+        self.closed = False
+        # 过滤条件相同的订阅者共用编码好的事件
+        self.key = (self.devices, self.blocks, start, end)
+
+    def _wants(self, device, block):
+        if self.devices and device not in self.devices:
+            return False
+        return not self.blocks or block in self.blocks or block.split("/", 1)[0] in self.blocks
+
+    def _slice(self, values):
+        return values[self.start:self.end] if isinstance(values, list) else values
+
+    def select(self, flat):
+        """Return the part of a flat snapshot this subscriber asked for."""
+        view = {}
+        for device, blocks in flat.items():
+            if self.devices and device not in self.devices:
+                continue
+            if not isinstance(blocks, dict):
+                view[device] = blocks
+                continue
+            view[device] = {block: self._slice(values) for block, values in blocks.items()
+                            if self._wants(device, block)}
+        return view
+
+    def select_changes(self, changes, puts):
+        """Return the part of diff() this subscriber asked for, or None if there is none."""
+        end = self.end if self.end is not None else float("inf")
+        selected = {}
+        for device, blocks in changes.items():
+            for block, pairs in blocks.items():
+                if self._wants(device, block):
+                    pairs = [pair for pair in pairs if self.start <= pair[0] < end]
+                    if pairs:
+                        selected.setdefault(device, {})[block] = pairs
+        replaced = {}
+        for device, blocks in puts.items():
+            if self.devices and device not in self.devices:
+                continue
+            if not isinstance(blocks, dict):
+                replaced[device] = blocks
+                continue
+            for block, values in blocks.items():
+                if self._wants(device, block):
+                    replaced.setdefault(device, {})[block] = self._slice(values)
+        if not selected and not replaced:
+            return None
+        return {"set": selected, "put": replaced}
+
+    def offer(self, event):
+        """Queue an event; return False if the queue is full."""
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            return False
+        return True
+
+    def next(self, timeout):
+        """Return the next event, or None after `timeout` seconds or once closed."""
+        if self.closed:
+            return None
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class SnapshotHub:
+    """Keep the latest snapshot and push its changes to the subscribers.
+
+    publish() is called by one feeding thread, subscribe() and
+    unsubscribe() by the web server threads.
+    """
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE):
+        """Initialize a new instance.
+
+        :param maxsize: Events a subscriber may have queued before it is dropped
+        """
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+        self.current = None
+        self.timestamp = None
+        self.seq = 0
+        self.dropped = 0
+        # 有订阅者时置位，FeedClient 据此连接或断开
+        self.wanted = threading.Event()
+
+    def subscribe(self, devices=None, blocks=None, start=0, end=None):
+        """Add a subscriber; its first event is the current snapshot, if any.
+
+        :returns: The Subscription, pass it to unsubscribe() when done
+        """
+        subscription = Subscription(devices, blocks, start, end, self.maxsize)
+        with self.lock:
+            self.subscriptions.add(subscription)
+            self.wanted.set()
+            if self.current is not None:
+                subscription.offer(_event("snapshot", self.seq, {
+                    "ts": self.timestamp, "data": subscription.select(self.current)}))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+            if not self.subscriptions:
+                self.wanted.clear()
+
+    def reset(self):
+        """Forget the current snapshot; the next one is sent in full."""
+        with self.lock:
+            self.current = None
+
+    def publish(self, snapshot, timestamp):
+        """Take a new snapshot and queue its changes for every subscriber.
+
+        :param snapshot: The {"slaveN": {"group": {"0xNN": [...]}}} snapshot
+        :param timestamp: The snapshot time, in seconds since the epoch
+        """
+        flat = flatten(snapshot)
+        with self.lock:
+            old, self.current = self.current, flat
+            self.timestamp = timestamp
+            self.seq += 1
+            if not self.subscriptions:
+                return
+            if old is not None:
+                changes, puts = diff(old, flat)
+                if not changes and not puts:
+                    return
+            events = {}
+            for subscription in list(self.subscriptions):
+                if subscription.key not in events:
+                    if old is None:
+                        payload = {"ts": timestamp, "data": subscription.select(flat)}
+                        events[subscription.key] = _event("snapshot", self.seq, payload)
+                    else:
+                        payload = subscription.select_changes(changes, puts)
+                        if payload is not None:
+                            payload["ts"] = timestamp
+                            payload = _event("change", self.seq, payload)
+                        events[subscription.key] = payload
+                event = events[subscription.key]
+                if event is not None and not subscription.offer(event):
+                    # 跟不上的订阅者断开，不拖慢其它订阅者
+                    subscription.closed = True
+                    self.subscriptions.discard(subscription)
+                    self.dropped += 1
+                    logger.warning("Dropped a slow live subscriber")
+            if not self.subscriptions:
+                self.wanted.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"subscribers": len(self.subscriptions), "dropped": self.dropped, "seq": self.seq}
+
+
+class FeedServer:
+    """Send the forwarder's snapshot to the processes reading the unix socket."""
+
+    def __init__(self, path=DEFAULT_PATH, max_buffer=4 << 20):
+        """Initialize a new instance.
+
+        :param path: The socket file
+        :param max_buffer: Unsent bytes after which a reader is disconnected
+        """
+        self.path = path
+        self.max_buffer = max_buffer
+        self.server = None
+        self.writers = set()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # 上次运行留下的套接字文件
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._serve, self.path)
+        logger.info(f"Live feed on {self.path}")
+
+    async def _serve(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def publish(self, data, timestamp):
+        """Send a snapshot to every reader; nothing is encoded without readers."""
+        if not self.writers:
+            return
+        message = encode_message({"ts": timestamp, "data": data})
+        for writer in list(self.writers):
+            if writer.transport.get_write_buffer_size() > self.max_buffer:
+                logger.warning("Live feed reader too slow, disconnecting it")
+                self.writers.discard(writer)
+                writer.close()
+                continue
+            writer.write(message)
+
+    def close(self):
+        if self.server is None:
+            return
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        self.writers.clear()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class FeedClient(threading.Thread):
+    """Read the forwarder's snapshots from the unix socket into a SnapshotHub.
+
+    Connected only while the hub has subscribers.
+    """
+
+    def __init__(self, path, hub, retry=1):
+        """Initialize a new instance.
+
+        :param path: The socket file of the forwarder
+        :param hub: The SnapshotHub to publish to
+        :param retry: Seconds between two connection attempts
+        """
+        super().__init__(name="live-feed", daemon=True)
+        self.path = path
+        self.hub = hub
+        self.retry = retry
+
+    def run(self):
+        warned = False
+        while True:
+            self.hub.wanted.wait()
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(self.path)
+                    logger.info(f"Live feed connected to {self.path}")
+                    warned = False
+                    for line in sock.makefile("rb"):
+                        message = json.loads(line)
+                        self.hub.publish(message["data"], message["ts"])
+                        if not self.hub.wanted.is_set():
+                            # 最后一个订阅者已离开，断开后转发服务不再编码快照
+                            logger.info(f"Live feed disconnected from {self.path}")
+                            break
+            except (OSError, ValueError, KeyError) as exc:
+                # 转发服务未运行时只提示一次
+                if not warned:
+                    logger.warning(f"Live feed {self.path} unavailable: {exc}")
+                    warned = True
+            # 下次连接后先发送完整快照
+            self.hub.reset()
+            if self.hub.wanted.is_set():
+                time.sleep(self.retry)
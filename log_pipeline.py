@@ -0,0 +1,190 @@
+"""Non-blocking logging shared by the services.
+
+Log calls only put the record on a bounded queue; a listener thread
+formats and writes it. A slow console, SD card or journald then delays
+the listener, not the poll cycle. When the queue is full the record is
+dropped and counted (s2c2s_log_dropped_total), and a warning with the
+number of lost records is logged once there is room again.
+
+Levels are set per category, i.e. per logger name, in config.json:
+
+    "logging": {
+        "level": "INFO",
+        "levels": {"pymodbus": "WARNING", "frames": "DEBUG", "uplink": "DEBUG"},
+        "queueSize": 10000,
+        "frameRate": 10,
+        "frameSample": 1
+    }
+
+Hex dumps of Modbus frames go to the "frames" category through
+dump_frame(). They are off unless "frames" is at DEBUG, and then only
+every frameSample-th frame is dumped, at most frameRate per second; the
+others are counted in s2c2s_log_frames_suppressed_total.
+"""
+
+__all__ = [
+    "FRAMES",
+    "dump_frame",
+    "setup",
+    "shutdown",
+]
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+from metrics import REGISTRY
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+DEFAULT_LEVELS = {
+    # pymodbus 在 DEBUG 下每帧都会输出十六进制，默认关闭
+    "pymodbus": "WARNING",
+    "frames": "WARNING",
+}
+
+LOG_DROPPED = REGISTRY.counter("s2c2s_log_dropped_total", "Log records dropped because the queue was full", ("level",))
+FRAMES_SUPPRESSED = REGISTRY.counter("s2c2s_log_frames_suppressed_total", "Frame dumps skipped by sampling or rate limit")
+
+# 队列满时丢弃记录，最多每秒报告一次丢弃数量
+DROP_REPORT_INTERVAL = 1
+
+frame_logger = logging.getLogger("frames")
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that drops records instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.lock_dropped = threading.Lock()
+        self.dropped = 0
+        self.reported = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.labels(record.levelname).inc()
+            with self.lock_dropped:
+                self.dropped += 1
+            return
+        if self.dropped and time.monotonic() - self.reported >= DROP_REPORT_INTERVAL:
+            with self.lock_dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.reported = time.monotonic()
+            if dropped:
+                notice = logging.LogRecord("log_pipeline", logging.WARNING, __file__, 0,
+                                           f"{dropped} log records dropped, queue full", None, None)
+                try:
+                    self.queue.put_nowait(notice)
+                except queue.Full:
+                    with self.lock_dropped:
+                        self.dropped += dropped
+
+
+class FrameSampler:
+    """Decide which frames are dumped: every n-th one, at most `rate` per second."""
+
+    def __init__(self, rate=10, every=1):
+        """Initialize a new instance.
+
+        :param rate: Max dumps per second, 0 for no limit
+        :param every: Dump one frame out of this many
+        """
+        self.rate = rate
+        self.every = max(1, every)
+        self.enabled = False
+        self.count = 0
+        self.tokens = rate
+        self.refilled = time.monotonic()
+
+    def sample(self):
+        """Return True if the current frame should be dumped."""
+        if not self.enabled:
+            return False
+        self.count += 1
+        if self.count % self.every:
+            FRAMES_SUPPRESSED.labels().inc()
+            return False
+        if self.rate:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                FRAMES_SUPPRESSED.labels().inc()
+                return False
+            self.tokens -= 1
+        return True
+
+
+#: The frame sampler of this process, configured by setup()
+FRAMES = FrameSampler()
+
+_listener = None
+
+
+def dump_frame(direction, peer, frame):
+    """Log a hex dump of a frame if the sampler lets it through.
+
+    :param direction: "in" or "out"
+    :param peer: The device or cloud address
+    :param frame: The bytes, or a callable returning them, called only if dumped
+    """
+    if not FRAMES.sample():
+        return
+    if callable(frame):
+        frame = frame()
+    frame_logger.debug("%s %s %s", direction, peer, frame.hex(" "))
+
+
+def setup(config, service):
+    """Route every log record of this process through the queue.
+
+    Call once at startup of each process, including the shard workers:
+    they are started with spawn and inherit no logging setup.
+
+    :param config: The config dict, "logging" section optional
+    :param service: The service name, logged once at startup
+    :returns: The QueueListener
+    """
+    global _listener
+    options = (config or {}).get("logging", {})
+    shutdown()
+    log_queue = queue.Queue(options.get("queueSize", 10000))
+    console_handler = logging.StreamHandler(sys.stderr)
+    console_handler.setFormatter(logging.Formatter(FORMAT))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DroppingQueueHandler(log_queue))
+    root.setLevel(options.get("level", "INFO"))
+    for name, level in dict(DEFAULT_LEVELS, **options.get("levels", {})).items():
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        # 去掉库自带的处理器（如 pymodbus_apply_logging_config 添加的），统一走队列
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+    FRAMES.rate = options.get("frameRate", 10)
+    FRAMES.every = max(1, options.get("frameSample", 1))
+    FRAMES.tokens = FRAMES.rate
+    FRAMES.enabled = frame_logger.isEnabledFor(logging.DEBUG)
+    _listener = logging.handlers.QueueListener(log_queue, console_handler)
+    _listener.start()
+    # 退出时写完队列中剩余的记录
+    atexit.unregister(shutdown)
+    atexit.register(shutdown)
+    logging.getLogger("log_pipeline").info(f"{service} logging at {logging.getLevelName(root.level)}")
+    return _listener
+
+
+def shutdown():
+    """Stop the listener after writing the queued records."""
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
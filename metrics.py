@@ -0,0 +1,236 @@
+"""In-process metrics with Prometheus text rendering.
+
+Services record into counters, gauges and fixed-bucket histograms. A
+metric family is looked up once per label set; recording is then a
+bisect and two additions, a few hundred nanoseconds, so it stays on in
+production (see benchmarks/bench_metrics.py).
+
+Each service process dumps its registry as JSON into the metrics
+directory (<path>/<service>.json) every cycle; the config app merges
+these files and serves them in the Prometheus text format with a
+`service` label. Updates are not locked: under thread contention an
+increment may occasionally be lost, which is fine for monitoring.
+"""
+
+__all__ = [
+    "DEFAULT_BUCKETS",
+    "REGISTRY",
+    "Registry",
+    "render",
+    "render_directory",
+]
+
+import bisect
+import json
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+#: Latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    """A monotonically increasing count."""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        """Set the total of a count kept elsewhere, e.g. scheduler overruns."""
+        self.value = value
+
+    def state(self):
+        return self.value
+
+
+class Gauge(Counter):
+    """A value that goes up and down."""
+
+    __slots__ = ()
+
+
+class Histogram:
+    """Counts of observations per bucket, plus their sum."""
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # the last slot is the +Inf bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def state(self):
+        return {"counts": list(self.counts), "sum": self.sum}
+
+
+class Family:
+    """A metric name with one child per label set."""
+
+    def __init__(self, name, kind, documentation, labelnames, factory, buckets=None):
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.buckets = buckets
+        self.children = {}
+
+    def labels(self, *values):
+        """Return the child of a label set, in labelnames order."""
+        child = self.children.get(values)
+        if child is None:
+            child = self.factory()
+            self.children[values] = child
+        return child
+
+    def snapshot(self):
+        snapshot = {
+            "type": self.kind,
+            "help": self.documentation,
+            "labels": list(self.labelnames),
+            "samples": [[list(values), child.state()] for values, child in list(self.children.items())],
+        }
+        if self.buckets is not None:
+            snapshot["buckets"] = list(self.buckets)
+        return snapshot
+
+
+class Registry:
+    """The metric families of one process."""
+
+    def __init__(self):
+        self.families = {}
+
+    def _family(self, name, kind, documentation, labelnames, factory, buckets=None):
+        family = self.families.get(name)
+        if family is None:
+            family = Family(name, kind, documentation, labelnames, factory, buckets)
+            self.families[name] = family
+        elif family.kind != kind:
+            raise ValueError(f"Metric {name} is already a {family.kind}")
+        return family
+
+    def counter(self, name, documentation, labelnames=()):
+        """Return the counter family of a name, creating it on first use."""
+        return self._family(name, "counter", documentation, labelnames, Counter)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """Return the gauge family of a name, creating it on first use."""
+        return self._family(name, "gauge", documentation, labelnames, Gauge)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Return the histogram family of a name, creating it on first use."""
+        buckets = tuple(buckets)
+        return self._family(name, "histogram", documentation, labelnames,
+                            lambda: Histogram(buckets), buckets)
+
+    def snapshot(self):
+        """Return every family as a JSON serialisable dict."""
+        return {name: family.snapshot() for name, family in list(self.families.items())}
+
+    def dump(self, path, service):
+        """Write the registry to <path>/<service>.json for the config app.
+
+        :param path: The metrics directory
+        :param service: The service name, used as the `service` label
+        """
+        try:
+            os.makedirs(path, exist_ok=True)
+            target = os.path.join(path, service + ".json")
+            with open(target + ".tmp", "w") as file:
+                json.dump({"service": service, "families": self.snapshot()}, file)
+            os.replace(target + ".tmp", target)
+        except OSError as exc:
+            logger.warning(f"Could not write metrics of {service}: {exc}")
+
+
+#: The registry shared by the modules of a process
+REGISTRY = Registry()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(dumps):
+    """Render registry dumps in the Prometheus text format.
+
+    Families of the same name from several services are merged under one
+    HELP/TYPE header, each sample labelled with its service.
+
+    :param dumps: A list of {"service": ..., "families": ...} dicts
+    :returns: The exposition text
+    """
+    merged = {}
+    for dump in dumps:
+        for name, family in dump["families"].items():
+            entry = merged.setdefault(name, (family, []))
+            if entry[0]["type"] != family["type"]:
+                logger.warning(f"Metric {name} of {dump['service']} has another type, skipped")
+                continue
+            entry[1].append((dump["service"], family))
+    lines = []
+    for name in sorted(merged):
+        header, families = merged[name]
+        lines.append(f"# HELP {name} {header['help']}")
+        lines.append(f"# TYPE {name} {header['type']}")
+        for service, family in families:
+            service_label = (("service", service),)
+            for values, state in family["samples"]:
+                if family["type"] != "histogram":
+                    lines.append(f"{name}{_labels(family['labels'], values, service_label)} {_number(state)}")
+                    continue
+                cumulative = 0
+                bounds = family["buckets"] + [math.inf]
+                for bound, count in zip(bounds, state["counts"]):
+                    cumulative += count
+                    bucket_labels = service_label + (("le", _number(bound)),)
+                    lines.append(f"{name}_bucket{_labels(family['labels'], values, bucket_labels)} {cumulative}")
+                labels = _labels(family["labels"], values, service_label)
+                lines.append(f"{name}_sum{labels} {_number(state['sum'])}")
+                lines.append(f"{name}_count{labels} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def render_directory(path):
+    """Render every service dump found in a metrics directory."""
+    dumps = []
+    try:
+        names = sorted(os.listdir(path))
+    except FileNotFoundError:
+        names = []
+    for file_name in names:
+        if not file_name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(path, file_name), "r") as file:
+                dumps.append(json.load(file))
+        except (OSError, ValueError) as exc:
+            logger.warning(f"Skipping metrics file {file_name}: {exc}")
+    return render(dumps)
@@ -0,0 +1,299 @@
+"""Long-lived Modbus TCP connection pools.
+
+Connections are keyed by device ip/port and kept open across poll cycles,
+so a PLC only sees a new handshake when the previous socket really died.
+Several slave units behind the same ip share one connection.
+"""
+
+__all__ = [
+    "ExponentialBackoff",
+    "ModbusConnectionPool",
+    "TcpMasterPool",
+    "device_key",
+]
+
+import asyncio
+import logging
+import time
+
+import pymodbus.client as ModbusClient
+
+from avc_bit_read_message import AvcReadDiscreteInputsResponse
+from avc_register_read_message import AvcReadHoldingRegistersResponse
+from pipeline import PipelinedModbusClient
+
+logger = logging.getLogger(__name__)
+
+
+def device_key(device):
+    """Return the pool key of a device config entry.
+
+    :param device: A device entry from config.json
+    :returns: "ip:port"
+    """
+    return f"{device['ip']}:{device.get('port', 502)}"
+
+
+class ExponentialBackoff:
+    """Track when the next reconnect attempt is allowed."""
+
+    def __init__(self, initial=1, maximum=60, factor=2):
+        """Initialize a new instance.
+
+        :param initial: Delay after the first failure, in seconds
+        :param maximum: Upper bound of the delay, in seconds
+        :param factor: Growth factor applied after each failure
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.failures = 0
+        self.delay = 0
+        self.next_attempt = 0
+
+    def ready(self):
+        """Return True if a connection attempt may be made now."""
+        return time.monotonic() >= self.next_attempt
+
+    def failure(self):
+        """Record a failed attempt and push the next one out."""
+        self.failures += 1
+        if self.delay:
+            self.delay = min(self.delay * self.factor, self.maximum)
+        else:
+            self.delay = self.initial
+        self.next_attempt = time.monotonic() + self.delay
+
+    def success(self):
+        """Reset after a successful attempt."""
+        self.failures = 0
+        self.delay = 0
+        self.next_attempt = 0
+
+
+class PooledConnection:
+    """A pooled client together with its usage counters."""
+
+    def __init__(self, key, client, concurrency, backoff):
+        """Initialize a new instance.
+
+        :param key: The pool key ("ip:port")
+        :param client: The underlying Modbus client
+        :param concurrency: Max requests in flight on this connection
+        :param backoff: The reconnect backoff of this connection
+        """
+        self.key = key
+        self.client = client
+        self.limiter = asyncio.Semaphore(concurrency) if concurrency else None
+        # 共用同一 ip:port 的多个从站可能同时发现连接断开，只由一个去重连
+        self.lock = asyncio.Lock()
+        self.backoff = backoff
+        self.connects = 0
+        self.reconnects = 0
+        self.reuses = 0
+        self.failures = 0
+        self.last_used = 0
+
+    def stats(self):
+        """Return the counters as a dict."""
+        stats = {
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "reuses": self.reuses,
+            "failures": self.failures,
+            "backoff": self.backoff.delay,
+        }
+        if isinstance(self.client, PipelinedModbusClient):
+            stats["pipeline"] = self.client.stats()
+        return stats
+
+
+class ModbusConnectionPool:
+    """Pool of pymodbus AsyncModbusTcpClient connections.
+
+    The custom AVC response decoders are registered once, when a client is
+    created, instead of on every poll cycle.
+    """
+
+    def __init__(self, timeout=3, backoff_initial=1, backoff_max=60, concurrency=4, pipeline=0):
+        """Initialize a new instance.
+
+        :param timeout: Connect/request timeout of each client, in seconds
+        :param backoff_initial: First reconnect delay, in seconds
+        :param backoff_max: Largest reconnect delay, in seconds
+        :param concurrency: Default max requests in flight per device
+        :param pipeline: Default pipeline depth, 0 for the pymodbus client
+        """
+        self.timeout = timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.concurrency = concurrency
+        self.pipeline = pipeline
+        self.connections = {}
+
+    def _create(self, key, device):
+        depth = device.get("pipeline") or self.pipeline
+        if depth:
+            # 流水线模式：同一连接上保持多个未完成的事务
+            client = PipelinedModbusClient(
+                host=device["ip"],
+                port=device.get("port", 502),
+                depth=depth,
+                timeout=device.get("timeout", self.timeout),
+            )
+        else:
+            client = ModbusClient.AsyncModbusTcpClient(
+                host=device["ip"],
+                port=device.get("port", 502),
+                timeout=device.get("timeout", self.timeout),
+                # reconnects are driven by the pool, not by pymodbus
+                reconnect_delay=0,
+            )
+        client.register(AvcReadDiscreteInputsResponse)
+        client.register(AvcReadHoldingRegistersResponse)
+        backoff = ExponentialBackoff(self.backoff_initial, self.backoff_max)
+        concurrency = device.get("concurrency", depth or self.concurrency)
+        return PooledConnection(key, client, concurrency, backoff)
+
+    def is_healthy(self, connection):
+        """Health check: the transport is still up."""
+        return connection.client.connected
+
+    async def acquire(self, device):
+        """Return a connected PooledConnection for the device.
+
+        :param device: A device entry from config.json
+        :raises ConnectionError: if the device is unreachable or still backing off
+        """
+        key = device_key(device)
+        connection = self.connections.get(key)
+        if connection is None:
+            connection = self._create(key, device)
+            self.connections[key] = connection
+        connection.last_used = time.monotonic()
+        if self.is_healthy(connection):
+            connection.reuses += 1
+            return connection
+        async with connection.lock:
+            # 等锁期间可能已由别的请求重连好
+            if self.is_healthy(connection):
+                connection.reuses += 1
+                return connection
+            if not connection.backoff.ready():
+                raise ConnectionError(f"{key} backing off for {connection.backoff.delay}s")
+            if connection.connects:
+                connection.reconnects += 1
+                logger.info(f"Reconnecting to {key}")
+            connection.connects += 1
+            connection.client.close()
+            if not await connection.client.connect():
+                connection.failures += 1
+                connection.backoff.failure()
+                raise ConnectionError(f"cannot connect to {key}")
+            connection.backoff.success()
+            return connection
+
+    def discard(self, device):
+        """Close a connection that is known to be broken.
+
+        :param device: A device entry from config.json
+        """
+        connection = self.connections.get(device_key(device))
+        if connection is not None:
+            connection.failures += 1
+            connection.client.close()
+
+    def remove(self, device):
+        """Close and forget the connection of a device.
+
+        :param device: A device entry from config.json
+        """
+        connection = self.connections.pop(device_key(device), None)
+        if connection is not None:
+            connection.client.close()
+
+    def stats(self):
+        """Return the usage counters of every connection, keyed by "ip:port"."""
+        return {key: connection.stats() for key, connection in self.connections.items()}
+
+    def close(self):
+        """Close every pooled connection."""
+        for connection in self.connections.values():
+            connection.client.close()
+        self.connections.clear()
+
+
+class TcpMasterPool:
+    """Pool of modbus_tk TcpMaster connections for the synchronous forwarder."""
+
+    def __init__(self, factory, timeout=3, backoff_initial=1, backoff_max=60):
+        """Initialize a new instance.
+
+        :param factory: Callable(host, port) returning a new TcpMaster
+        :param timeout: Socket timeout of each master, in seconds
+        :param backoff_initial: First reconnect delay, in seconds
+        :param backoff_max: Largest reconnect delay, in seconds
+        """
+        self.factory = factory
+        self.timeout = timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.connections = {}
+
+    def acquire(self, device):
+        """Return an opened PooledConnection for the device.
+
+        :param device: A device entry from config.json
+        :raises ConnectionError: if the device is unreachable or still backing off
+        """
+        key = device_key(device)
+        connection = self.connections.get(key)
+        if connection is not None and connection.client is not None:
+            connection.reuses += 1
+            connection.last_used = time.monotonic()
+            return connection
+        if connection is None:
+            backoff = ExponentialBackoff(self.backoff_initial, self.backoff_max)
+            connection = PooledConnection(key, None, 0, backoff)
+            self.connections[key] = connection
+        if not connection.backoff.ready():
+            raise ConnectionError(f"{key} backing off for {connection.backoff.delay}s")
+        if connection.connects:
+            connection.reconnects += 1
+            logger.info(f"Reconnecting to {key}")
+        connection.connects += 1
+        try:
+            master = self.factory(device["ip"], device.get("port", 502))
+            master.set_timeout(device.get("timeout", self.timeout))
+            master.open()
+        except Exception as exc:
+            connection.failures += 1
+            connection.backoff.failure()
+            raise ConnectionError(f"cannot connect to {key}: {exc}") from exc
+        connection.client = master
+        connection.backoff.success()
+        connection.last_used = time.monotonic()
+        return connection
+
+    def discard(self, device):
+        """Close a connection that is known to be broken.
+
+        :param device: A device entry from config.json
+        """
+        connection = self.connections.get(device_key(device))
+        if connection is not None and connection.client is not None:
+            connection.failures += 1
+            connection.backoff.failure()
+            connection.client.close()
+            connection.client = None
+
+    def stats(self):
+        """Return the usage counters of every connection, keyed by "ip:port"."""
+        return {key: connection.stats() for key, connection in self.connections.items()}
+
+    def close(self):
+        """Close every pooled connection."""
+        for connection in self.connections.values():
+            if connection.client is not None:
+                connection.client.close()
+        self.connections.clear()
@@ -0,0 +1,230 @@
+"""Pipelined Modbus TCP client.
+
+Keeps up to `depth` requests in flight on one socket and matches the
+responses by MBAP transaction id, instead of waiting for each response
+before sending the next request. Every transaction has its own timeout;
+a late answer to a timed out transaction is discarded.
+
+The client speaks pymodbus PDUs, so the existing AvcRead*Request and
+AvcRead*Response classes work unchanged. execute_raw() passes a ready
+MBAP frame through, so gateway commands can share the connection the
+poller uses.
+"""
+
+__all__ = [
+    "PipelinedModbusClient",
+    "validate_frame",
+]
+
+import asyncio
+import logging
+import struct
+
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+from pymodbus.factory import ClientDecoder
+
+logger = logging.getLogger(__name__)
+
+# Transaction id, protocol id, length, unit id
+MBAP = struct.Struct(">HHHB")
+
+
+def validate_frame(frame):
+    """Check that a frame is one complete Modbus TCP request.
+
+    :param frame: The MBAP frame
+    :raises ValueError: if it has no function code, a protocol id other
+                        than 0 or a length field not matching its size
+    """
+    if len(frame) < MBAP.size + 1:
+        raise ValueError(f"frame of {len(frame)} bytes is too short")
+    _, protocol, length, _ = MBAP.unpack_from(frame)
+    if protocol != 0:
+        raise ValueError(f"protocol id {protocol} is not Modbus")
+    if len(frame) != 6 + length:
+        raise ValueError(f"length field {length} does not match a frame of {len(frame)} bytes")
+
+
+class PipelinedModbusClient(asyncio.Protocol):
+    """Modbus TCP client with several transactions in flight on one connection."""
+
+    def __init__(self, host, port=502, depth=1, timeout=3):
+        """Initialize a new instance.
+
+        :param host: Device ip
+        :param port: Device port
+        :param depth: Max number of requests in flight, 1 disables pipelining
+        :param timeout: Connect and per-transaction timeout, in seconds
+        """
+        self.host = host
+        self.port = port
+        self.depth = depth
+        self.timeout = timeout
+        self.decoder = ClientDecoder()
+        self.transport = None
+        self.buffer = bytearray()
+        self.pending = {}
+        # 透传请求：本连接的事务号 -> 原始事务号
+        self.raw = {}
+        self.window = asyncio.Semaphore(depth)
+        self.next_tid = 0
+        self.sent = 0
+        self.timeouts = 0
+        self.late = 0
+
+    @property
+    def connected(self):
+        """Return state of connection."""
+        return self.transport is not None and not self.transport.is_closing()
+
+    def register(self, custom_response_class):
+        """Register a custom response class with the decoder.
+
+        :param custom_response_class: Modbus response class
+        """
+        self.decoder.register(custom_response_class)
+
+    async def connect(self):
+        """Connect to the device.
+
+        :returns: True if connected
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(
+                loop.create_connection(lambda: self, self.host, self.port),
+                timeout=self.timeout,
+            )
+        except (OSError, asyncio.TimeoutError) as exc:
+            logger.warning(f"Failed to connect {self.host}:{self.port}: {exc}")
+            return False
+        return True
+
+    def close(self):
+        """Close the connection and fail every pending transaction."""
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self._fail_pending(ConnectionException(f"{self.host}:{self.port} closed"))
+
+    def stats(self):
+        """Return the pipeline counters as a dict."""
+        return {
+            "depth": self.depth,
+            "inflight": len(self.pending),
+            "sent": self.sent,
+            "timeouts": self.timeouts,
+            "late": self.late,
+        }
+
+    def _allocate_tid(self):
+        while True:
+            self.next_tid = (self.next_tid % 0xFFFF) + 1
+            if self.next_tid not in self.pending:
+                return self.next_tid
+
+    async def execute(self, request):
+        """Send a request and wait for its response.
+
+        :param request: A pymodbus request PDU
+        :returns: The decoded response
+        :raises ConnectionException: if not connected or the connection dropped
+        :raises ModbusIOException: if the transaction timed out
+        """
+        async with self.window:
+            if not self.connected:
+                raise ConnectionException(f"Not connected[{self.host}:{self.port}]")
+            tid = self._allocate_tid()
+            request.transaction_id = tid
+            pdu = struct.pack(">B", request.function_code) + request.encode()
+            future = asyncio.get_running_loop().create_future()
+            self.pending[tid] = future
+            self.transport.write(MBAP.pack(tid, 0, len(pdu) + 1, request.slave_id) + pdu)
+            self.sent += 1
+            try:
+                return await asyncio.wait_for(future, timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise ModbusIOException(f"transaction {tid} timed out after {self.timeout}s")
+            finally:
+                self.pending.pop(tid, None)
+
+    async def execute_raw(self, frame):
+        """Send a complete MBAP frame and return the response frame.
+
+        The frame gets a transaction id of this connection on the wire;
+        the response carries the frame's original transaction id again.
+
+        :param frame: A Modbus TCP request frame
+        :returns: The response frame
+        :raises ValueError: if the frame is not a complete request, see validate_frame()
+        :raises ConnectionException: if not connected or the connection dropped
+        :raises ModbusIOException: if the transaction timed out
+        """
+        validate_frame(frame)
+        original, protocol, length, unit = MBAP.unpack_from(frame)
+        async with self.window:
+            if not self.connected:
+                raise ConnectionException(f"Not connected[{self.host}:{self.port}]")
+            tid = self._allocate_tid()
+            future = asyncio.get_running_loop().create_future()
+            self.pending[tid] = future
+            self.raw[tid] = original
+            self.transport.write(MBAP.pack(tid, protocol, length, unit) + frame[MBAP.size:])
+            self.sent += 1
+            try:
+                return await asyncio.wait_for(future, timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise ModbusIOException(f"transaction {tid} timed out after {self.timeout}s")
+            finally:
+                self.pending.pop(tid, None)
+                self.raw.pop(tid, None)
+
+    def _fail_pending(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self.pending.clear()
+        self.raw.clear()
+
+    def connection_made(self, transport):
+        """Call when the connection is established."""
+        self.transport = transport
+        self.buffer.clear()
+
+    def connection_lost(self, exc):
+        """Call when the connection is lost."""
+        self.transport = None
+        self._fail_pending(ConnectionException(f"{self.host}:{self.port} lost: {exc}"))
+
+    def data_received(self, data):
+        """Split the stream into MBAP frames and resolve their transactions."""
+        self.buffer += data
+        while len(self.buffer) >= MBAP.size:
+            tid, _, length, unit = MBAP.unpack_from(self.buffer)
+            end = 6 + length
+            if len(self.buffer) < end:
+                break
+            pdu = bytes(self.buffer[MBAP.size:end])
+            del self.buffer[:end]
+            future = self.pending.get(tid)
+            if future is None or future.done():
+                self.late += 1
+                logger.debug(f"Discard response to unknown transaction {tid}")
+                continue
+            original = self.raw.get(tid)
+            if original is not None:
+                future.set_result(MBAP.pack(original, 0, length, unit) + pdu)
+                continue
+            try:
+                response = self.decoder.decode(pdu)
+            except Exception as exc:
+                future.set_exception(ModbusIOException(f"cannot decode response: {exc}"))
+                continue
+            if response is None:
+                future.set_exception(ModbusIOException(f"cannot decode response {pdu.hex()}"))
+                continue
+            response.transaction_id = tid
+            response.slave_id = unit
+            future.set_result(response)
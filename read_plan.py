@@ -0,0 +1,177 @@
+"""Read-plan compiler for Modbus address blocks.
+
+The forwarders declare what they want to read as named blocks. The
+compiler coalesces adjacent, overlapping or nearly adjacent blocks of the
+same kind into the fewest legal requests (at most 125 registers or 2000
+bits each), and splits the responses back into the per-block structure.
+
+How much this saves depends on the layout. forwarder1's 127 blocks fold
+into 4 requests only because every machine, storage and monitor group
+reads the same addresses (bits at 10, registers at 30), so the blocks of
+a kind all overlap; blocks at distinct addresses still need a request
+per gap wider than "readGap".
+"""
+
+__all__ = [
+    "BITS",
+    "REGISTERS",
+    "Block",
+    "ReadPlan",
+    "ReadRequest",
+    "compile_plan",
+]
+
+import collections
+import functools
+
+#: Discrete inputs / coils, read in units of bits
+BITS = "bits"
+#: Holding / input registers, read in units of 16 bit words
+REGISTERS = "registers"
+
+#: Largest quantity one request may ask for, per kind (Modbus application protocol 6.2/6.3)
+MAX_COUNT = {BITS: 2000, REGISTERS: 125}
+
+#: A declared block, e.g. Block("machine0", "0x30", REGISTERS, 30, 285)
+Block = collections.namedtuple("Block", "group key kind address count")
+
+
+class ReadRequest:
+    """One request of a compiled plan.
+
+    .segments lists (block, request_offset, block_offset, length) tuples telling
+    which part of the response belongs to which block.
+    """
+
+    def __init__(self, kind, address, count):
+        """Initialize a new instance.
+
+        :param kind: BITS or REGISTERS
+        :param address: The start address of the request
+        :param count: The number of bits/registers to read
+        """
+        self.kind = kind
+        self.address = address
+        self.count = count
+        self.segments = []
+
+    def __str__(self):
+        """Return a string representation of the instance.
+
+        :returns: A string representation of the instance
+        """
+        return f"ReadRequest({self.kind},{self.address},{self.count})"
+
+
+class ReadPlan:
+    """A compiled, immutable list of requests covering a set of blocks."""
+
+    def __init__(self, blocks, requests, gap):
+        """Initialize a new instance.
+
+        :param blocks: The declared blocks
+        :param requests: The compiled ReadRequest list
+        :param gap: The gap tolerance the plan was compiled with
+        """
+        self.blocks = blocks
+        self.requests = requests
+        self.gap = gap
+
+    def __len__(self):
+        """Return the number of round trips of the plan."""
+        return len(self.requests)
+
+    def split(self, results):
+        """Split request results back into {group: {key: values}}.
+
+        A block whose data is (partly) missing gets "" like a failed read.
+
+        :param results: One value sequence (or None on error) per request, in plan order
+        :returns: The per-block data
+        """
+        parts = {block: [] for block in self.blocks}
+        failed = set()
+        for request, values in zip(self.requests, results):
+            for block, request_offset, block_offset, length in request.segments:
+                if values is None or len(values) < request_offset + length:
+                    failed.add(block)
+                else:
+                    parts[block].append((block_offset, values[request_offset:request_offset + length]))
+        data = {}
+        for block in self.blocks:
+            group = data.setdefault(block.group, {})
+            if block in failed:
+                group[block.key] = ""
+                continue
+            values = []
+            for _, chunk in sorted(parts[block], key=lambda part: part[0]):
+                values.extend(chunk)
+            group[block.key] = values
+        return data
+
+    def __str__(self):
+        """Return a printable description of the plan.
+
+        :returns: A string representation of the instance
+        """
+        lines = [f"ReadPlan: {len(self.blocks)} blocks -> {len(self.requests)} requests (gap={self.gap})"]
+        for request in self.requests:
+            names = ", ".join(
+                f"{block.group}/{block.key}[{block_offset}:{block_offset + length}]"
+                for block, _, block_offset, length in request.segments
+            )
+            lines.append(f"  {request}: {names}")
+        return "\n".join(lines)
+
+
+def _union(blocks):
+    """Merge the intervals of blocks into sorted, disjoint [start, end) ranges."""
+    ranges = []
+    for block in sorted(blocks, key=lambda block: block.address):
+        start, end = block.address, block.address + block.count
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def _chunks(ranges, gap, limit):
+    """Cover the ranges with the fewest [start, end) chunks of at most limit items.
+
+    Ranges closer than gap are read together, the unused items in between
+    are simply discarded.
+    """
+    chunks = []
+    for start, end in ranges:
+        while start < end:
+            if chunks and start - chunks[-1][1] <= gap and start < chunks[-1][0] + limit:
+                chunks[-1][1] = min(end, chunks[-1][0] + limit)
+            else:
+                chunks.append([start, min(end, start + limit)])
+            start = chunks[-1][1]
+    return chunks
+
+
+@functools.lru_cache(maxsize=32)
+def compile_plan(blocks, gap=0):
+    """Compile declared blocks into the fewest legal read requests.
+
+    Plans are cached, compiling the same blocks again is free.
+
+    :param blocks: A tuple of Block
+    :param gap: Max number of unused bits/registers read to merge two blocks
+    :returns: A ReadPlan
+    """
+    requests = []
+    for kind in (BITS, REGISTERS):
+        members = [block for block in blocks if block.kind == kind]
+        for start, end in _chunks(_union(members), gap, MAX_COUNT[kind]):
+            request = ReadRequest(kind, start, end - start)
+            for block in members:
+                low = max(start, block.address)
+                high = min(end, block.address + block.count)
+                if low < high:
+                    request.segments.append((block, low - start, low - block.address, high - low))
+            requests.append(request)
+    return ReadPlan(blocks, requests, gap)
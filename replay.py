@@ -0,0 +1,384 @@
+"""Replay a traffic trace against the forwarder or gateway code.
+
+A trace recorded with config.json "trace" (see traffic_trace.py) is
+played back through the same functions the services run: the forwarder's
+poll_devices() and forward_data(), or the gateway's forward paths fed
+with the recorded cloud commands. The devices are replaced by replay
+servers in a child process that answer each request with the response
+recorded for the same bytes, after the recorded delay, on one loopback
+address per recorded device (127.0.0.2, 127.0.0.3, ...). Requests that
+timed out in the trace are left unanswered again; requests the trace
+never saw get a "gateway target failed to respond" exception.
+
+    python replay.py traces/forwarder-20240601-120000.s2t
+    python replay.py TRACE --speed 0 --allocations --output new.json --baseline old.json
+
+--speed 1 keeps the recorded timing, 0 replays as fast as possible.
+The report lists cycle times, wall and CPU time and, with --allocations,
+the peak memory traced by tracemalloc; --baseline shows the change
+against the JSON result of an earlier build.
+"""
+
+__all__ = [
+    "build_answers",
+    "replay",
+]
+
+import argparse
+import asyncio
+import collections
+import functools
+import json
+import logging
+import multiprocessing
+import statistics
+import struct
+import time
+import tracemalloc
+
+import forwarder
+import gateway
+import traffic_trace
+from framing import FramingError, JsonStreamDecoder
+
+logger = logging.getLogger(__name__)
+
+MBAP = struct.Struct(">HHHB")
+
+# Modbus 异常码 0x0B：网关目标设备无响应
+TARGET_FAILED = 0x0B
+
+
+def build_answers(records):
+    """Pair the recorded requests with their outcome.
+
+    The delay is the device's own service time: a device answers one
+    request after the other, so time a request spent queued behind the
+    previous answer of the same device is not counted again on replay.
+
+    :returns: {peer: {request bytes: [(delay, response bytes or None), ...]}}
+    """
+    pending = {}
+    answered = {}
+    answers = collections.defaultdict(lambda: collections.defaultdict(list))
+    for record in records:
+        if record.kind == traffic_trace.REQUEST:
+            pending[(record.peer, record.txn)] = record
+        elif record.kind in (traffic_trace.RESPONSE, traffic_trace.NO_RESPONSE):
+            request = pending.pop((record.peer, record.txn), None)
+            if request is None:
+                continue
+            started = max(request.time, answered.get(record.peer, 0))
+            answered[record.peer] = record.time
+            response = record.payload if record.kind == traffic_trace.RESPONSE else None
+            answers[record.peer][request.payload].append((record.time - started, response))
+    return {peer: dict(table) for peer, table in answers.items()}
+
+
+def replay_address(index):
+    return f"127.0.{(index + 2) // 256}.{(index + 2) % 256}"
+
+
+class ReplayDevice(asyncio.Protocol):
+    """Answer Modbus TCP requests with the responses of a trace."""
+
+    def __init__(self, answers, speed):
+        self.answers = answers
+        self.speed = speed
+        self.transport = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def data_received(self, data):
+        self.buffer += data
+        while len(self.buffer) >= MBAP.size:
+            tid, _, length, _ = MBAP.unpack_from(self.buffer)
+            if len(self.buffer) < 6 + length:
+                break
+            request = bytes(self.buffer[6:6 + length])
+            del self.buffer[:6 + length]
+            outcomes = self.answers.get(request)
+            if outcomes is None:
+                response = bytes((request[0], request[1] | 0x80, TARGET_FAILED))
+                delay = 0
+            else:
+                # 同一请求的多次应答轮流使用
+                delay, response = outcomes.popleft()
+                outcomes.append((delay, response))
+                if response is None:
+                    continue
+            frame = struct.pack(">HHH", tid, 0, len(response)) + response
+            if self.speed:
+                asyncio.get_running_loop().call_later(delay / self.speed, self.send, frame)
+            else:
+                self.send(frame)
+
+    def send(self, frame):
+        if self.transport is not None:
+            self.transport.write(frame)
+
+
+async def serve_devices(answers, addresses, port, speed, ready):
+    loop = asyncio.get_running_loop()
+    servers = []
+    for peer, table in answers.items():
+        table = {request: collections.deque(outcomes) for request, outcomes in table.items()}
+        servers.append(await loop.create_server(
+            functools.partial(ReplayDevice, table, speed), addresses[peer], port))
+    ready.set()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for server in servers:
+            server.close()
+
+
+def _devices_main(answers, addresses, port, speed, ready):
+    asyncio.run(serve_devices(answers, addresses, port, speed, ready))
+
+
+class NullWriter:
+    """Stands in for the cloud connection and the uplink; counts the bytes."""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+    async def drain(self):
+        pass
+
+    def publish(self, message, on_sent=None, on_spilled=None):
+        self.bytes += len(message)
+        if on_sent is not None:
+            on_sent()
+        return True
+
+
+async def run_timeline(events, speed, handle):
+    """Call handle(record) for each event, at the recorded time scaled by speed.
+
+    With speed 0 the events run one after another as fast as possible;
+    otherwise each runs as its own task, overlapping like in production.
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    tasks = []
+    for record in events:
+        if not speed:
+            await handle(record)
+            continue
+        delay = start + record.time / speed - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(handle(record)))
+    await asyncio.gather(*tasks)
+
+
+def timed(durations, label, func):
+    async def run(*args):
+        started = time.perf_counter()
+        try:
+            return await func(*args)
+        finally:
+            durations[label].append(time.perf_counter() - started)
+    return run
+
+
+async def replay_forwarder(records, addresses, port, config, speed, durations):
+    units = collections.defaultdict(set)
+    for record in records:
+        if record.kind == traffic_trace.REQUEST:
+            units[record.peer].add(record.payload[0])
+    devices = [{"ip": addresses[peer], "port": port, "slave": unit}
+               for peer in sorted(units) for unit in sorted(units[peer])]
+    pool = forwarder.create_pool(config)
+    breakers = forwarder.create_breakers(config)
+    encoder = forwarder.create_encoder(config)
+    binary = config.get("uplink", {}).get("format") == "binary"
+    uplink = NullWriter()
+    data = {}
+
+    async def forward():
+        if data:
+            forwarder.forward_data(uplink, forwarder.copy_snapshot(data), encoder, binary)
+
+    async def handle(record):
+        if record.kind == traffic_trace.POLL:
+            group = record.payload.decode("utf-8")
+            await timed(durations, "poll " + group, forwarder.poll_devices)(pool, devices, group, data, breakers)
+        else:
+            await timed(durations, "forward", forward)()
+
+    events = []
+    for record in records:
+        if record.kind == traffic_trace.POLL:
+            events.append(record)
+        elif record.kind == traffic_trace.CLOUD_OUT and (not events or events[-1].kind != traffic_trace.CLOUD_OUT):
+            # 增量模式下一次上送有多条消息，只回放一次
+            events.append(record)
+    try:
+        await run_timeline(events, speed, handle)
+    finally:
+        pool.close()
+    return uplink.bytes
+
+
+async def replay_gateway(records, addresses, port, config, speed, durations):
+    settings = gateway.gateway_settings(config.get("gateway", {}))
+    settings["device_port"] = port
+    target = gateway.Gateway(**settings)
+    ips = {peer.rsplit(":", 1)[0]: address for peer, address in addresses.items()}
+    writer = NullWriter()
+    decoder = JsonStreamDecoder()
+
+    def remap(command):
+        if isinstance(command, dict) and command.get("ip") in ips:
+            command["ip"] = ips[command["ip"]]
+
+    async def handle(record):
+        jobs = []
+        for request_data in decoder.feed(record.payload):
+            if isinstance(request_data, FramingError) or not isinstance(request_data, dict):
+                continue
+            if "batch" in request_data and isinstance(request_data["batch"], list):
+                for command in request_data["batch"]:
+                    remap(command)
+                jobs.append(timed(durations, "batch", gateway.forward_batch)(target, writer, request_data))
+            elif request_data.get("type") != "stats":
+                remap(request_data)
+                jobs.append(timed(durations, "command", gateway.forward_single)(target, writer, request_data))
+        await asyncio.gather(*jobs)
+
+    events = [record for record in records if record.kind == traffic_trace.CLOUD_IN]
+    try:
+        await run_timeline(events, speed, handle)
+    finally:
+        target.close()
+    return writer.bytes
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean": statistics.mean(values),
+        "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        "max": values[-1],
+    }
+
+
+def replay(path, speed=1.0, port=5602, config=None, allocations=False):
+    """Replay a trace and measure it.
+
+    :param path: The trace file
+    :param speed: Time scale of the recorded timing, 0 for as fast as possible
+    :param port: TCP port of the replay devices
+    :param config: The config dict used to build the pool, gateway and encoder
+    :param allocations: Trace memory allocations (slows the replay down)
+    :returns: The result dict
+    """
+    service, _, records = traffic_trace.read_trace(path)
+    config = config or {}
+    answers = build_answers(records)
+    addresses = {peer: replay_address(index) for index, peer in enumerate(sorted(answers))}
+    ready = multiprocessing.Event()
+    # 回放设备在子进程中运行，CPU 和内存只统计被测代码
+    process = multiprocessing.Process(target=_devices_main, args=(answers, addresses, port, speed, ready), daemon=True)
+    process.start()
+    if not ready.wait(30):
+        process.terminate()
+        raise RuntimeError("replay devices did not start")
+    durations = collections.defaultdict(list)
+    runner = replay_gateway if service == "gateway" else replay_forwarder
+    if allocations:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        sent = asyncio.run(runner(records, addresses, port, config, speed, durations))
+    finally:
+        process.terminate()
+        process.join()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    result = {
+        "trace": path,
+        "service": service,
+        "speed": speed,
+        "requests": sum(record.kind == traffic_trace.REQUEST for record in records),
+        "wall": wall,
+        "cpu": cpu,
+        "cloudBytes": sent,
+        "cycles": {label: summarize(values) for label, values in sorted(durations.items())},
+    }
+    if allocations:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["allocations"] = {"current": current, "peak": peak}
+    return result
+
+
+def change(value, baseline):
+    if baseline is None:
+        return ""
+    if not baseline:
+        return "       n/a"
+    return f"{100 * (value - baseline) / baseline:+9.1f}%"
+
+
+def report(result, baseline=None):
+    baseline = baseline or {}
+    cycles = baseline.get("cycles", {})
+    print(f"{result['service']} trace {result['trace']}, {result['requests']} recorded requests, "
+          f"speed {result['speed'] or 'max'}")
+    print(f"{'cycle':<20} {'count':>6} {'mean ms':>10} {'p95 ms':>10} {'max ms':>10}"
+          + (f" {'vs base':>10}" if baseline else ""))
+    for label, stats in result["cycles"].items():
+        base = cycles.get(label, {}).get("mean") if baseline else None
+        print(f"{label:<20} {stats['count']:>6} {stats['mean'] * 1000:10.2f} {stats['p95'] * 1000:10.2f} "
+              f"{stats['max'] * 1000:10.2f}" + (f" {change(stats['mean'], base)}" if baseline else ""))
+    print(f"wall {result['wall']:.3f}s {change(result['wall'], baseline.get('wall')) if baseline else ''}")
+    print(f"cpu  {result['cpu']:.3f}s {change(result['cpu'], baseline.get('cpu')) if baseline else ''}")
+    if "allocations" in result:
+        peak = result["allocations"]["peak"]
+        base = baseline.get("allocations", {}).get("peak") if baseline else None
+        print(f"peak {peak / 1024:.0f} KiB {change(peak, base) if baseline else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a traffic trace and measure the code paths")
+    parser.add_argument("trace", help="The .s2t trace file")
+    parser.add_argument("--speed", type=float, default=1.0, help="Time scale, 1 for recorded timing, 0 for max speed")
+    parser.add_argument("--port", type=int, default=5602, help="TCP port of the replay devices")
+    parser.add_argument("--config", default="config.json", help="Config used to build pool, gateway and encoder")
+    parser.add_argument("--allocations", action="store_true", help="Trace memory allocations")
+    parser.add_argument("--output", help="Write the result as JSON")
+    parser.add_argument("--baseline", help="JSON result of an earlier run to compare with")
+    args = parser.parse_args()
+    # 日志输出会左右测量结果
+    logging.disable(logging.CRITICAL)
+    try:
+        with open(args.config, "r") as file:
+            config = json.load(file)
+    except FileNotFoundError:
+        config = {}
+    # 回放时不再录制
+    config.pop("trace", None)
+    result = replay(args.trace, args.speed, args.port, config, args.allocations)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+    report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Per-device request queues with round-robin fairness and backpressure.
+
+Every device gets a bounded queue and a limit on how many of its requests
+may run at once. Queued requests are granted round-robin across devices,
+so one chatty device cannot starve the others when a global in-flight
+budget is set. A request to a device whose queue is full fails at once
+with BusyError instead of piling up behind the device timeout.
+"""
+
+__all__ = [
+    "BusyError",
+    "FairScheduler",
+]
+
+import asyncio
+import collections
+import time
+
+
+class BusyError(Exception):
+    """The device queue is full."""
+
+
+class _DeviceQueue:
+    def __init__(self):
+        self.waiting = collections.deque()
+        self.outstanding = 0
+        self.served = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def stats(self):
+        return {
+            "depth": len(self.waiting),
+            "outstanding": self.outstanding,
+            "served": self.served,
+            "rejected": self.rejected,
+            "waitAvg": self.wait_total / self.served if self.served else 0.0,
+            "waitMax": self.wait_max,
+        }
+
+
+class FairScheduler:
+    """Grant device requests round-robin within per-device and global limits."""
+
+    def __init__(self, max_outstanding=1, max_queue=16, max_inflight=0):
+        """Initialize a new instance.
+
+        :param max_outstanding: Max requests running at once per device
+        :param max_queue: Max requests waiting per device before BusyError
+        :param max_inflight: Max requests running at once over all devices, 0 for no limit
+        """
+        self.max_outstanding = max_outstanding
+        self.max_queue = max_queue
+        self.max_inflight = max_inflight
+        self.queues = {}
+        self.ready = collections.deque()
+        self.inflight = 0
+
+    def _queue(self, device):
+        queue = self.queues.get(device)
+        if queue is None:
+            queue = _DeviceQueue()
+            self.queues[device] = queue
+        return queue
+
+    def _next_ready(self):
+        for _ in range(len(self.ready)):
+            device = self.ready[0]
+            queue = self.queues[device]
+            if not queue.waiting:
+                self.ready.popleft()
+                continue
+            self.ready.rotate(-1)
+            if queue.outstanding < self.max_outstanding:
+                return device, queue
+        return None, None
+
+    def _dispatch(self):
+        while not self.max_inflight or self.inflight < self.max_inflight:
+            device, queue = self._next_ready()
+            if device is None:
+                return
+            grant = queue.waiting.popleft()
+            if grant.done():
+                # cancelled while waiting
+                continue
+            queue.outstanding += 1
+            self.inflight += 1
+            grant.set_result(None)
+
+    def _release(self, queue):
+        queue.outstanding -= 1
+        self.inflight -= 1
+        self._dispatch()
+
+    async def submit(self, device, request):
+        """Run a request once the device's turn comes.
+
+        :param device: The device key, e.g. its ip
+        :param request: Coroutine function performing the request
+        :returns: The result of the request
+        :raises BusyError: if the device queue is full
+        """
+        queue = self._queue(device)
+        if len(queue.waiting) >= self.max_queue:
+            queue.rejected += 1
+            raise BusyError(f"{device} busy")
+        grant = asyncio.get_running_loop().create_future()
+        queue.waiting.append(grant)
+        if device not in self.ready:
+            self.ready.append(device)
+        enqueued = time.monotonic()
+        self._dispatch()
+        try:
+            await grant
+        except asyncio.CancelledError:
+            if grant in queue.waiting:
+                queue.waiting.remove(grant)
+            elif not grant.cancelled():
+                self._release(queue)
+            raise
+        waited = time.monotonic() - enqueued
+        queue.served += 1
+        queue.wait_total += waited
+        queue.wait_max = max(queue.wait_max, waited)
+        try:
+            return await request()
+        finally:
+            self._release(queue)
+
+    def stats(self):
+        """Return queue depth, wait time and counters per device."""
+        return {device: queue.stats() for device, queue in self.queues.items()}
@@ -0,0 +1,115 @@
+"""Short-TTL response cache with in-flight request coalescing.
+
+Raw Modbus TCP read commands for the same device are keyed by the frame
+without its MBAP transaction id. A cached response is replayed with the
+transaction id of the new request; identical requests already on their
+way to the device share that single round trip.
+"""
+
+__all__ = [
+    "ResponseCache",
+]
+
+import asyncio
+import collections
+import time
+
+#: Read coils, read discrete inputs, read holding registers, read input registers
+READ_FUNCTION_CODES = frozenset((1, 2, 3, 4))
+
+
+def _retrieve(future):
+    # nobody may be waiting on a failed coalesced request
+    if not future.cancelled():
+        future.exception()
+
+
+class ResponseCache:
+    """LRU bounded cache of read responses keyed by (ip, normalized frame)."""
+
+    def __init__(self, ttl=0.5, maxsize=256):
+        """Initialize a new instance.
+
+        :param ttl: How long a response is served from the cache, in seconds (0 disables caching)
+        :param maxsize: Max number of cached responses
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.bypassed = 0
+
+    @staticmethod
+    def key(ip, frame):
+        """Return the cache key of a request, or None if it must not be cached.
+
+        :param ip: The device ip
+        :param frame: The Modbus TCP request frame
+        """
+        if len(frame) < 8 or frame[7] not in READ_FUNCTION_CODES:
+            return None
+        # drop the transaction id, keep protocol, length, unit and pdu
+        return ip, bytes(frame[2:])
+
+    async def fetch(self, ip, frame, request):
+        """Return the response to a frame, from the cache when possible.
+
+        :param ip: The device ip
+        :param frame: The Modbus TCP request frame
+        :param request: Coroutine function sending a frame to the device
+        :returns: The response frame, carrying the transaction id of this request
+        """
+        key = self.key(ip, frame)
+        if key is None:
+            self.bypassed += 1
+            return await request(frame)
+        tid = bytes(frame[:2])
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, response = entry
+            if time.monotonic() < expires:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return tid + response[2:]
+            del self.entries[key]
+        pending = self.inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            response = await asyncio.shield(pending)
+            return tid + response[2:]
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_retrieve)
+        self.inflight[key] = future
+        try:
+            response = await request(frame)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(response)
+            # do not cache modbus exception responses
+            if self.ttl > 0 and len(response) > 7 and not response[7] & 0x80:
+                self.entries[key] = (time.monotonic() + self.ttl, response)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+            return response
+        finally:
+            del self.inflight[key]
+
+    def stats(self):
+        """Return the cache counters as a dict."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "bypassed": self.bypassed,
+            "size": len(self.entries),
+        }
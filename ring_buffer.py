@@ -0,0 +1,183 @@
+"""Fixed-size, memory-mapped ring buffer of messages on disk.
+
+The file is a small header followed by `slots` fixed-size slots::
+
+    header  ">4sHHIIQQ"  magic b"S2RB", version, reserved, slot size,
+                         slot count, head (next sequence number to write),
+                         tail (next sequence number to read)
+    slot    ">QII"       sequence number, payload length, crc32 of payload
+            payload
+
+A message is written into its slot before the header's head moves, so
+after a power cut only the slots past the recorded head need checking:
+recovery walks forward from head while the slots carry the expected
+sequence number and a valid crc, instead of scanning the whole file.
+When the ring is full the oldest message is evicted.
+"""
+
+__all__ = [
+    "RingBuffer",
+]
+
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"S2RB"
+VERSION = 1
+
+HEADER = struct.Struct(">4sHHIIQQ")
+SLOT = struct.Struct(">QII")
+#: Offset of the head/tail fields in the header
+HEAD_OFFSET = 16
+TAIL_OFFSET = 24
+HEADER_SIZE = 64
+
+
+class RingBuffer:
+    """Persistent FIFO of byte messages with a fixed number of slots."""
+
+    def __init__(self, path, slots=256, slot_size=256 * 1024, sync=True):
+        """Open or create a ring file.
+
+        :param path: The ring file
+        :param slots: Number of messages the ring holds
+        :param slot_size: Bytes per slot, including the slot header
+        :param sync: Flush every write to disk (msync)
+        """
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.sync = sync
+        self.appended = 0
+        self.evicted = 0
+        self.oversized = 0
+        self.corrupt = 0
+        size = HEADER_SIZE + slots * slot_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, version, _, slot_size_on_disk, slots_on_disk, head, tail = HEADER.unpack_from(self.map, 0)
+        if fresh or magic != MAGIC or version != VERSION \
+                or slot_size_on_disk != slot_size or slots_on_disk != slots:
+            if not fresh:
+                logger.warning(f"Ring {path} has another layout, starting empty")
+            self.head = self.tail = 0
+            HEADER.pack_into(self.map, 0, MAGIC, VERSION, 0, slot_size, slots, 0, 0)
+            self.map.flush()
+        else:
+            self.head = head
+            self.tail = tail
+            self._recover()
+
+    def _offset(self, seq):
+        return HEADER_SIZE + (seq % self.slots) * self.slot_size
+
+    def _read_slot(self, seq):
+        """Return the payload stored for seq, or None if the slot does not hold it."""
+        offset = self._offset(seq)
+        stored_seq, length, crc = SLOT.unpack_from(self.map, offset)
+        if stored_seq != seq or length > self.slot_size - SLOT.size:
+            return None
+        start = offset + SLOT.size
+        payload = self.map[start:start + length]
+        if zlib.crc32(payload) != crc:
+            return None
+        return payload
+
+    def _recover(self):
+        # messages written after the last header update are still valid
+        recovered = 0
+        while self._read_slot(self.head) is not None and recovered < self.slots:
+            self.head += 1
+            recovered += 1
+        if self.head - self.tail > self.slots:
+            self.tail = self.head - self.slots
+        if self.tail > self.head:
+            self.tail = self.head
+        self._write_pointers()
+        logger.info(f"Ring {self.path} recovered {len(self)} messages ({recovered} past the header)")
+
+    def _write_pointers(self):
+        struct.pack_into(">QQ", self.map, HEAD_OFFSET, self.head, self.tail)
+        if self.sync:
+            self.map.flush(0, min(mmap.PAGESIZE, len(self.map)))
+
+    def __len__(self):
+        """Return the number of messages waiting in the ring."""
+        return self.head - self.tail
+
+    def append(self, payload):
+        """Store a message, evicting the oldest one when full.
+
+        :param payload: The message bytes
+        :returns: False if the message does not fit in a slot
+        """
+        if len(payload) > self.slot_size - SLOT.size:
+            self.oversized += 1
+            logger.warning(f"Message of {len(payload)} bytes does not fit a {self.slot_size} byte ring slot")
+            return False
+        seq = self.head
+        offset = self._offset(seq)
+        start = offset + SLOT.size
+        self.map[start:start + len(payload)] = payload
+        SLOT.pack_into(self.map, offset, seq, len(payload), zlib.crc32(payload))
+        if self.sync:
+            page = offset - offset % mmap.PAGESIZE
+            self.map.flush(page, start + len(payload) - page)
+        self.head = seq + 1
+        if self.head - self.tail > self.slots:
+            self.tail = self.head - self.slots
+            self.evicted += 1
+        self._write_pointers()
+        self.appended += 1
+        return True
+
+    def peek(self):
+        """Return the oldest message without removing it.
+
+        Corrupt slots are skipped.
+
+        :returns: (sequence number, payload), or (None, None) if empty
+        """
+        while self.tail < self.head:
+            payload = self._read_slot(self.tail)
+            if payload is not None:
+                return self.tail, payload
+            self.corrupt += 1
+            self.tail += 1
+            self._write_pointers()
+        return None, None
+
+    def commit(self, seq):
+        """Remove the messages up to and including seq.
+
+        :param seq: The sequence number returned by peek()
+        """
+        if seq >= self.tail:
+            self.tail = min(seq + 1, self.head)
+            self._write_pointers()
+
+    def stats(self):
+        """Return the ring counters as a dict."""
+        return {
+            "pending": len(self),
+            "appended": self.appended,
+            "evicted": self.evicted,
+            "oversized": self.oversized,
+            "corrupt": self.corrupt,
+        }
+
+    def close(self):
+        """Flush and unmap the ring file."""
+        self.map.flush()
+        self.map.close()
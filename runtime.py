@@ -0,0 +1,228 @@
+"""All-in-one runtime: config API, gateway and poller in one process.
+
+forwarder.py, gateway.py and app.py each open their own sockets to the
+same PLCs, and small PLCs run out of connection slots. This runtime hosts
+all three in one asyncio event loop instead:
+
+- the poller is forwarder.py's: the same jobs on one DeadlineScheduler,
+  the same uplink, history and hot reload of config.json
+- cloud commands are answered like gateway.py does, but sent over the
+  poller's pooled connection to the device, so commands and background
+  polls are multiplexed on one socket and share its in-flight limit
+- the Flask config API runs in a thread of the same process (Flask is a
+  WSGI app and cannot be served by the event loop itself); its /stream
+  subscribers are fed from the poller's snapshot without the socket
+
+Devices are connected with the pipelined client (pipeline.py), which can
+pass the gateway's raw MBAP frames through; "pool": {"pipeline": N}
+sets the depth, "pool": {"concurrency"} (4) by default. A malformed
+command frame is answered with a Modbus exception response (illegal data
+value) and never sent to the device. The API listens on config.json
+"app": {"host": "127.0.0.1", "port": 5000}.
+
+Run ``python runtime.py`` (s2c2s-runtime.service) instead of the three
+services, never together with them.
+"""
+
+__all__ = [
+    "PooledGateway",
+    "run_runtime",
+    "start_runtime",
+]
+
+import asyncio
+import json
+import logging
+import struct
+import threading
+import time
+
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+from werkzeug.serving import make_server
+
+import app as config_app
+import config_watch
+import forwarder
+import gateway
+import log_pipeline
+import traffic_trace
+from deadline_scheduler import DeadlineScheduler
+from live_feed import DEFAULT_INTERVAL, DEFAULT_QUEUE_SIZE, SnapshotHub
+from modbus_pool import device_key
+from pipeline import validate_frame
+
+logger = logging.getLogger("runtime")
+
+# 配置页面的默认监听地址，与 app.py 单独运行时相同
+APP_HOST = "127.0.0.1"
+APP_PORT = 5000
+
+# 非法的命令帧按 Modbus 异常码 03（非法数据值）应答
+ILLEGAL_DATA_VALUE = 3
+
+
+def exception_response(frame, code=ILLEGAL_DATA_VALUE):
+    """Return a Modbus exception response to a request frame.
+
+    :param frame: The request frame, possibly truncated
+    :param code: The exception code
+    """
+    tid = bytes(frame[:2]).ljust(2, b"\0")
+    unit = frame[6] if len(frame) > 6 else 0
+    function = frame[7] if len(frame) > 7 else 0
+    return tid + struct.pack(">HHBBB", 0, 3, unit, function | 0x80, code)
+
+
+class PooledGateway(gateway.Gateway):
+    """A Gateway that sends commands over the poller's device connections."""
+
+    def __init__(self, pool, devices, **settings):
+        """Initialize a new instance.
+
+        :param pool: The ModbusConnectionPool of the poller
+        :param devices: The poller's device list, kept up to date by forwarder.reconcile()
+        :param settings: Keyword arguments as returned by gateway.gateway_settings()
+        """
+        super().__init__(**settings)
+        self.pool = pool
+        self.devices = devices
+
+    def device(self, ip):
+        # 命令按 ip 寻址；不在设备列表中的 ip 按网关的设备端口连接
+        for device in self.devices:
+            if device["ip"] == ip:
+                return device
+        return {"ip": ip, "port": self.device_port, "slave": 1}
+
+    def stats(self):
+        stats = super().stats()
+        stats["devices"] = self.pool.stats()
+        return stats
+
+    async def request(self, ip, frame):
+        return await self.scheduler.submit(ip, lambda: self.exchange(ip, frame))
+
+    async def exchange(self, ip, frame):
+        try:
+            validate_frame(frame)
+        except ValueError as exc:
+            logger.warning(f"Invalid command frame for {ip}: {exc}")
+            return exception_response(frame)
+        device = self.device(ip)
+        connection = await self.pool.acquire(device)
+        tracer = traffic_trace.TRACER
+        peer = device_key(device)
+        txn = None
+        try:
+            # 与轮询共用同一连接的并发上限
+            async with connection.limiter:
+                if tracer is not None:
+                    txn = tracer.request(peer, frame[6:])
+                log_pipeline.dump_frame("out", ip, frame)
+                gateway.DEVICE_BYTES.labels(ip, "out").inc(len(frame))
+                response = await connection.client.execute_raw(frame)
+        except Exception as exc:
+            if txn is not None:
+                tracer.no_response(peer, txn, type(exc).__name__)
+            if isinstance(exc, (ConnectionException, ModbusIOException)):
+                # 超时后设备可能仍在应答旧的事务，重新连接
+                self.pool.discard(device)
+            raise
+        gateway.DEVICE_BYTES.labels(ip, "in").inc(len(response))
+        log_pipeline.dump_frame("in", ip, response)
+        if txn is not None:
+            tracer.response(peer, txn, response[6:])
+        return response
+
+
+def serve_app(config, hub):
+    """Serve the Flask config API from a daemon thread.
+
+    :param hub: The SnapshotHub serving /stream
+    :returns: The werkzeug server, stop it with shutdown()
+    """
+    options = config.get("app", {})
+    config_app.config_data = config_app.load_config()
+    config_app.live_hub = hub
+    server = make_server(options.get("host", APP_HOST), options.get("port", APP_PORT), config_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="app", daemon=True).start()
+    logger.info(f"Config API listening on {server.host}:{server.port}")
+    return server
+
+
+async def run_runtime(config):
+    devices = config["devices"]
+    pool = forwarder.create_pool(config)
+    # 网关命令需要透传 MBAP 帧，只有流水线客户端支持；深度默认取每台设备的并发上限
+    pool.pipeline = pool.pipeline or pool.concurrency or 1
+    uplink = forwarder.create_uplink(config)
+    encoder = forwarder.create_encoder(config)
+    historian = forwarder.create_historian(config)
+    binary = config.get("uplink", {}).get("format") == "binary"
+    scheduler = DeadlineScheduler()
+    breakers = forwarder.create_breakers(config)
+    forwarder.save_status(breakers)
+    metrics_dir = forwarder.metrics_path(config)
+    traffic_trace.start(config, "runtime")
+    data = {}
+    # 网关的配置单独保存一份，热更新时才能比较出被删除的设备
+    gateway_config = dict(config)
+    target = PooledGateway(pool, devices, **gateway.gateway_settings(config.get("gateway", {})))
+    live_options = config.get("live", {})
+    hub = SnapshotHub(live_options.get("queueSize", DEFAULT_QUEUE_SIZE))
+
+    async def forward():
+        target.update_metrics()
+        if data:
+            snapshot = forwarder.copy_snapshot(data)
+            if historian is not None:
+                historian.record(snapshot, time.time())
+            logger.debug(f"Connection pool {pool.stats()}")
+            logger.debug(f"Schedule {scheduler.stats()}")
+            forwarder.forward_data(uplink, snapshot, encoder, binary)
+            forwarder.save_data(snapshot)
+            forwarder.save_status(breakers)
+        forwarder.dump_metrics(metrics_dir, "runtime", scheduler, pool)
+
+    async def publish_live():
+        hub.publish(data, time.time())
+
+    def reconcile(new_config):
+        # 先更新网关，forwarder.reconcile 会修改共用的设备列表
+        gateway.reconcile_gateway(target, gateway_config, new_config)
+        forwarder.reconcile(config, new_config, scheduler, pool, devices, data, breakers, uplink)
+
+    schedule = forwarder.add_poll_jobs(scheduler, config, pool, devices, data, breakers)
+    scheduler.add("forward", schedule["forward"], forward)
+    scheduler.add("live", live_options.get("interval", DEFAULT_INTERVAL), publish_live)
+    watcher = config_watch.ConfigWatcher(forwarder.CONFIG_FILE, reconcile, current=json.loads(json.dumps(config)))
+    server = serve_app(config, hub)
+    gateway.spawn(target, gateway.serve_cloud(target, gateway_config))
+    gateway.spawn(target, watcher.run())
+    try:
+        await scheduler.run_async()
+    finally:
+        for task in list(target.tasks):
+            task.cancel()
+        server.shutdown()
+        uplink.stop()
+        pool.close()
+        if historian is not None:
+            historian.close()
+        traffic_trace.stop()
+
+
+def start_runtime():
+    config = gateway.load_config()
+    log_pipeline.setup(config, "runtime")
+    if config is None or "devices" not in config:
+        logger.error("Config invalid, exiting..")
+        return
+    try:
+        asyncio.run(run_runtime(config))
+    finally:
+        log_pipeline.shutdown()
+
+
+if __name__ == "__main__":
+    start_runtime()
@@ -0,0 +1,358 @@
+"""Sharded forwarder: poll a large device fleet from several processes.
+
+A supervisor assigns every device to one of N worker processes by
+consistent hashing of its "ip:port", so a device keeps its worker across
+restarts, devices behind one ip share a worker (and its connection), and
+changing the worker count only moves about 1/N of the devices.
+
+Each worker polls its share exactly like forwarder.py and also does the
+encoding work (JSON, binary frames or deltas) before sending its partial
+snapshot over a pipe. The supervisor only joins the pre-encoded parts
+and publishes them through the single cloud uplink, so it does not
+become the bottleneck the workers were meant to remove.
+
+The supervisor also serves the live feed (live_feed.py) from the joined
+snapshot, so it is updated once per "forward" period rather than every
+"live" interval.
+
+A restarted worker continues the delta sequence numbers of its devices
+where the previous one stopped, starting with keyframes, so the cloud
+can tell a restart from lost messages.
+
+Workers are started with the "spawn" method: the supervisor runs the
+uplink, log and live feed threads, and restarting a worker must not fork
+a copy of a process holding their locks.
+
+Run ``python shard.py`` instead of forwarder.py. The worker count is set
+with config.json "shards": {"workers": 4}, by default one per core.
+"""
+
+__all__ = [
+    "HashRing",
+    "assign",
+    "run_supervisor",
+    "start_sharded",
+]
+
+import asyncio
+import bisect
+import functools
+import hashlib
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+
+import forwarder
+import log_pipeline
+import traffic_trace
+import wire_format
+from deadline_scheduler import DeadlineScheduler
+from modbus_pool import device_key
+
+logger = logging.getLogger("shard")
+
+#: Seconds to wait before restarting a worker that died
+RESTART_DELAY = 5
+
+# 主进程有上行、日志线程，工作进程不能 fork
+CONTEXT = multiprocessing.get_context("spawn")
+
+
+def _hash(key):
+    # hash() is salted per process, md5 is stable across restarts
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring mapping keys to nodes."""
+
+    def __init__(self, nodes, replicas=64):
+        """Initialize a new instance.
+
+        :param nodes: The node names
+        :param replicas: Points per node on the ring, more spreads keys more evenly
+        """
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node(self, key):
+        """Return the node owning a key."""
+        position = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.nodes[position]
+
+
+def assign(devices, workers, replicas=64):
+    """Split devices across workers by consistent hash of their "ip:port".
+
+    :param devices: The device entries from config.json
+    :param workers: The number of workers
+    :param replicas: Points per worker on the hash ring
+    :returns: One list of devices per worker
+    """
+    ring = HashRing([f"worker{index}" for index in range(workers)], replicas)
+    shares = [[] for _ in range(workers)]
+    for device in devices:
+        shares[int(ring.node(device_key(device))[6:])].append(device)
+    return shares
+
+
+async def run_worker(index, config, devices, conn, seqs=None):
+    """Poll a share of the devices and send the encoded snapshots to the supervisor.
+
+    :param seqs: {device: last delta sequence number} sent by a previous worker
+    """
+    pool = forwarder.create_pool(config)
+    encoder = forwarder.create_encoder(config)
+    if encoder is not None:
+        for device, seq in (seqs or {}).items():
+            encoder.resume(device, seq)
+    historian = forwarder.create_historian(config)
+    binary = config.get("uplink", {}).get("format") == "binary"
+    scheduler = DeadlineScheduler()
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+    metrics_dir = forwarder.metrics_path(config)
+    traffic_trace.start(config, f"forwarder-shard{index}")
+    data = {}
+
+    def on_change(breaker, old, new):
+        logger.warning(f"Worker {index}: device {breaker.key} breaker {old} -> {new}")
+        conn.send(("status", breakers.stats()))
+
+    breakers = forwarder.create_breakers(config, on_change)
+
+    def on_message():
+        try:
+            kind, device, seq = conn.recv()
+        except (EOFError, OSError):
+            # 主进程已退出
+            loop.remove_reader(conn.fileno())
+            if not stopped.done():
+                stopped.set_result(None)
+            return
+        if kind == "ack" and encoder is not None:
+            encoder.ack(device, seq)
+        elif kind == "resync" and encoder is not None:
+            encoder.resync(device, seq)
+
+    async def forward():
+        if not data:
+            return
+        snapshot = forwarder.copy_snapshot(data)
+        if historian is not None:
+            historian.record(snapshot, time.time())
+        # 去掉外层花括号，主进程直接拼接各分片的 JSON
+        fragment = json.dumps(snapshot)[1:-1]
+        if encoder is not None:
+            payload = [(delta["device"], delta["seq"], (json.dumps(delta) + "\n").encode("utf-8"))
+                       for delta in encoder.encode(snapshot)]
+        elif binary:
+            payload = wire_format.encode_snapshot(snapshot, time.time(), forwarder.BLOCK_KINDS)
+        else:
+            payload = None
+        conn.send(("snapshot", fragment, payload))
+        conn.send(("status", breakers.stats()))
+        forwarder.dump_metrics(metrics_dir, f"forwarder-shard{index}", scheduler, pool)
+
+    loop.add_reader(conn.fileno(), on_message)
+    schedule = forwarder.add_poll_jobs(scheduler, config, pool, devices, data, breakers)
+    scheduler.add("forward", schedule["forward"], forward)
+    jobs = asyncio.ensure_future(scheduler.run_async())
+    try:
+        await asyncio.wait([jobs, stopped], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        jobs.cancel()
+        pool.close()
+        if historian is not None:
+            historian.close()
+        traffic_trace.stop()
+
+
+def worker_main(index, config, devices, conn, seqs=None):
+    # spawn 启动的工作进程重新建立自己的日志队列
+    log_pipeline.setup(config, f"forwarder-shard{index}")
+    asyncio.run(run_worker(index, config, devices, conn, seqs))
+
+
+class _Shard:
+    """Supervisor side of one worker process."""
+
+    def __init__(self, index, devices):
+        self.index = index
+        self.devices = devices
+        self.process = None
+        self.conn = None
+        self.fragment = ""
+        self.payload = None
+        self.breakers = {}
+        # 每台设备最后收到的增量序号，重启的工作进程接着编号
+        self.seqs = {}
+        self.restarts = 0
+        self.restart_at = 0
+
+    def start(self, config):
+        parent, child = CONTEXT.Pipe()
+        self.process = CONTEXT.Process(
+            target=worker_main, args=(self.index, config, self.devices, child, dict(self.seqs)),
+            name=f"forwarder-shard{self.index}", daemon=True)
+        self.process.start()
+        child.close()
+        self.conn = parent
+        logger.info(f"Worker {self.index} (pid {self.process.pid}) polls {len(self.devices)} devices")
+
+    def stop(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join(1)
+
+    def ack(self, device, seq, kind="ack"):
+        # 在上行线程中调用：把已发送（或已转存到环形缓冲）的序号告诉对应的增量编码器
+        conn = self.conn
+        if conn is not None:
+            try:
+                conn.send((kind, device, seq))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            "pid": self.process.pid if self.process is not None else None,
+            "devices": len(self.devices),
+            "restarts": self.restarts,
+            "alive": self.process is not None and self.process.is_alive(),
+        }
+
+
+def _receive(shard, uplink):
+    try:
+        message = shard.conn.recv()
+    except (EOFError, OSError):
+        return False
+    if message[0] == "snapshot":
+        _, shard.fragment, payload = message
+        if isinstance(payload, list):
+            # 增量消息按设备立即上送，发送后回执给所属的分片
+            for device, seq, data in payload:
+                shard.seqs[device] = seq
+                if not uplink.publish(data, functools.partial(shard.ack, device, seq),
+                                      functools.partial(shard.ack, device, seq, "resync")):
+                    logger.warning(f"Uplink queue full, {device} #{seq} dropped")
+        else:
+            shard.payload = payload
+    elif message[0] == "status":
+        shard.breakers = message[1]
+    return True
+
+
+def start_live_feed(config):
+    """Serve the live feed from an event loop in a thread of the supervisor.
+
+    :returns: (loop, FeedServer), or (None, None) if the socket is unavailable
+    """
+    loop = asyncio.new_event_loop()
+    feed = loop.run_until_complete(forwarder.start_live_feed(config))
+    if feed is None:
+        loop.close()
+        return None, None
+    threading.Thread(target=loop.run_forever, name="live-feed", daemon=True).start()
+    return loop, feed
+
+
+def _publish_live(feed, text, timestamp):
+    # 在推送线程中运行；没有读取者时不解析快照
+    if feed.writers:
+        feed.publish(json.loads(text), timestamp)
+
+
+def _forward(shards, uplink, delta, binary, live=None):
+    fragments = [shard.fragment for shard in shards if shard.fragment]
+    if not fragments:
+        return
+    text = "{" + ", ".join(fragments) + "}"
+    if live is not None:
+        loop, feed = live
+        loop.call_soon_threadsafe(_publish_live, feed, text, time.time())
+    if not delta:
+        if binary:
+            message = b"".join(shard.payload for shard in shards if shard.payload)
+        else:
+            message = (text + "\n").encode("utf-8")
+        if not uplink.publish(message):
+            logger.warning("Uplink queue full, snapshot dropped")
+    with open('data.json', 'w') as file:
+        file.write(text)
+    breakers = {}
+    for shard in shards:
+        breakers.update(shard.breakers)
+    with open(forwarder.STATUS_FILE, 'w') as file:
+        json.dump({"breakers": breakers, "shards": {shard.index: shard.stats() for shard in shards}}, file)
+
+
+def run_supervisor(config):
+    """Start the workers and forward their snapshots until interrupted."""
+    options = config.get("shards", {})
+    workers = options.get("workers") or os.cpu_count() or 1
+    shares = assign(config["devices"], workers, options.get("replicas", 64))
+    shards = [_Shard(index, share) for index, share in enumerate(shares) if share]
+    delta = config.get("uplink", {}).get("encoding") == "delta"
+    binary = config.get("uplink", {}).get("format") == "binary"
+    period = dict(forwarder.DEFAULT_SCHEDULE, **config.get("schedule", {}))["forward"]
+    for shard in shards:
+        shard.start(config)
+    uplink = forwarder.create_uplink(config)
+    loop, feed = start_live_feed(config)
+    live = (loop, feed) if feed is not None else None
+    deadline = time.monotonic() + period
+    try:
+        while True:
+            conns = {shard.conn: shard for shard in shards if shard.conn is not None}
+            ready = multiprocessing.connection.wait(list(conns), max(0, deadline - time.monotonic()))
+            for conn in ready:
+                shard = conns[conn]
+                if not _receive(shard, uplink):
+                    shard.stop()
+                    logger.error(f"Worker {shard.index} exited ({shard.process.exitcode}), "
+                                 f"restarting in {RESTART_DELAY}s")
+                    shard.fragment = ""
+                    shard.payload = None
+                    shard.restart_at = time.monotonic() + RESTART_DELAY
+            now = time.monotonic()
+            for shard in shards:
+                if shard.conn is None and now >= shard.restart_at:
+                    shard.restarts += 1
+                    shard.start(config)
+            if now >= deadline:
+                _forward(shards, uplink, delta, binary, live)
+                logger.debug(f"Uplink {uplink.stats()}")
+                # 与 DeadlineScheduler 相同：按绝对时间推进，错过的周期直接跳过
+                deadline += period
+                if now >= deadline:
+                    deadline += ((now - deadline) // period + 1) * period
+    finally:
+        for shard in shards:
+            shard.stop()
+        uplink.stop()
+        if live is not None:
+            loop.call_soon_threadsafe(feed.close)
+            loop.call_soon_threadsafe(loop.stop)
+
+
+def start_sharded(config):
+    run_supervisor(config)
+
+
+if __name__ == "__main__":
+    config_data = forwarder.load_config()
+    log_pipeline.setup(config_data, "shard")
+    if config_data is None or "devices" not in config_data:
+        logger.error("Config invalid, exiting..")
+        raise SystemExit(1)
+    start_sharded(config_data)
@@ -0,0 +1,87 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from framing import FramingError, JsonStreamDecoder, encode_message  # noqa: E402
+
+
+def feed_split(text, at):
+    decoder = JsonStreamDecoder()
+    data = text.encode("utf-8")
+    return decoder.feed(data[:at]) + decoder.feed(data[at:])
+
+
+def test_split_inside_true():
+    text = '{"ip":"1.2.3.4","cmd":"0001","x":true}\n'
+    assert feed_split(text, text.index("ue}")) == [{"ip": "1.2.3.4", "cmd": "0001", "x": True}]
+
+
+def test_split_inside_null():
+    text = '{"ip":"1.2.3.4","x":null}\n'
+    assert feed_split(text, text.index("ll}")) == [{"ip": "1.2.3.4", "x": None}]
+
+
+def test_split_after_minus():
+    text = '{"a":-12}\n'
+    assert feed_split(text, text.index("-") + 1) == [{"a": -12}]
+
+
+def test_split_inside_number_at_top_level():
+    assert feed_split("12\n", 1) == [12]
+
+
+def test_every_split_point():
+    text = '{"ip":"1.2.3.4","cmd":"0001","n":-1.5e3,"b":[true,false,null],"s":"\\u00e9x"}\n'
+    expected = [{"ip": "1.2.3.4", "cmd": "0001", "n": -1500.0, "b": [True, False, None], "s": "\u00e9x"}]
+    for at in range(len(text.encode("utf-8")) + 1):
+        assert feed_split(text, at) == expected, at
+
+
+def test_objects_without_newline():
+    decoder = JsonStreamDecoder()
+    assert decoder.feed(b'{"a":1}{"b":2}{"c"') == [{"a": 1}, {"b": 2}]
+    assert decoder.feed(b':3}') == [{"c": 3}]
+
+
+def test_invalid_line_resyncs():
+    decoder = JsonStreamDecoder()
+    messages = decoder.feed(b'{bad {"a":1}\n{"b":2}\n')
+    assert isinstance(messages[0], FramingError)
+    assert messages[1:] == [{"a": 1}, {"b": 2}]
+
+
+def test_unterminated_garbage_waits_for_newline():
+    decoder = JsonStreamDecoder()
+    assert decoder.feed(b"{bad") == []
+    assert isinstance(decoder.feed(b"\n")[0], FramingError)
+
+
+def test_encode_message_roundtrip():
+    assert JsonStreamDecoder().feed(encode_message({"a": [1, 2]})) == [{"a": [1, 2]}]
+
+
+def test_escaped_quote_and_brace_at_every_split_point():
+    text = '{"s":"a\\\\\\"}b\\\\","t":["]"]}\n'
+    expected = [{"s": 'a\\"}b\\', "t": ["]"]}]
+    for at in range(len(text.encode("utf-8")) + 1):
+        assert feed_split(text, at) == expected, at
+
+
+def test_large_message_is_decoded_once():
+    calls = []
+
+    class CountingDecoder(json.JSONDecoder):
+        def raw_decode(self, text, position=0):
+            calls.append(position)
+            return super().raw_decode(text, position)
+
+    decoder = JsonStreamDecoder()
+    decoder.decoder = CountingDecoder()
+    data = encode_message({"batch": [{"ip": "1.2.3.4", "cmd": "0001"}] * 5000})[:-1]
+    messages = []
+    for start in range(0, len(data), 4096):
+        messages += decoder.feed(data[start:start + 4096])
+    assert len(messages) == 1 and len(messages[0]["batch"]) == 5000
+    assert len(calls) == 1
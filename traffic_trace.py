@@ -0,0 +1,234 @@
+"""Compact binary traces of Modbus and cloud traffic.
+
+With config.json "trace": {"path": "traces"} the forwarder and the
+gateway write every Modbus request and response, every message to and
+from the cloud and the start of every poll cycle to
+<path>/<service>-<start time>.s2t. replay.py plays such a trace back
+against the same code paths, so performance can be compared between
+builds on an identical workload.
+
+File layout: a header ">4sBdB" (magic S2TR, version, start time as unix
+seconds, service name length) followed by the service name, then one
+record per event:
+
+    kind (B), µs since the previous record (I), peer id (H),
+    transaction (H), payload length (I), payload
+
+Peers ("ip:port") are declared once by a PEER record whose payload is
+the name. Modbus payloads are the unit id followed by the PDU, the same
+bytes as the MBAP frame minus its 6-byte header. A RESPONSE or
+NO_RESPONSE carries the transaction of its REQUEST, since several
+requests to one device may be in flight.
+"""
+
+__all__ = [
+    "CLOUD_IN",
+    "CLOUD_OUT",
+    "NO_RESPONSE",
+    "PEER",
+    "POLL",
+    "REQUEST",
+    "RESPONSE",
+    "Tracer",
+    "encode_pdu",
+    "read_trace",
+    "start",
+    "stop",
+]
+
+import collections
+import logging
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"S2TR"
+VERSION = 1
+HEADER = struct.Struct(">4sBdB")
+RECORD = struct.Struct(">BIHHI")
+
+PEER = 0
+REQUEST = 1
+RESPONSE = 2
+NO_RESPONSE = 3
+CLOUD_IN = 4
+CLOUD_OUT = 5
+POLL = 6
+# 与上一条记录间隔超过 uint32 微秒（约 71 分钟）时补的占位记录
+GAP = 7
+
+MAX_DELTA = 0xFFFFFFFF
+
+#: Seconds between two flushes of the trace file
+FLUSH_INTERVAL = 1
+
+#: The tracer of this process, None while not tracing
+TRACER = None
+
+Record = collections.namedtuple("Record", "kind time peer txn payload")
+
+
+def encode_pdu(unit, message):
+    """Return the traced bytes of a pymodbus request or response.
+
+    :param unit: The slave id
+    :param message: A pymodbus PDU, including ExceptionResponse
+    """
+    return bytes((unit, message.function_code)) + message.encode()
+
+
+class Tracer:
+    """Append traffic records to a trace file."""
+
+    def __init__(self, path, service, max_bytes=256 * 1024 * 1024):
+        """Initialize a new instance.
+
+        :param path: The trace file
+        :param service: The service name stored in the header
+        :param max_bytes: Recording stops once the file reaches this size
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.file = open(path, "wb", buffering=64 * 1024)
+        name = service.encode("utf-8")
+        self.file.write(HEADER.pack(MAGIC, VERSION, time.time(), len(name)) + name)
+        self.size = HEADER.size + len(name)
+        self.peers = {}
+        self.txn = 0
+        self.last = time.monotonic()
+        self.flushed = self.last
+        self.full = False
+
+    def _write(self, kind, peer, txn, payload):
+        # 调用方持有锁
+        if self.full:
+            return
+        now = time.monotonic()
+        delta = int((now - self.last) * 1e6)
+        while delta > MAX_DELTA:
+            self.file.write(RECORD.pack(GAP, MAX_DELTA, 0, 0, 0))
+            delta -= MAX_DELTA
+        self.file.write(RECORD.pack(kind, delta, peer, txn, len(payload)))
+        self.file.write(payload)
+        # 只推进记录下来的微秒数，舍去的部分留到下一条，累计时间不漂移
+        self.last += delta / 1e6
+        self.size += RECORD.size + len(payload)
+        if self.size >= self.max_bytes:
+            self.full = True
+            logger.warning(f"Trace {self.path} reached {self.max_bytes} bytes, recording stopped")
+        if now - self.flushed >= FLUSH_INTERVAL:
+            self.file.flush()
+            self.flushed = now
+
+    def _peer(self, name):
+        peer = self.peers.get(name)
+        if peer is None:
+            peer = len(self.peers) + 1
+            self.peers[name] = peer
+            self._write(PEER, peer, 0, name.encode("utf-8"))
+        return peer
+
+    def request(self, peer, payload):
+        """Record a Modbus request.
+
+        :param peer: The device, "ip:port"
+        :param payload: Unit id and PDU
+        :returns: The transaction to pass to response() or no_response()
+        """
+        with self.lock:
+            self.txn = (self.txn + 1) & 0xFFFF
+            self._write(REQUEST, self._peer(peer), self.txn, payload)
+            return self.txn
+
+    def response(self, peer, txn, payload):
+        """Record the response to a request."""
+        with self.lock:
+            self._write(RESPONSE, self._peer(peer), txn, payload)
+
+    def no_response(self, peer, txn, reason):
+        """Record a request that failed without a response (timeout, connection lost)."""
+        with self.lock:
+            self._write(NO_RESPONSE, self._peer(peer), txn, reason.encode("utf-8"))
+
+    def cloud_in(self, data):
+        """Record bytes received from the cloud."""
+        with self.lock:
+            self._write(CLOUD_IN, 0, 0, bytes(data))
+
+    def cloud_out(self, data):
+        """Record a message sent or queued to the cloud."""
+        with self.lock:
+            self._write(CLOUD_OUT, 0, 0, bytes(data))
+
+    def poll(self, group):
+        """Record the start of a poll cycle of a block group."""
+        with self.lock:
+            self._write(POLL, 0, 0, group.encode("utf-8"))
+
+    def close(self):
+        with self.lock:
+            self.full = True
+            self.file.close()
+
+
+def start(config, service):
+    """Start tracing this process if config.json has a "trace" section.
+
+    :param config: The config dict
+    :param service: The service name, used in the file name
+    :returns: The tracer, or None if tracing is off
+    """
+    global TRACER
+    options = config.get("trace")
+    if not options:
+        return None
+    path = options.get("path", "traces")
+    os.makedirs(path, exist_ok=True)
+    file_name = os.path.join(path, f"{service}-{time.strftime('%Y%m%d-%H%M%S')}.s2t")
+    TRACER = Tracer(file_name, service, options.get("maxBytes", 256 * 1024 * 1024))
+    logger.info(f"Tracing traffic to {file_name}")
+    return TRACER
+
+
+def stop():
+    """Close the tracer of this process."""
+    global TRACER
+    tracer, TRACER = TRACER, None
+    if tracer is not None:
+        tracer.close()
+
+
+def read_trace(path):
+    """Read a trace file.
+
+    :param path: The trace file
+    :returns: (service, start time, list of Record), times in seconds since the start
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    magic, version, started, length = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} trace")
+    service = data[HEADER.size:HEADER.size + length].decode("utf-8")
+    offset = HEADER.size + length
+    peers = {0: ""}
+    records = []
+    elapsed = 0
+    while offset + RECORD.size <= len(data):
+        kind, delta, peer, txn, size = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        payload = data[offset:offset + size]
+        if len(payload) < size:
+            # 进程被杀时最后一条记录可能不完整
+            break
+        offset += size
+        elapsed += delta
+        if kind == PEER:
+            peers[peer] = payload.decode("utf-8")
+        elif kind != GAP:
+            records.append(Record(kind, elapsed / 1e6, peers.get(peer, ""), txn, payload))
+    return service, started, records
@@ -0,0 +1,281 @@
+"""Persistent, non-blocking uplink to the cloud server.
+
+The poll loop hands encoded messages to publish(), which never blocks.
+A dedicated thread owns the single cloud connection, drains the bounded
+queue and reconnects with exponential backoff, so a WAN outage never
+delays device polling.
+
+With a RingBuffer attached, messages published while the cloud is
+unreachable are stored on disk instead of dropped, and replayed at a
+limited rate once the connection is back. The uplink thread does the
+disk writes, so a slow SD card never stalls polling. Live messages are
+always sent first; the backlog only uses the time the link would
+otherwise be idle.
+
+retarget() moves the uplink to a new cloud address without losing the
+queue, e.g. after config.json "cloudIP" changed.
+"""
+
+__all__ = [
+    "CloudUplink",
+    "DROP_NEWEST",
+    "DROP_OLDEST",
+    "ring_slot_size",
+]
+
+import collections
+import logging
+import socket
+import threading
+import time
+
+from modbus_pool import ExponentialBackoff
+
+logger = logging.getLogger(__name__)
+
+#: When the queue is full, discard the oldest queued message (keep the latest data)
+DROP_OLDEST = "drop_oldest"
+#: When the queue is full, discard the message being published
+DROP_NEWEST = "drop_newest"
+
+#: Smallest default ring slot, in bytes
+MIN_SLOT_SIZE = 256 * 1024
+
+
+def ring_slot_size(message_size):
+    """Return a ring slot size holding messages of up to message_size bytes.
+
+    :param message_size: The largest message expected, in bytes
+    """
+    # 槽头与换行等少量开销，按 4 KB 对齐
+    size = message_size + 64
+    return max(MIN_SLOT_SIZE, -(-size // 4096) * 4096)
+
+
+class CloudUplink(threading.Thread):
+    """Bounded queue plus one persistent, auto-reconnecting cloud connection."""
+
+    def __init__(self, host, port, maxsize=16, policy=DROP_OLDEST,
+                 timeout=5, backoff_initial=1, backoff_max=60, ring=None, replay_rate=2):
+        """Initialize a new instance.
+
+        :param host: Cloud server ip
+        :param port: Cloud server port
+        :param maxsize: Number of messages buffered while the link is slow or down
+        :param policy: DROP_OLDEST or DROP_NEWEST, applied when the queue is full
+        :param timeout: Connect/send timeout, in seconds
+        :param backoff_initial: First reconnect delay, in seconds
+        :param backoff_max: Largest reconnect delay, in seconds
+        :param ring: Optional RingBuffer storing messages during outages
+        :param replay_rate: Max messages per second replayed from the ring
+        """
+        super().__init__(name="uplink", daemon=True)
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"unknown uplink policy {policy}")
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.policy = policy
+        self.timeout = timeout
+        self.backoff = ExponentialBackoff(backoff_initial, backoff_max)
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.sock = None
+        self.stopping = False
+        self.moved = False
+        self.published = 0
+        self.sent = 0
+        self.dropped = 0
+        self.connects = 0
+        self.send_errors = 0
+        self.ring = ring
+        self.replay_rate = replay_rate
+        self.next_replay = 0
+        self.replayed = 0
+        self.spilled = 0
+
+    def publish(self, message, on_sent=None, on_spilled=None):
+        """Queue an encoded message for the cloud without blocking.
+
+        :param message: The bytes to send
+        :param on_sent: Optional callable run in the uplink thread once the message was sent
+        :param on_spilled: Optional callable run in the uplink thread if the message
+                           went to the ring instead (on_sent is then never called)
+        :returns: False if the message was dropped
+        """
+        with self.condition:
+            self.published += 1
+            # 断网时由上行线程把队列转存到磁盘环形缓冲，这里不丢弃也不做磁盘 IO
+            spilling = self.ring is not None and self.sock is None
+            if len(self.queue) >= self.maxsize and not spilling:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return False
+                self.queue.popleft()
+            self.queue.append((message, on_sent, on_spilled))
+            self.condition.notify()
+        return True
+
+    def stats(self):
+        """Return the uplink counters as a dict."""
+        with self.condition:
+            queued = len(self.queue)
+            stats = {
+                "connected": self.sock is not None,
+                "queued": queued,
+                "published": self.published,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "connects": self.connects,
+                "sendErrors": self.send_errors,
+            }
+            if self.ring is not None:
+                stats["spilled"] = self.spilled
+                stats["replayed"] = self.replayed
+                stats["ring"] = self.ring.stats()
+        return stats
+
+    def retarget(self, host, port):
+        """Send to a new cloud address from the next message on.
+
+        The uplink thread closes the current connection; queued messages
+        are kept and sent to the new address.
+
+        :param host: Cloud server ip
+        :param port: Cloud server port
+        """
+        with self.condition:
+            if (host, port) == (self.host, self.port):
+                return
+            self.host = host
+            self.port = port
+            self.moved = True
+            # 新地址立即重连，不沿用旧地址的退避时间
+            self.backoff.success()
+            self.condition.notify()
+
+    def stop(self):
+        """Stop the uplink thread and close the connection."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+    def _connect(self):
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError as exc:
+            self.backoff.failure()
+            logger.error(f"Uplink connection error: {exc}, retrying in {self.backoff.delay}s")
+            return False
+        sock.settimeout(self.timeout)
+        self.sock = sock
+        self.connects += 1
+        self.backoff.success()
+        logger.info(f"Uplink connected to {self.host}:{self.port}")
+        return True
+
+    def _disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def _next(self):
+        """Return the next (entry, ring sequence number) to send.
+
+        Returns (None, None) when stopping or when the address changed.
+        """
+        with self.condition:
+            while not self.stopping and not self.moved:
+                if self.queue:
+                    return self.queue.popleft(), None
+                if self.ring is not None and len(self.ring):
+                    delay = self.next_replay - time.monotonic()
+                    if delay <= 0:
+                        seq, message = self.ring.peek()
+                        if message is not None:
+                            return (message, None, None), seq
+                        continue
+                    self.condition.wait(delay)
+                    continue
+                self.condition.wait()
+            return None, None
+
+    def _replayed(self, seq):
+        with self.condition:
+            self.ring.commit(seq)
+            self.replayed += 1
+            self.next_replay = time.monotonic() + 1 / self.replay_rate
+
+    def _requeue(self, entry):
+        with self.condition:
+            if len(self.queue) < self.maxsize or self.ring is not None:
+                self.queue.appendleft(entry)
+            else:
+                self.dropped += 1
+
+    def _spill(self):
+        """Move the queued messages to the ring; runs in the uplink thread while disconnected."""
+        if self.ring is None:
+            return
+        with self.condition:
+            entries = list(self.queue)
+            self.queue.clear()
+        stored = 0
+        for message, _, on_spilled in entries:
+            # 写盘和 msync 在锁外进行，publish 不会被阻塞
+            if self.ring.append(message):
+                stored += 1
+            if on_spilled is not None:
+                on_spilled()
+        with self.condition:
+            self.spilled += stored
+            self.dropped += len(entries) - stored
+
+    def _wait_backoff(self):
+        deadline = time.monotonic() + self.backoff.delay
+        while True:
+            self._spill()
+            with self.condition:
+                delay = deadline - time.monotonic()
+                if self.stopping or self.moved or delay <= 0:
+                    return
+                if self.ring is not None and self.queue:
+                    continue
+                self.condition.wait(delay)
+
+    def run(self):
+        while not self.stopping:
+            if self.moved:
+                with self.condition:
+                    self.moved = False
+                self._disconnect()
+                logger.info(f"Uplink moved to {self.host}:{self.port}")
+            if self.sock is None:
+                self._spill()
+                if not self._connect():
+                    self._wait_backoff()
+                    continue
+            entry, seq = self._next()
+            if entry is None:
+                continue
+            message, on_sent, _ = entry
+            try:
+                self.sock.sendall(message)
+                self.sent += 1
+            except OSError as exc:
+                self.send_errors += 1
+                logger.error(f"Error forwarding data to cloud server: {exc}")
+                self._disconnect()
+                if seq is None:
+                    self._requeue(entry)
+                continue
+            if seq is not None:
+                self._replayed(seq)
+            if on_sent is not None:
+                on_sent()
+        self._disconnect()
+        if self.ring is not None:
+            self.ring.close()
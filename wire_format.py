@@ -0,0 +1,207 @@
+"""Compact binary framing of forwarder snapshots.
+
+One frame per device::
+
+    header  ">2sBBIHdH"  magic b"S2", version, flags, body length,
+                         device (slave id), timestamp, block count
+    block   ">BBHH"      kind, name length, block address, count
+            name         group name, e.g. b"machine0"
+            payload      bits packed 8 per byte (LSB first, like pack_bitstring)
+                         or registers as big-endian uint16
+
+The body length lets a receiver split a byte stream into frames.
+"""
+
+__all__ = [
+    "decode_frame",
+    "decode_stream",
+    "encode_frame",
+    "encode_snapshot",
+]
+
+import array
+import struct
+import sys
+
+from read_plan import BITS
+
+MAGIC = b"S2"
+VERSION = 1
+
+#: The device could not be polled at all, the frame has no blocks
+FLAG_DEVICE_ERROR = 0x01
+
+KIND_BITS = 0
+KIND_REGISTERS = 1
+#: The block failed to read ("" in the JSON snapshot)
+KIND_MISSING = 2
+
+HEADER = struct.Struct(">2sBBIHdH")
+BLOCK = struct.Struct(">BBHH")
+
+_BIT_CHARS = bytes.maketrans(b"\x00\x01", b"01")
+_CHAR_BITS = bytes.maketrans(b"01", b"\x00\x01")
+_SWAP = sys.byteorder == "little"
+
+
+def pack_bits(bits):
+    """Pack a sequence of booleans 8 per byte, first bit in the LSB.
+
+    :param bits: The bit values
+    :returns: The packed bytes
+    """
+    if not bits:
+        return b""
+    text = bytes(map(bool, reversed(bits))).translate(_BIT_CHARS)
+    return int(text, 2).to_bytes((len(bits) + 7) // 8, "little")
+
+
+def unpack_bits(data, count):
+    """Unpack count booleans packed by pack_bits.
+
+    :param data: The packed bytes
+    :param count: The number of bits to return
+    :returns: A list of booleans
+    """
+    if not count:
+        return []
+    text = format(int.from_bytes(data, "little"), f"0{len(data) * 8}b").encode("ascii")
+    return list(map(bool, text[::-1][:count].translate(_CHAR_BITS)))
+
+
+def pack_registers(registers):
+    """Encode register values as big-endian uint16.
+
+    :param registers: The register values
+    :returns: The encoded bytes
+    """
+    values = array.array("H", registers)
+    if _SWAP:
+        values.byteswap()
+    return values.tobytes()
+
+
+def unpack_registers(data):
+    """Decode big-endian uint16 register values.
+
+    :param data: The encoded bytes
+    :returns: A list of register values
+    """
+    values = array.array("H")
+    values.frombytes(data)
+    if _SWAP:
+        values.byteswap()
+    return values.tolist()
+
+
+def _device_id(device):
+    return int(device[5:]) if device.startswith("slave") else int(device)
+
+
+def _kind(kinds, group, key, values):
+    if kinds is None:
+        # 未给出数据块类型时按值的类型猜测，modbus_tk 返回的 0/1 位会被当作寄存器
+        return KIND_BITS if isinstance(values[0], bool) else KIND_REGISTERS
+    return KIND_BITS if kinds[group, key] == BITS else KIND_REGISTERS
+
+
+def encode_frame(device, data, timestamp, kinds=None):
+    """Encode the data of one device into a frame.
+
+    :param device: The device name, e.g. "slave1"
+    :param data: The device data, {group: {"0x10": [...], ...}} or "" on error
+    :param timestamp: The poll time, in seconds since the epoch
+    :param kinds: {(group, key): read_plan.BITS or REGISTERS} of every block;
+                  if None, lists of bools are sent as bits, other lists as registers
+    :returns: The frame bytes
+    """
+    parts = []
+    blocks = 0
+    flags = 0
+    if isinstance(data, dict):
+        for group, values_by_key in data.items():
+            name = group.encode("utf-8")
+            for key, values in values_by_key.items():
+                address = int(key, 16)
+                if not isinstance(values, (list, tuple)) or not len(values):
+                    kind, payload, count = KIND_MISSING, b"", 0
+                elif _kind(kinds, group, key, values) == KIND_BITS:
+                    kind, payload, count = KIND_BITS, pack_bits(values), len(values)
+                else:
+                    kind, payload, count = KIND_REGISTERS, pack_registers(values), len(values)
+                parts.append(BLOCK.pack(kind, len(name), address, count))
+                parts.append(name)
+                parts.append(payload)
+                blocks += 1
+    else:
+        flags |= FLAG_DEVICE_ERROR
+    body = b"".join(parts)
+    header = HEADER.pack(MAGIC, VERSION, flags, len(body), _device_id(device), timestamp, blocks)
+    return header + body
+
+
+def encode_snapshot(snapshot, timestamp, kinds=None):
+    """Encode a {"slaveN": {...}} snapshot, one frame per device.
+
+    :param snapshot: The poll snapshot
+    :param timestamp: The poll time, in seconds since the epoch
+    :param kinds: The block kinds, see encode_frame()
+    :returns: The concatenated frames
+    """
+    return b"".join(encode_frame(device, data, timestamp, kinds) for device, data in snapshot.items())
+
+
+def decode_frame(data, offset=0):
+    """Reference decoder of one frame.
+
+    :param data: A buffer holding the frame
+    :param offset: Where the frame starts in data
+    :returns: (device, device data, timestamp, offset of the next frame)
+    :raises ValueError: if the buffer does not hold a valid frame
+    """
+    magic, version, flags, length, device_id, timestamp, blocks = HEADER.unpack_from(data, offset)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"not a v{VERSION} snapshot frame")
+    position = offset + HEADER.size
+    end = position + length
+    device = "slave" + str(device_id)
+    if flags & FLAG_DEVICE_ERROR:
+        return device, "", timestamp, end
+    result = {}
+    view = memoryview(data)
+    for _ in range(blocks):
+        kind, name_length, address, count = BLOCK.unpack_from(data, position)
+        position += BLOCK.size
+        group = bytes(view[position:position + name_length]).decode("utf-8")
+        position += name_length
+        if kind == KIND_BITS:
+            size = (count + 7) // 8
+            values = unpack_bits(view[position:position + size], count)
+        elif kind == KIND_REGISTERS:
+            size = count * 2
+            values = unpack_registers(view[position:position + size])
+        else:
+            size = 0
+            values = ""
+        position += size
+        result.setdefault(group, {})[f"0x{address:x}"] = values
+    if position != end:
+        raise ValueError("frame length mismatch")
+    return device, result, timestamp, end
+
+
+def decode_stream(data):
+    """Decode every complete frame of a buffer.
+
+    :param data: The received bytes
+    :returns: (list of (device, device data, timestamp), number of bytes consumed)
+    """
+    frames = []
+    offset = 0
+    while len(data) - offset >= HEADER.size:
+        length = HEADER.unpack_from(data, offset)[3]
+        if len(data) - offset < HEADER.size + length:
+            break
+        device, result, timestamp, offset = decode_frame(data, offset)
+        frames.append((device, result, timestamp))
+    return frames, offset